@@ -0,0 +1,551 @@
+# asyncio engine
+#  UDP endpoint for NetSIO devices, TCP endpoint for Altirra custom device and all timers
+#  (buffer age, alive expiry, sync timeout) are running on single event loop.
+#  Message handling is shared with thread engine (NetSIOServer, NetSIOHandler, AtDevHandlerBase).
+#  Everything is driven by protocol callbacks, no tasks are involved on the relay path,
+#  e.g. sync response from device is answered to emulator directly from datagram callback.
+
+from netsiohub import deviceserver
+from netsiohub.hub import *
+from netsiohub.lanes import QueueLane, control_lane
+
+import asyncio
+import collections
+import queue
+import socket
+
+
+# max datagrams handled in one go, before other events are served
+DATAGRAM_BATCH = 64
+# how long to wait for atdevice to become ready to receive, in seconds
+ATDEV_READY_TIMEOUT = 5.0
+
+
+def new_event_loop():
+    # selector loop on all platforms, add_reader() is not available with proactor loop on Windows
+    loop = asyncio.SelectorEventLoop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+class LoopQueue:
+    """Non-blocking two lane queue living on event loop, compatible with queue.Queue as used by hub,
+    lanes and ordering rules are same as in LaneQueue (lanes.py)"""
+    def __init__(self, maxsize=0, control_maxsize=8):
+        self.control = QueueLane(control_maxsize)
+        self.data = QueueLane(maxsize)
+        # called after item is put into the queue
+        self.on_put = None
+
+    def qsize(self):
+        return len(self.control) + len(self.data)
+
+    def empty(self):
+        return not self.qsize()
+
+    def full(self):
+        return self.data.full()
+
+    def put(self, item, block=True, timeout=None):
+        # never block the loop, queue size is kept low by credit flow control
+        lane = self.control if control_lane(item) else self.data
+        if lane.full():
+            metric_event(METRIC_QUEUE_FULL)
+        lane.push(item)
+        if self.on_put is not None:
+            self.on_put()
+
+    put_nowait = put
+
+    def get_nowait(self, data=True):
+        """Take next message, control lane first, data lane only if data is true"""
+        if len(self.control):
+            return self.control.pop()
+        if data and len(self.data):
+            return self.data.pop()
+        raise queue.Empty
+
+    def data_waiting(self) -> int:
+        return len(self.data)
+
+    def stats(self) -> dict:
+        return {'control': self.control.stats(), 'data': self.data.stats()}
+
+
+class LoopInBuffer(NetInBuffer):
+    """Byte buffer with auto flush on size or age, age is watched by event loop timer"""
+
+    def __init__(self, server):
+        self.loop:asyncio.AbstractEventLoop = server.loop
+        self.timer:asyncio.TimerHandle = None
+        super().__init__(server)
+
+    def start_monitor(self):
+        pass
+
+    def arm(self):
+        if self.timer is None:
+            self.timer = self.loop.call_later(self.BUFFER_MAX_AGE, self.expire)
+
+    def expire(self):
+        self.timer = None
+        if not len(self.data):
+            return
+        tmout = self.time_left()
+        if tmout > 0.0:
+            # bytes arrived meanwhile
+            self.timer = self.loop.call_later(tmout, self.expire)
+        else:
+            self.flush(self.FLUSH_AGE)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        debug_print("NetInBuffer flushes:", self.flushes)
+
+
+class LoopClientExpiry(ClientExpiry):
+    """Client alive deadlines watched by event loop timer"""
+
+    def __init__(self, server):
+        self.loop:asyncio.AbstractEventLoop = server.loop
+        self.timer:asyncio.TimerHandle = None
+        super().__init__(server)
+
+    def start_monitor(self):
+        pass
+
+    def arm(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(max(0.0, self.heap[0][0] - timer()), self.deadline)
+
+    def deadline(self):
+        self.timer = None
+        self.expire()
+        if self.heap and self.timer is None:
+            self.arm()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+class LoopNetSIOServer(NetSIOServer):
+    """NetSIO UDP Server, datagrams are received via event loop"""
+
+    inbuffer_class = LoopInBuffer
+    expiry_class = LoopClientExpiry
+
+    def __init__(self, hub:NetSIOHub, port:int, loop:asyncio.AbstractEventLoop):
+        self.loop = loop
+        super().__init__(hub, port)
+
+    def shutdown(self):
+        # serve_forever() is not used, only stop buffer and expiry timers
+        self.inbuffer.stop()
+        self.expiry.stop()
+        debug_print("Routing{}:".format(self.hub.tag), self.router.stats())
+
+
+class NetSIOReader:
+    """Pass datagrams received on server socket to NetSIOHandler
+
+    Socket is drained on every read event, asyncio datagram transport would
+    handle only one datagram per loop iteration."""
+    def __init__(self, server:LoopNetSIOServer):
+        self.server = server
+        self.sock:socket.socket = server.socket
+        self.sock.setblocking(False)
+        server.loop.add_reader(self.sock.fileno(), self.read_ready)
+
+    def close(self):
+        self.server.loop.remove_reader(self.sock.fileno())
+
+    def read_ready(self):
+        recvfrom = self.sock.recvfrom
+        for _ in range(DATAGRAM_BATCH):
+            try:
+                data, addr = recvfrom(self.server.max_packet_size)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. ICMP port unreachable reported on Windows
+                debug_print("NetSIO socket error:", e)
+                continue
+            NetSIOHandler((data, self.sock), addr, self.server)
+
+
+class AsyncNetSIOManager(NetSIOManager):
+    """Manages NetSIO (SIO over UDP) traffic on event loop"""
+
+    def __init__(self, loop:asyncio.AbstractEventLoop, port=NETSIO_PORT):
+        super().__init__(port)
+        self.loop = loop
+        self.server:LoopNetSIOServer = None
+        self.reader:NetSIOReader = None
+        # messages to devices, sent in one batch when current callback is done
+        self.outbox = []
+        # data bytes held for coalescing window
+        self.pending = []
+        self.pending_timer:asyncio.TimerHandle = None
+
+    def start(self, hub):
+        print("UDP port (NetSIO):", self.port)
+        self.server = LoopNetSIOServer(hub, self.port, self.loop)
+        self.reader = NetSIOReader(self.server)
+        print("Listening for NetSIO packets on port {}".format(self.port))
+
+    def stop(self):
+        debug_print("Stop AsyncNetSIOManager")
+        if self.pending_timer is not None:
+            self.pending_timer.cancel()
+            self.pending_timer = None
+        if self.server is not None:
+            self.reader.close()
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def to_peripheral(self, msg):
+        if msg.id == NETSIO_DATA_BYTE and self.coalesce_age > 0.0:
+            # hold data byte for coalescing window
+            if not self.pending:
+                self.pending_timer = self.loop.call_later(self.coalesce_age, self.flush_pending)
+            self.pending.append(msg)
+            if len(self.pending) >= self.coalesce_size:
+                self.flush_pending()
+            return
+        if self.pending:
+            # sync, command, reset, ... go right after held bytes
+            self.flush_pending()
+        self.post(msg)
+
+    def to_peripheral_sync(self, msg):
+        # do not wait for the end of current callback
+        if self.pending:
+            self.flush_pending()
+        self.post(msg)
+        self.send_outbox()
+
+    def flush_pending(self):
+        if self.pending_timer is not None:
+            self.pending_timer.cancel()
+            self.pending_timer = None
+        pending = self.pending
+        self.pending = []
+        for msg in pending:
+            self.post(msg)
+
+    def post(self, msg):
+        # no device queue, message is sent as soon as the loop is done with current callback,
+        # together with other messages produced by it
+        if not self.outbox:
+            self.loop.call_soon(self.send_outbox)
+        self.outbox.append(msg)
+
+    def send_outbox(self):
+        msgs = self.outbox
+        if not msgs:
+            return # already sent with sync request
+        self.outbox = []
+        if len(msgs) > 1:
+            msgs = coalesce_bytes(msgs, self.coalesce_size)
+        if self.server is not None:
+            self.server.send_batch_to_all(msgs)
+
+    def connected(self):
+        """Return true if any device is connected"""
+        return self.server.connected()
+
+    def credit_clients(self):
+        return self.server.credit_clients()
+
+    def stats(self) -> dict:
+        return {'device_queue': len(self.outbox) + len(self.pending),
+                'clients': self.server.credit_stats() if self.server is not None else {}}
+
+
+class TransportRequest:
+    """Socket-like wrapper of transport, lets DeviceProtocol.req_*() methods to write to transport.
+    Writes inside "with request:" block are gathered, as with AtDevChannel."""
+    __slots__ = ['transport', 'depth', 'pending']
+
+    def __init__(self, transport:asyncio.Transport):
+        self.transport = transport
+        self.depth = 0
+        self.pending = []
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0 and self.pending:
+            buffers = self.pending
+            self.pending = []
+            self.transport.writelines(buffers)
+
+    def sendall(self, data):
+        if self.depth:
+            self.pending.append(data)
+        else:
+            self.transport.write(data)
+
+
+class AsyncAtDevHandler(AtDevHandlerBase):
+    """Handler to communicate with netsio.atdevice, served by event loop
+
+    The protocol service loop serve() is driven by AtDevProtocol, serve() yields number
+    of bytes it needs to continue, or the sync request it waits for."""
+    def __init__(self, transport:asyncio.Transport, server):
+        self.ready_timer:asyncio.TimerHandle = None
+        self.host_queue:LoopQueue = None
+        super().__init__(TransportRequest(transport), transport.get_extra_info('peername'), server)
+
+    def connected(self):
+        self.verbose = self.server.cmdline_args.verbose
+        self.hub = self.server.hub
+        self.atdev_ready = asyncio.Event()
+        self.atdev_ready.set()
+        print("Connection received from emulator")
+        self.host_queue = self.hub.host_connected(self)
+        self.host_queue.on_put = self.pump
+
+    def disconnected(self):
+        if self.host_queue is not None:
+            self.host_queue.on_put = None
+            self.host_queue = None
+            self.hub.host_disconnected()
+        if self.ready_timer is not None:
+            self.ready_timer.cancel()
+            self.ready_timer = None
+
+    def set_rtr(self):
+        super().set_rtr()
+        if self.ready_timer is not None:
+            self.ready_timer.cancel()
+            self.ready_timer = None
+        self.pump()
+
+    def pump(self):
+        """Send "messages" to Altirra atdevice, event loop counterpart of AtDevThread"""
+        q = self.host_queue
+        while q is not None and q.qsize():
+            ready = self.atdev_ready.is_set()
+            if not ready and not len(q.control):
+                # POKEY is busy, wait for atdevice to post ready, control messages go out anyway
+                if self.ready_timer is None:
+                    self.ready_timer = self.server.loop.call_later(ATDEV_READY_TIMEOUT, self.ready_timeout)
+                return
+
+            msg = q.get_nowait(ready)
+
+            # credit is given when queue drains below stalled client's target
+            self.hub.credit_clients()
+
+            if msg.id in (NETSIO_DATA_BYTE, NETSIO_DATA_BLOCK, NETSIO_BUS_IDLE):
+                # send byte and send buffer makes POKEY busy and
+                # we have to receive confirmation when it is ready again
+                # prior sending more data
+                self.clear_rtr()
+
+            self.transmit(msg)
+            free_msg(msg)
+
+    def ready_timeout(self):
+        self.ready_timer = None
+        info_print("ATD TIMEOUT")
+        metric_event(METRIC_ATD_TIMEOUT)
+        clear_queue(self.host_queue)
+        self.set_rtr()
+
+
+class AtDevProtocol(asyncio.Protocol):
+    """Feeds data received from Altirra to AsyncAtDevHandler.serve() generator"""
+    def __init__(self, listener):
+        self.listener:AtDevListener = listener
+        self.transport:asyncio.Transport = None
+        self.handler:AsyncAtDevHandler = None
+        self.service = None
+        self.buffer = bytearray()
+        self.want = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.listener.protocol_connected(self)
+
+    def start(self):
+        self.handler = AsyncAtDevHandler(self.transport, self.listener)
+        self.handler.connected()
+        self.service = self.handler.serve()
+        self.resume(None)
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if self.handler is not None:
+            if exc is not None:
+                info_print("Host reset connection")
+            else:
+                print("Connection closed")
+            self.handler.disconnected()
+            self.service.close()
+            self.handler = None
+        self.listener.protocol_disconnected(self)
+
+    def data_received(self, data):
+        self.buffer += data
+        want = self.want
+        if want is not None and len(self.buffer) >= want:
+            self.want = None
+            self.resume(self.take(want))
+
+    def take(self, n):
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def resume(self, value):
+        """run service loop until it needs more data"""
+        sync = self.listener.hub.sync
+        while self.handler is not None:
+            try:
+                want = self.service.send(value)
+            except StopIteration:
+                self.transport.close()
+                return
+            if want is sync:
+                if sync.on_response(self.resume):
+                    return
+                # response is already available
+                value = sync.get_response(0, ATDEV_EMPTY_SYNC)
+            elif len(self.buffer) >= want:
+                value = self.take(want)
+            else:
+                self.want = want
+                return
+
+
+class AtDevListener:
+    """Emulator connections of one hub, handlers get hub and arguments from here"""
+    def __init__(self, loop:asyncio.AbstractEventLoop, hub, port, cmdline_args):
+        self.loop = loop
+        self.hub = hub
+        self.port = port
+        self.cmdline_args = cmdline_args
+        self.server:asyncio.AbstractServer = None
+        # serve one emulator at a time, as TCPServer does, others are waiting
+        self.active:AtDevProtocol = None
+        self.waiting = collections.deque()
+
+    def protocol_connected(self, protocol:AtDevProtocol):
+        protocol.transport.pause_reading()
+        self.waiting.append(protocol)
+        self.next_protocol()
+
+    def protocol_disconnected(self, protocol:AtDevProtocol):
+        if protocol is self.active:
+            self.active = None
+        else:
+            try:
+                self.waiting.remove(protocol)
+            except ValueError:
+                pass
+        self.next_protocol()
+
+    def next_protocol(self):
+        if self.active is None and self.waiting:
+            self.active = self.waiting.popleft()
+            self.active.start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        if self.active is not None:
+            self.active.transport.close()
+        for protocol in self.waiting:
+            protocol.transport.close()
+
+
+class AsyncAtDevManager(HostManager):
+    """Altirra custom device manager, runs the event loop"""
+    def __init__(self, loop:asyncio.AbstractEventLoop, cmdline_args):
+        super().__init__()
+        self.loop = loop
+        self.cmdline_args = cmdline_args
+        self.listeners = []
+
+    def run(self, hub):
+        self.run_all([hub])
+
+    def run_all(self, hubs):
+        self.hub = hubs[0]
+        deviceserver.print_banner()
+        for i, hub in enumerate(hubs):
+            listener = AtDevListener(self.loop, hub, self.cmdline_args.port + i, self.cmdline_args)
+            listener.server = self.loop.run_until_complete(
+                self.loop.create_server(lambda l=listener: AtDevProtocol(l), "localhost", listener.port))
+            self.listeners.append(listener)
+            print("Waiting for localhost connection from emulator on port {}{} -- Ctrl+Break to stop".format(
+                listener.port, hub.tag))
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.loop.is_closed():
+            return
+        for listener in self.listeners:
+            listener.close()
+        # let transports close, then close the loop
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+
+class AsyncNetSIOHub(NetSIOHub):
+    """HUB connecting NetSIO devices with Atari host, running on event loop"""
+
+    class LoopSyncRequest(NetSIOHub.SyncRequest):
+        """Synchronized request-response, response is delivered to callback"""
+        def __init__(self, loop:asyncio.AbstractEventLoop, timeout):
+            super().__init__()
+            self.loop = loop
+            self.timeout = timeout
+            self.callback = None
+            self.timer:asyncio.TimerHandle = None
+
+        def on_response(self, callback) -> bool:
+            """Call callback(response) once response arrives or on timeout,
+            return False if the response is already available"""
+            if self.completed.is_set():
+                return False
+            self.callback = callback
+            self.timer = self.loop.call_later(self.timeout, self.complete)
+            return True
+
+        def set_response(self, response, sn):
+            super().set_response(response, sn)
+            if self.callback is not None and self.completed.is_set():
+                self.complete()
+
+        def cancel(self, response=ATDEV_EMPTY_SYNC):
+            super().cancel(response)
+            if self.callback is not None and self.completed.is_set():
+                self.complete()
+
+        def complete(self):
+            callback = self.callback
+            self.callback = None
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if callback is not None:
+                callback(self.get_response(0, ATDEV_EMPTY_SYNC))
+
+    def __init__(self, loop:asyncio.AbstractEventLoop, device_manager:DeviceManager, host_manager:HostManager):
+        super().__init__(device_manager, host_manager)
+        self.loop = loop
+        self.host_queue = LoopQueue(MAX_CREDIT + 8)
+        self.sync = AsyncNetSIOHub.LoopSyncRequest(loop, device_manager.sync_tmout)
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+
+# SIO transaction analyzer
+#  SioAnalyzer rebuilds SIO transactions from hub trace points and times their phases, hub feeds it
+#  when enabled by enable_sio_analyzer() (netsio.py). This module also names devices and commands
+#  (same decode as debug_command_frame in netsio.atdevice), prints summary and writes CSV or JSON
+#  report. Running the module analyzes trace dump (hub --trace FILE) offline.
+
+from netsiohub.netsio import *
+from netsiohub.trace import read_trace_records
+
+import argparse
+import collections
+import csv
+import json
+import sys
+import threading
+import time
+
+
+SIO_PHASES = (
+    'command',  # COMMAND_ON .. COMMAND_OFF_SYNC, emulator sends command frame
+    'ack',      # COMMAND_OFF_SYNC .. ACK/NAK returned to emulator
+    'ack_net',  # sync request sent to device .. sync response received, network and device
+    'data',     # ACK .. DATA_BYTE_SYNC, emulator sends data frame
+    'checksum', # DATA_BYTE_SYNC .. ACK/NAK of data frame returned to emulator
+    'device',   # sync response .. first byte of complete and data from device
+    'delivery', # first byte from device .. first byte to emulator, host queue and credit
+    'pokey',    # first byte to emulator .. emulator ready after last byte
+    'total',    # COMMAND_ON .. end of transaction
+)
+
+# number of finished transactions kept for report
+SIO_HISTORY = 10000
+
+
+class SioTransaction:
+    """Timestamps (timer() seconds, 0 if not seen) and outcome of one SIO transaction"""
+    __slots__ = ['start', 'frame', 'device_id', 'command', 'aux', 'ack', 'data_ack', 'complete',
+        'data_in', 'data_out', 't_on', 't_off', 't_sync_out', 't_sync_in', 't_ack', 't_data',
+        't_checksum', 't_answer', 't_reply_in', 't_reply', 't_end']
+
+    def __init__(self, ts, start):
+        self.start = start # wall clock time
+        self.frame = bytearray()
+        self.device_id = None
+        self.command = None
+        self.aux = 0
+        self.ack = None # ACK/NAK byte, None if device did not respond
+        self.data_ack = None # ACK/NAK byte of data frame
+        self.complete = None # first byte from device after ACK, complete or error
+        self.data_in = 0 # data frame bytes from Atari
+        self.data_out = 0 # bytes from device to Atari
+        self.t_on = ts
+        self.t_off = 0
+        self.t_sync_out = 0
+        self.t_sync_in = 0
+        self.t_ack = 0
+        self.t_data = 0
+        self.t_checksum = 0
+        self.t_answer = 0 # last sync response, from device or to emulator
+        self.t_reply_in = 0
+        self.t_reply = 0
+        self.t_end = 0
+
+    def phases(self) -> dict:
+        """Phase durations in microseconds, phases which did not happen are left out"""
+        def span(a, b):
+            return int((b - a) * 1e6) if a and b else None
+        end = self.t_end or self.t_reply or self.t_checksum or self.t_ack or self.t_off
+        p = {
+            'command': span(self.t_on, self.t_off),
+            'ack': span(self.t_off, self.t_ack),
+            'ack_net': span(self.t_sync_out, self.t_sync_in),
+            'data': span(self.t_ack, self.t_data),
+            'checksum': span(self.t_data, self.t_checksum),
+            'device': span(self.t_answer, self.t_reply_in),
+            'delivery': span(self.t_reply_in, self.t_reply),
+            'pokey': span(self.t_reply, self.t_end),
+            'total': span(self.t_on, end),
+        }
+        return {k: max(0, v) for k, v in p.items() if v is not None}
+
+
+class SioCommandStats:
+    """Transaction counters and phase times of one device ID and command"""
+    __slots__ = ['count', 'naks', 'no_ack', 'errors', 'data_in', 'data_out', 'phases']
+
+    def __init__(self):
+        self.count = 0
+        self.naks = 0 # command or data frame not acknowledged
+        self.no_ack = 0 # no ACK/NAK from device
+        self.errors = 0 # device completed with error
+        self.data_in = 0
+        self.data_out = 0
+        self.phases = {} # phase -> [count, total, min, max] in microseconds
+
+    def add(self, tx:SioTransaction):
+        self.count += 1
+        if tx.ack is None:
+            self.no_ack += 1
+        elif tx.ack != SIO_ACK or tx.data_ack not in (None, SIO_ACK):
+            self.naks += 1
+        if tx.complete == SIO_ERROR:
+            self.errors += 1
+        self.data_in += tx.data_in
+        self.data_out += tx.data_out
+        for phase, us in tx.phases().items():
+            s = self.phases.get(phase)
+            if s is None:
+                self.phases[phase] = [1, us, us, us]
+            else:
+                s[0] += 1
+                s[1] += us
+                if us < s[2]:
+                    s[2] = us
+                if us > s[3]:
+                    s[3] = us
+
+    def stats(self) -> dict:
+        return {
+            'count': self.count,
+            'naks': self.naks,
+            'no_ack': self.no_ack,
+            'errors': self.errors,
+            'data_in': self.data_in,
+            'data_out': self.data_out,
+            'phases': {phase: {'count': s[0], 'avg_us': s[1] // s[0], 'min_us': s[2], 'max_us': s[3]}
+                for phase, s in ((p, self.phases[p]) for p in SIO_PHASES if p in self.phases)},
+        }
+
+
+class SioAnalyzer:
+    """Follows SIO transactions through hub trace points, aggregates per device ID and command
+
+    Atari side is seen at ATD points (or SER points with serial host), device side at NET
+    points. Transaction ends when next command frame starts, on reset or by finish()."""
+
+    # trace points by side
+    HOST_IN = (TRACE_ATD_IN, TRACE_ATD_CALL)
+    DEVICE_OUT = (TRACE_NET_OUT, TRACE_SER_OUT, TRACE_DISK_OUT)
+    DEVICE_IN = (TRACE_NET_IN, TRACE_SER_IN, TRACE_DISK_IN)
+
+    def __init__(self, history=SIO_HISTORY):
+        self.lock = threading.Lock()
+        self.current:SioTransaction = None
+        self.sync_pending = False
+        self.commands = {} # (device ID, command) -> SioCommandStats
+        self.history = collections.deque(maxlen=history)
+        self.bad_frames = 0
+        # called with every finished transaction, see analyzer.py
+        self.on_transaction = None
+
+    def event(self, ts, point, id, data, length, value):
+        """Feed trace point"""
+        with self.lock:
+            tx = self.current
+            # data block bytes are known when call returns, segment is read by then
+            if point in self.HOST_IN or (point == TRACE_ATD_RESPONSE and id == NETSIO_DATA_BLOCK):
+                if id == NETSIO_COMMAND_ON:
+                    self.finish_current()
+                    self.current = SioTransaction(ts, time.time())
+                    self.sync_pending = False
+                elif tx is None:
+                    pass
+                elif id == NETSIO_DATA_BYTE or (id == NETSIO_DATA_BLOCK and point == TRACE_ATD_RESPONSE):
+                    if not tx.t_off:
+                        tx.frame += data[:5 - len(tx.frame)]
+                    else:
+                        tx.data_in += length
+                elif id == NETSIO_COMMAND_OFF_SYNC:
+                    self.command_frame(tx, ts)
+                elif id == NETSIO_DATA_BYTE_SYNC and tx.t_ack:
+                    tx.t_data = ts
+                    tx.data_in += 1 # checksum
+                    self.sync_pending = True
+                elif id in (NETSIO_COLD_RESET, NETSIO_WARM_RESET):
+                    self.finish_current()
+            elif tx is None or not tx.t_off:
+                pass
+            elif point == TRACE_ATD_RESPONSE:
+                ack = (value >> 8) & 0xFF if value & 0xFF == NETSIO_SYNC_RESPONSE else None
+                if id == NETSIO_COMMAND_OFF_SYNC and not tx.t_ack:
+                    tx.t_ack = ts
+                    tx.ack = ack
+                elif id == NETSIO_DATA_BYTE_SYNC and tx.t_data and not tx.t_checksum:
+                    tx.t_checksum = ts
+                    tx.data_ack = ack
+                else:
+                    return
+                if self.sync_pending:
+                    tx.t_answer = ts
+                    self.sync_pending = False
+            elif point in self.DEVICE_OUT:
+                if id == NETSIO_COMMAND_OFF_SYNC and not tx.t_sync_out:
+                    tx.t_sync_out = ts
+            elif point in self.DEVICE_IN:
+                if id == NETSIO_SYNC_RESPONSE:
+                    if self.sync_pending:
+                        if not tx.t_ack:
+                            tx.t_sync_in = ts
+                        tx.t_answer = ts
+                        self.sync_pending = False
+                elif id in (NETSIO_DATA_BYTE, NETSIO_DATA_BLOCK) and not self.sync_pending and not tx.t_reply_in:
+                    tx.t_reply_in = ts
+                    tx.complete = data[0] if length else None
+            elif point == TRACE_ATD_OUT:
+                if id in (NETSIO_DATA_BYTE, NETSIO_DATA_BLOCK) and tx.t_reply_in:
+                    if not tx.t_reply:
+                        tx.t_reply = ts
+                    tx.data_out += length
+            elif point == TRACE_ATD_READY:
+                if tx.t_reply:
+                    tx.t_end = ts
+
+    def command_frame(self, tx:SioTransaction, ts):
+        """Command frame is complete, decode it"""
+        tx.t_off = ts
+        frame = tx.frame
+        if len(frame) != 5 or sio_checksum(frame[:4]) != frame[4]:
+            # not a transaction, e.g. frame at wrong speed
+            self.bad_frames += 1
+            self.current = None
+            return
+        tx.device_id = frame[0]
+        tx.command = frame[1]
+        tx.aux = frame[2] | frame[3] << 8
+        self.sync_pending = True
+
+    def finish_current(self):
+        """Close current transaction, called with lock held"""
+        tx = self.current
+        self.current = None
+        if tx is None or not tx.t_off:
+            return
+        key = (tx.device_id, tx.command)
+        stats = self.commands.get(key)
+        if stats is None:
+            stats = self.commands[key] = SioCommandStats()
+        stats.add(tx)
+        self.history.append(tx)
+        if self.on_transaction is not None:
+            self.on_transaction(tx)
+
+    def finish(self):
+        """Close transaction in progress, e.g. prior writing report"""
+        with self.lock:
+            self.finish_current()
+
+    def stats(self) -> dict:
+        """Statistics by (device ID, command)"""
+        with self.lock:
+            return {key: s.stats() for key, s in sorted(self.commands.items())}
+
+    def transactions(self) -> list:
+        with self.lock:
+            return list(self.history)
+
+
+DISK_COMMANDS = {
+    0x21: "FORMAT", 0x22: "FORMAT MEDIUM", 0x3F: "GET HSIO", 0x4E: "READ PERCOM", 0x4F: "WRITE PERCOM",
+    0x50: "PUT", 0x52: "READ", 0x53: "STATUS", 0x57: "WRITE",
+}
+
+FUJI_COMMANDS = {
+    0xFF: "RESET", 0xFE: "GET SSID", 0xFD: "SCAN NETWORKS", 0xFC: "GET SCAN", 0xFB: "SET SSID",
+    0xFA: "GET WIFI STATUS", 0xF9: "MOUNT HOST", 0xF8: "MOUNT IMAGE", 0xF7: "OPEN DIR", 0xF6: "READ DIR",
+    0xF5: "CLOSE DIR", 0xF4: "READ HOSTS", 0xF3: "WRITE HOSTS", 0xF2: "READ DEVICES", 0xF1: "WRITE DEVICES",
+    0xEA: "GET WIFI ENABLED", 0xE9: "UNMOUNT IMAGE", 0xE8: "GET CONFIG", 0xE7: "CREATE IMAGE",
+    0xE6: "UNMOUNT HOST", 0xE5: "TELL DIR", 0xE4: "SEEK DIR", 0xE3: "SET HSIO", 0xE2: "SET DEVICE SLOT",
+    0xE1: "SET PREFIX", 0xE0: "GET PREFIX", 0xDF: "SET EXT CLOCK", 0xDE: "WRITE APPKEY", 0xDD: "READ APPKEY",
+    0xDC: "OPEN APPKEY", 0xDB: "CLOSE APPKEY", 0xDA: "GET PATH", 0xD9: "CONFIG BOOT", 0xD8: "COPY FILE",
+    0xD7: "MOUNT ALL", 0xD6: "SET BOOT MODE", 0xD0: "BASE64 ENCODE INPUT", 0xCF: "BASE64 ENCODE COMPUTE",
+    0xCE: "BASE64 ENCODE LENGTH", 0xCD: "BASE64 ENCODE OUTPUT", 0xCC: "BASE64 DECODE INPUT",
+    0xCB: "BASE64 DECODE COMPUTE", 0xCA: "BASE64 DECODE LENGTH", 0xC9: "BASE64 DECODE OUTPUT",
+    0xC8: "HASH INPUT", 0xC7: "HASH COMPUTE", 0xC6: "HASH LENGTH", 0xC5: "HASH OUTPUT",
+    0x53: "STATUS", 0x3F: "GET HSIO",
+}
+
+NETWORK_COMMANDS = {
+    0x52: "READ", 0x53: "STATUS", 0x57: "WRITE", 0x4F: "OPEN", 0x4D: "MODE", 0x43: "CLOSE",
+    0x50: "PARSE JSON", 0x51: "QUERY JSON", 0x20: "RENAME", 0x21: "DELETE", 0x23: "LOCK", 0x24: "UNLOCK",
+    0x2A: "MKDIR", 0x2B: "RMDIR", 0x2C: "CHDIR", 0x30: "PWD", 0xFC: "SET CHANNEL MODE",
+    0xFD: "SET LOGIN", 0xFE: "SET PASSWORD",
+}
+
+MODEM_COMMANDS = {
+    0x52: "READ", 0x53: "STATUS", 0x57: "WRITE", 0x58: "STREAM", 0x21: "GET RELOC", 0x26: "GET HANDLER",
+    0x3F: "POLL T1", 0x40: "POLL T3", 0x41: "CONTROL", 0x42: "CONFIGURE", 0x44: "SET DUMP",
+    0x4C: "LISTEN", 0x4D: "UNLISTEN", 0x4E: "BAUDLOCK", 0x4F: "AUTOANSWER",
+}
+
+PRINTER_COMMANDS = {0x50: "PUT", 0x53: "STATUS", 0x57: "WRITE"}
+APETIME_COMMANDS = {0x93: "GET TIME"}
+PCLINK_COMMANDS = {0x50: "PARBLK", 0x52: "EXEC", 0x53: "STATUS"}
+
+
+def device_name(device_id) -> str:
+    """SIO device name, e.g. D1, FujiNet, N1"""
+    if 0x31 <= device_id <= 0x3F:
+        return "D{}".format(device_id - 0x30)
+    if 0x40 <= device_id <= 0x43:
+        return "P{}".format(device_id - 0x3F)
+    if device_id == 0x45:
+        return "APETime"
+    if device_id == 0x4F:
+        return "Poll"
+    if 0x50 <= device_id <= 0x53:
+        return "R{}".format(device_id - 0x4F)
+    if device_id == 0x6F:
+        return "PCLink"
+    if device_id == 0x70:
+        return "FujiNet"
+    if 0x71 <= device_id <= 0x78:
+        return "N{}".format(device_id - 0x70)
+    return "0x{:02X}".format(device_id)
+
+
+def command_name(device_id, command) -> str:
+    """SIO device and command, e.g. D1: READ, FujiNet: STATUS"""
+    if 0x31 <= device_id <= 0x3F:
+        commands = DISK_COMMANDS
+    elif device_id == 0x70:
+        commands = FUJI_COMMANDS
+    elif 0x71 <= device_id <= 0x78:
+        commands = NETWORK_COMMANDS
+    elif 0x50 <= device_id <= 0x53:
+        commands = MODEM_COMMANDS
+    elif 0x40 <= device_id <= 0x43:
+        commands = PRINTER_COMMANDS
+    elif device_id == 0x45:
+        commands = APETIME_COMMANDS
+    elif device_id == 0x6F:
+        commands = PCLINK_COMMANDS
+    else:
+        commands = {}
+    return "{}: {}".format(device_name(device_id), commands.get(command, "CMD 0x{:02X}".format(command)))
+
+
+def sio_byte(b) -> str:
+    """ACK/NAK/complete byte as character"""
+    if b is None:
+        return ""
+    return chr(b) if 0x20 < b < 0x7F else "0x{:02X}".format(b)
+
+
+# CSV report columns
+REPORT_FIELDS = ['time', 'name', 'device_id', 'command', 'aux', 'ack', 'data_ack', 'complete',
+    'data_in', 'data_out'] + [phase + '_us' for phase in SIO_PHASES]
+
+
+def transaction_row(tx:SioTransaction) -> dict:
+    """Flat transaction record for report"""
+    row = {
+        'time': datetime.fromtimestamp(tx.start).strftime("%H:%M:%S.%f"),
+        'name': command_name(tx.device_id, tx.command),
+        'device_id': "0x{:02X}".format(tx.device_id),
+        'command': "0x{:02X}".format(tx.command),
+        'aux': tx.aux,
+        'ack': sio_byte(tx.ack),
+        'data_ack': sio_byte(tx.data_ack),
+        'complete': sio_byte(tx.complete),
+        'data_in': tx.data_in,
+        'data_out': tx.data_out,
+    }
+    phases = tx.phases()
+    for phase in SIO_PHASES:
+        row[phase + '_us'] = phases.get(phase, '')
+    return row
+
+
+def transaction_str(tx:SioTransaction) -> str:
+    """One line transaction summary"""
+    s = "SIO {} aux {} ack {}".format(command_name(tx.device_id, tx.command), tx.aux, sio_byte(tx.ack) or "-")
+    if tx.complete is not None:
+        s += " complete {} [{}]".format(sio_byte(tx.complete), tx.data_out)
+    return s + " " + " ".join("{} {}".format(k, v) for k, v in tx.phases().items())
+
+
+def summary_lines(analyzer:SioAnalyzer) -> list:
+    """Table with average phase times per device ID and command"""
+    stats = analyzer.stats()
+    lines = ["{:<28} {:>6} {:>4} {:>4} {:>4}".format("SIO command", "count", "nak", "none", "err")
+        + "".join(" {:>9}".format(p) for p in SIO_PHASES)]
+    for (device_id, command), s in stats.items():
+        line = "{:<28} {:>6} {:>4} {:>4} {:>4}".format(command_name(device_id, command)[:28],
+            s['count'], s['naks'], s['no_ack'], s['errors'])
+        for phase in SIO_PHASES:
+            p = s['phases'].get(phase)
+            line += " {:>9}".format(p['avg_us'] if p else "-")
+        lines.append(line)
+    if analyzer.bad_frames:
+        lines.append("bad command frames: {}".format(analyzer.bad_frames))
+    return lines
+
+
+def print_summary(analyzer:SioAnalyzer):
+    info_print("SIO transactions, average phase time in microseconds:")
+    for line in summary_lines(analyzer):
+        print(line)
+
+
+def write_report(analyzer:SioAnalyzer, path):
+    """Write transactions into CSV file, or summary and transactions into JSON file (.json)"""
+    analyzer.finish()
+    rows = [transaction_row(tx) for tx in analyzer.transactions()]
+    with open(path, 'w', newline='') as f:
+        if path.lower().endswith('.json'):
+            json.dump({
+                'phases': SIO_PHASES,
+                'bad_frames': analyzer.bad_frames,
+                'summary': [dict(name=command_name(device_id, command), device_id=device_id, command=command, **s)
+                    for (device_id, command), s in analyzer.stats().items()],
+                'transactions': rows,
+            }, f, indent=1)
+        else:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    info_print("SIO report written to", path)
+
+
+class SummaryThread(threading.Thread):
+    """Prints SIO summary periodically"""
+
+    def __init__(self, analyzer:SioAnalyzer, interval):
+        self.analyzer = analyzer
+        self.interval = interval
+        self.stopped = threading.Event()
+        super().__init__(daemon=True)
+
+    def run(self):
+        count = 0
+        while not self.stopped.wait(self.interval):
+            stats = self.analyzer.stats()
+            total = sum(s['count'] for s in stats.values())
+            if total != count:
+                # something new
+                count = total
+                print_summary(self.analyzer)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def analyze_trace(path, analyzer:SioAnalyzer):
+    """Feed trace dump records into analyzer"""
+    start, start_time, records = read_trace_records(path)
+    for ts, point, id, length, port, aux, value, data in records:
+        analyzer.event(ts, point, id, data[:length], length, value)
+    analyzer.finish()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Time SIO transactions recorded in NetSIO HUB trace dump.")
+    arg_parser.add_argument('file', help='Trace file written by hub --trace FILE')
+    arg_parser.add_argument('-r', '--report', metavar='FILE',
+        help='Write transactions into CSV file, or summary and transactions into JSON file (.json)')
+    arg_parser.add_argument('-t', '--transactions', action='store_true',
+        help='Print every transaction')
+    args = arg_parser.parse_args()
+
+    analyzer = SioAnalyzer()
+    if args.transactions:
+        analyzer.on_transaction = lambda tx: print(transaction_str(tx))
+    try:
+        analyze_trace(args.file, analyzer)
+    except (OSError, ValueError, struct.error) as e:
+        print(e, file=sys.stderr)
+        return -1
+
+    for line in summary_lines(analyzer):
+        print(line)
+    if args.report:
+        write_report(analyzer, args.report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,675 @@
+#!/usr/bin/env python3
+
+# NetSIO hub benchmark
+#  Starts the hub for every selected engine and measures message latency with a fake Altirra
+#  (custom device TCP client) on one side and a fake NetSIO device (UDP) on the other side.
+#  SIO workloads run complete disk transactions (command frame, ACK sync, sector data) against
+#  a fake disk drive on the NetSIO device and report sectors per second and hub CPU time per sector.
+#  With --disk the SIO workloads run against disk drives emulated by the hub itself, local baseline
+#  without network round trip.
+
+from netsiohub.netsio import *
+
+import socket
+import subprocess
+import multiprocessing
+import threading
+import queue
+import statistics
+import struct
+import sys
+import os
+import time
+import tempfile
+import argparse
+
+
+def sio_frame(device_id, command, aux) -> bytes:
+    """SIO command frame with checksum"""
+    frame = bytes((device_id, command, aux & 0xFF, (aux >> 8) & 0xFF))
+    return frame + bytes((sio_checksum(frame),))
+
+
+class FakeAltirra:
+    """Stand-in for netsio.atdevice, talks Altirra custom device protocol to the hub"""
+
+    SEGMENTS = (("txbuffer", 512), ("rxbuffer", 512), ("textbuffer", 256))
+
+    def __init__(self, port=NETSIO_ATDEV_PORT, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.sock = socket.create_connection(("localhost", port))
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile('rb')
+        self.segments = [bytearray(size) for _, size in self.SEGMENTS]
+        self.send_lock = threading.Lock()
+        self.results = queue.Queue()
+        self.timestamp = 0
+        self.sync_timeouts = 0
+        # called with (event, data) when hub delivers something to emulated Atari
+        self.on_receive = None
+        self.auto_ready = True
+        # pack short blocks into call parameters, as netsio.atdevice v0.17+ does
+        self.compact = True
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def send_command(self, command, param1, param2):
+        with self.send_lock:
+            self.timestamp += 1000
+            self.sock.sendall(struct.pack('<BIiQ', command, param1, param2, self.timestamp))
+
+    def post(self, event, arg=0):
+        """$network.post_message(event, arg)"""
+        self.send_command(8, event, arg)
+
+    def call(self, event, arg=0, timeout=5.0):
+        """$network.send_message(event, arg), emulation is paused until the hub responds"""
+        self.send_command(7, event, arg)
+        return self.results.get(timeout=timeout)
+
+    def send_block(self, data, timeout=5.0):
+        """buffer_to_server(), place data into rxbuffer and notify the hub"""
+        if self.compact and 0 < len(data) <= COMPACT_SIZE:
+            aux1, aux2 = compact_pack(NETSIO_DATA_BLOCK, data)
+            return self.call(aux1, aux2 - (1 << 32) if aux2 & 0x80000000 else aux2, timeout)
+        self.segments[1][0:len(data)] = data
+        return self.call(NETSIO_DATA_BLOCK, len(data), timeout)
+
+    def sync_result(self, result):
+        """Check result of sync request, return None if device did not respond in time"""
+        if result & 0xFF != NETSIO_SYNC_RESPONSE:
+            self.sync_timeouts += 1
+            return None
+        # ACK/NAK byte "sent" to POKEY, ready for more
+        self.post(ATDEV_READY)
+        return result
+
+    def sio_command(self, frame):
+        """Atari sends SIO command frame, returns sync result with ACK/NAK byte and write size"""
+        self.post(NETSIO_COMMAND_ON)
+        self.send_block(frame)
+        return self.sync_result(self.call(NETSIO_COMMAND_OFF_SYNC))
+
+    def sio_data_frame(self, data):
+        """Atari sends SIO data frame, returns sync result with ACK/NAK byte"""
+        # netsio.atdevice flushes rxbuffer every 65 bytes, checksum byte goes with sync request
+        for i in range(0, len(data), 65):
+            self.send_block(data[i:i+65])
+        return self.sync_result(self.call(NETSIO_DATA_BYTE_SYNC, sio_checksum(data)))
+
+    def read_loop(self):
+        read = self.rfile.read
+        try:
+            while True:
+                b = read(1)
+                if not b:
+                    break
+                cmd = b[0]
+                if cmd == 1:
+                    # return value of script event
+                    self.results.put(struct.unpack('<i', read(4))[0])
+                elif cmd in (2, 5):
+                    read(2)
+                elif cmd == 3:
+                    read(5)
+                elif cmd == 4:
+                    read(6)
+                elif cmd == 6:
+                    seg, offset, length = struct.unpack('<BII', read(9))
+                    with self.send_lock:
+                        self.sock.sendall(self.segments[seg][offset:offset+length])
+                elif cmd == 7:
+                    seg, offset, length = struct.unpack('<BII', read(9))
+                    self.segments[seg][offset:offset+length] = read(length)
+                elif cmd == 8:
+                    dst, dst_offset, src, src_offset, length = struct.unpack('<BIBII', read(14))
+                    self.segments[dst][dst_offset:dst_offset+length] = \
+                        self.segments[src][src_offset:src_offset+length]
+                elif cmd == 9:
+                    self.interrupt(*struct.unpack('<II', read(8)))
+                elif cmd == 10:
+                    self.send_names([name for name, _ in self.SEGMENTS])
+                elif cmd == 11:
+                    self.send_names([])
+                elif cmd == 12:
+                    read(1)
+                elif cmd == 13:
+                    seg, offset, val, length = struct.unpack('<BIBI', read(10))
+                    self.segments[seg][offset:offset+length] = bytes((val,)) * length
+                else:
+                    print("FakeAltirra: unknown request {:02X}".format(cmd))
+                    break
+        except (OSError, ValueError):
+            pass
+
+    def send_names(self, names):
+        data = struct.pack('<I', len(names))
+        for name in names:
+            data += struct.pack('<I', len(name)) + name.encode('utf-8')
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def interrupt(self, aux1, aux2):
+        """network_interrupt event handler of netsio.atdevice"""
+        evt = aux1 & 0x1FF
+        data = None
+        if evt == NETSIO_DATA_BYTE:
+            data = bytes((aux2 & 0xFF,))
+        elif evt == ATDEV_TRANSMIT_BUFFER:
+            if compact_size(aux1):
+                data = compact_unpack(aux1, aux2)
+            else:
+                data = bytes(self.segments[0][:aux2])
+        if self.on_receive is not None:
+            self.on_receive(evt, data)
+        if self.auto_ready and evt in (NETSIO_DATA_BYTE, ATDEV_TRANSMIT_BUFFER, NETSIO_BUS_IDLE):
+            # bytes "sent" to POKEY, ready for more
+            self.post(ATDEV_READY)
+
+
+class FakeDevice:
+    """Stand-in for NetSIO device (FujiNet), talks NetSIO over UDP to the hub"""
+
+    def __init__(self, port=NETSIO_PORT, host="localhost", batch=False):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((host, port))
+        self.credit = 0
+        # ask hub for batch framing on connect
+        self.batch = batch
+        # features confirmed by hub
+        self.features = 0
+        self.connected = threading.Event()
+        # called with (id, arg) for every message from the hub
+        self.on_message = None
+        # called with (id, arg) for sync requests, returns (ack_type, ack_byte, write_size)
+        self.on_sync = None
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def close(self):
+        try:
+            self.send(NETSIO_DEVICE_DISCONNECT)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def connect(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not self.connected.is_set():
+            if time.monotonic() > deadline:
+                raise TimeoutError("no credit from hub")
+            if self.batch:
+                self.send(NETSIO_DEVICE_CONNECT, (NETSIO_FEATURE_BATCH,))
+            else:
+                self.send(NETSIO_DEVICE_CONNECT)
+            self.connected.wait(0.2)
+
+    def send(self, id, arg=b''):
+        self.sock.send(bytes((id,)) + bytes(arg))
+
+    def send_many(self, messages):
+        """send list of (id, arg), in one datagram if hub agreed on batch framing"""
+        if not self.features & NETSIO_FEATURE_BATCH:
+            for id, arg in messages:
+                self.send(id, arg)
+            return
+        for datagram in batch_pack([bytes((id,)) + bytes(arg) for id, arg in messages]):
+            self.sock.send(datagram)
+
+    def read_loop(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                break
+            if not data:
+                continue
+            for packet in batch_unpack(data) if data[0] == NETSIO_BATCH else (data,):
+                self.handle(packet[0], packet[1:])
+
+    def handle(self, id, arg):
+        if id == NETSIO_DEVICE_CONNECT:
+            self.features = arg[0] if len(arg) else 0
+            return
+        if id == NETSIO_CREDIT_UPDATE:
+            self.credit = arg[0]
+            self.connected.set()
+            return
+        if id in (NETSIO_COMMAND_OFF_SYNC, NETSIO_DATA_BYTE_SYNC):
+            self.sync_response(id, arg)
+        if self.on_message is not None:
+            self.on_message(id, arg)
+
+    def sync_response(self, id, arg):
+        sync_num = arg[-1]
+        ack_type, ack_byte, write_size = \
+            (NETSIO_EMPTY_SYNC, 0, 0) if self.on_sync is None else self.on_sync(id, arg)
+        self.send(NETSIO_SYNC_RESPONSE, struct.pack('<BBBH', sync_num, ack_type, ack_byte, write_size))
+
+
+class SioReceiver:
+    """Collects bytes delivered by the hub to emulated Atari"""
+    def __init__(self, atdev:FakeAltirra):
+        self.data = bytearray()
+        self.cond = threading.Condition()
+        atdev.on_receive = self.on_receive
+
+    def on_receive(self, evt, data):
+        if data:
+            with self.cond:
+                self.data.extend(data)
+                self.cond.notify()
+
+    def wait(self, size, timeout=1.0):
+        """Wait for size bytes, return them or None on timeout"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.data) >= size, timeout):
+                self.data.clear()
+                return None
+            data = bytes(self.data[:size])
+            del self.data[:size]
+        return data
+
+
+class FakeDisk:
+    """SIO disk drive served by fake NetSIO device, handles sector read and write commands"""
+    def __init__(self, device:FakeDevice, sector_size=128, burst=False):
+        self.device = device
+        self.sector_size = sector_size
+        # send complete byte together with data frame
+        self.burst = burst
+        self.sector = bytes([i & 0xFF for i in range(sector_size)])
+        self.command = False
+        self.frame = bytearray()
+        self.data = bytearray()
+        device.on_message = self.on_message
+        device.on_sync = self.on_sync
+
+    def on_sync(self, id, arg):
+        if id == NETSIO_COMMAND_OFF_SYNC:
+            self.command = False
+            if len(self.frame) != 5 or sio_checksum(self.frame[:4]) != self.frame[4]:
+                return (NETSIO_ACK_SYNC, SIO_NAK, 0)
+            if self.frame[1] in (SIO_WRITE, SIO_PUT):
+                # expect data frame with checksum
+                self.data.clear()
+                return (NETSIO_ACK_SYNC, SIO_ACK, self.sector_size + 1)
+            return (NETSIO_ACK_SYNC, SIO_ACK, 0)
+        # data frame checksum
+        return (NETSIO_ACK_SYNC, SIO_ACK if sio_checksum(self.data) == arg[0] else SIO_NAK, 0)
+
+    def on_message(self, id, arg):
+        if id == NETSIO_COMMAND_ON:
+            self.command = True
+            self.frame.clear()
+        elif id in (NETSIO_DATA_BYTE, NETSIO_DATA_BLOCK):
+            (self.frame if self.command else self.data).extend(arg)
+        elif id == NETSIO_COMMAND_OFF_SYNC:
+            if len(self.frame) == 5 and self.frame[1] == SIO_READ:
+                data_frame = self.sector + bytes((sio_checksum(self.sector),))
+                if self.burst:
+                    self.device.send(NETSIO_DATA_BLOCK, bytes((SIO_COMPLETE,)) + data_frame)
+                else:
+                    self.device.send_many(((NETSIO_DATA_BYTE, (SIO_COMPLETE,)), (NETSIO_DATA_BLOCK, data_frame)))
+        elif id == NETSIO_DATA_BYTE_SYNC:
+            self.device.send(NETSIO_DATA_BYTE, (SIO_COMPLETE,))
+
+
+class HubProcess:
+    """Hub running in child process"""
+    def __init__(self, engine, port, netsio_port, extra_args=()):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "netsiohub", "--engine", engine,
+                "--port", str(port), "--netsio-port", str(netsio_port), *extra_args],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def cpu_time(self):
+        """CPU time (user + system) used by hub process, None if not available"""
+        try:
+            with open("/proc/{}/stat".format(self.proc.pid)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+def generate_load(port, rate, stop):
+    """Background traffic from another peer, ping requests at given rate (messages per second)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(("localhost", port))
+    sock.setblocking(False)
+    ping = bytes((NETSIO_PING_REQUEST,))
+    period = 1.0 / rate
+    t = time.perf_counter()
+    while not stop.is_set():
+        try:
+            sock.send(ping)
+            while True:
+                sock.recv(16)
+        except (BlockingIOError, ConnectionRefusedError):
+            pass
+        t += period
+        delay = t - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    sock.close()
+
+
+def bench_relay(atdev:FakeAltirra, device:FakeDevice, count):
+    """device -> hub -> emulator -> hub -> device round trip, 4 bytes data block and 1 byte back"""
+    echo = threading.Event()
+    atdev.on_receive = lambda evt, data: \
+        atdev.post(NETSIO_DATA_BYTE, data[0]) if evt == ATDEV_TRANSMIT_BUFFER else None
+    device.on_message = lambda id, arg: echo.set() if id == NETSIO_DATA_BYTE else None
+    samples = []
+    for i in range(count):
+        echo.clear()
+        t = time.perf_counter()
+        device.send(NETSIO_DATA_BLOCK, struct.pack('<I', i))
+        if not echo.wait(1.0):
+            continue
+        samples.append((time.perf_counter() - t) * 1e6)
+    return samples
+
+
+def bench_stream(atdev:FakeAltirra, device:FakeDevice, count, window=DEFAULT_CREDIT):
+    """like relay, but keep several messages in flight"""
+    sent = {}
+    samples = []
+    slots = threading.Semaphore(window)
+    done = threading.Event()
+
+    def on_echo(id, arg):
+        if id != NETSIO_DATA_BYTE:
+            return
+        t = sent.pop(arg[0], None)
+        if t is not None:
+            samples.append((time.perf_counter() - t) * 1e6)
+            slots.release()
+            if len(samples) >= count:
+                done.set()
+
+    atdev.on_receive = lambda evt, data: \
+        atdev.post(NETSIO_DATA_BYTE, data[0]) if evt == ATDEV_TRANSMIT_BUFFER else None
+    device.on_message = on_echo
+    for i in range(count):
+        if not slots.acquire(timeout=1.0):
+            # message lost, give up on the oldest one
+            sent.clear()
+            slots = threading.Semaphore(window - 1)
+        sent[i & 0xFF] = time.perf_counter()
+        device.send(NETSIO_DATA_BLOCK, struct.pack('<I', i))
+    done.wait(1.0)
+    return samples
+
+
+def bench_bytes(atdev:FakeAltirra, device:FakeDevice, count, burst=128):
+    """device sends burst of single data bytes, hub buffers them, time until emulator got all bytes"""
+    received = [0]
+    done = threading.Event()
+
+    def on_receive(evt, data):
+        if evt in (NETSIO_DATA_BYTE, ATDEV_TRANSMIT_BUFFER):
+            received[0] += len(data)
+            if received[0] >= burst:
+                done.set()
+
+    atdev.on_receive = on_receive
+    device.on_message = None
+    samples = []
+    for i in range(max(1, count // burst)):
+        received[0] = 0
+        done.clear()
+        t = time.perf_counter()
+        for b in range(burst):
+            device.send(NETSIO_DATA_BYTE, (b,))
+        if not done.wait(1.0):
+            continue
+        samples.append((time.perf_counter() - t) * 1e6)
+    return samples
+
+
+def bench_sync(atdev:FakeAltirra, device:FakeDevice, count):
+    """emulator sync request -> hub -> device -> hub -> emulator, COMMAND OFF + ACK"""
+    atdev.on_receive = None
+    device.on_message = None
+    device.on_sync = lambda id, arg: (NETSIO_ACK_SYNC, ord('A'), 0)
+    samples = []
+    for i in range(count):
+        t = time.perf_counter()
+        if atdev.sync_result(atdev.call(NETSIO_COMMAND_OFF_SYNC)) is not None:
+            samples.append((time.perf_counter() - t) * 1e6)
+    return samples
+
+
+def bench_sio_read(atdev:FakeAltirra, device:FakeDevice, count, sector_size=128, burst=False):
+    """SIO sector read: command frame, ACK sync, then complete byte, sector and checksum to Atari"""
+    if device is not None:
+        FakeDisk(device, sector_size, burst)
+    rx = SioReceiver(atdev)
+    # double density sectors are read from D2, hub built-in drives have one density each,
+    # sectors from 4 up, boot sectors are 128 bytes
+    device_id = SIO_DISK1 if sector_size == 128 else SIO_DISK1 + 1
+    samples = []
+    for i in range(count):
+        t = time.perf_counter()
+        result = atdev.sio_command(sio_frame(device_id, SIO_READ, 4 + i % 716))
+        if result is None or (result >> 8) & 0xFF != SIO_ACK:
+            continue
+        data = rx.wait(sector_size + 2)
+        if data is None or data[0] != SIO_COMPLETE:
+            continue
+        samples.append((time.perf_counter() - t) * 1e6)
+    return samples
+
+
+def bench_sio_read256(atdev:FakeAltirra, device:FakeDevice, count):
+    """SIO double density sector read"""
+    return bench_sio_read(atdev, device, count, 256)
+
+
+def bench_sio_write(atdev:FakeAltirra, device:FakeDevice, count, sector_size=128):
+    """SIO sector write: command frame, ACK sync, data frame, ACK sync, then complete byte to Atari"""
+    if device is not None:
+        FakeDisk(device, sector_size)
+    rx = SioReceiver(atdev)
+    data = bytes([(i * 7) & 0xFF for i in range(sector_size)])
+    samples = []
+    for i in range(count):
+        t = time.perf_counter()
+        result = atdev.sio_command(sio_frame(SIO_DISK1, SIO_PUT, 1 + i % 720))
+        if result is None or (result >> 8) & 0xFF != SIO_ACK:
+            continue
+        result = atdev.sio_data_frame(data)
+        if result is None or (result >> 8) & 0xFF != SIO_ACK:
+            continue
+        if rx.wait(1) != bytes((SIO_COMPLETE,)):
+            continue
+        samples.append((time.perf_counter() - t) * 1e6)
+    return samples
+
+
+def bench_hsio(atdev:FakeAltirra, device:FakeDevice, count):
+    """back-to-back sector reads after switching to high speed, device sends complete byte and data in one block"""
+    atdev.post(NETSIO_SPEED_CHANGE, 125984) # POKEY divisor 0
+    try:
+        return bench_sio_read(atdev, device, count, 128, burst=True)
+    finally:
+        atdev.post(NETSIO_SPEED_CHANGE, 19200)
+
+
+WORKLOADS = {
+    "relay": bench_relay,
+    "stream": bench_stream,
+    "bytes": bench_bytes,
+    "sync": bench_sync,
+    "read": bench_sio_read,
+    "read256": bench_sio_read256,
+    "write": bench_sio_write,
+    "hsio": bench_hsio,
+}
+
+# workloads served by disk drive, see --disk
+SIO_WORKLOADS = ("read", "read256", "write", "hsio")
+
+
+class WorkloadResult:
+    def __init__(self, samples, elapsed, cpu, timeouts):
+        self.samples = samples      # latency of every completed operation, in microseconds
+        self.elapsed = elapsed      # wall time, in seconds
+        self.cpu = cpu              # hub CPU time, in seconds, None if unknown
+        self.timeouts = timeouts    # sync requests without device response
+
+    def rate(self):
+        return len(self.samples) / self.elapsed if self.elapsed else 0.0
+
+    def cpu_per_op(self):
+        if self.cpu is None or not self.samples:
+            return None
+        return self.cpu / len(self.samples) * 1e6
+
+
+def percentile(samples, p):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(len(s) * p / 100))]
+
+
+def write_atr(path, sector_size, sectors=720):
+    """Blank ATR image, boot sectors are 128 bytes"""
+    size = 3 * 128 + (sectors - 3) * sector_size if sector_size > 128 else sectors * 128
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<HHHB9x', 0x0296, (size // 16) & 0xFFFF, sector_size, size // 16 >> 16))
+        f.write(bytes(size))
+
+
+def run_engine(engine, args):
+    extra_args = []
+    if args.disk:
+        # hub built-in drives, D1 single density, D2 double density
+        for unit, sector_size in ((1, 128), (2, 256)):
+            path = os.path.join(args.disk, "d{}.atr".format(unit))
+            write_atr(path, sector_size)
+            extra_args += ["--disk", "D{}={}".format(unit, path)]
+    hub = HubProcess(engine, args.port, args.netsio_port, extra_args)
+    atdev = device = load = None
+    stop_load = multiprocessing.Event()
+    results = {}
+    try:
+        atdev = FakeAltirra(args.port)
+        if not args.disk:
+            device = FakeDevice(args.netsio_port, batch=args.batch)
+            device.connect()
+        if args.load:
+            load = multiprocessing.Process(target=generate_load, args=(args.netsio_port, args.load, stop_load))
+            load.start()
+        for name in args.workloads:
+            WORKLOADS[name](atdev, device, args.warmup)
+            cpu = hub.cpu_time()
+            timeouts = atdev.sync_timeouts
+            t = time.perf_counter()
+            samples = WORKLOADS[name](atdev, device, args.count)
+            elapsed = time.perf_counter() - t
+            if cpu is not None:
+                cpu = hub.cpu_time() - cpu
+            results[name] = WorkloadResult(samples, elapsed, cpu, atdev.sync_timeouts - timeouts)
+    finally:
+        if load is not None:
+            stop_load.set()
+            load.join()
+        if device is not None:
+            device.close()
+        if atdev is not None:
+            atdev.close()
+        hub.stop()
+    return results
+
+
+def print_report(report):
+    print("{:<8} {:<8} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>5}".format(
+        "workload", "engine", "n", "mean", "stdev", "p50", "p90", "p99", "max", "ops/s", "cpu/op", "tmo"))
+    for name, engines in report.items():
+        for engine, result in engines.items():
+            samples = result.samples
+            if not samples:
+                print("{:<8} {:<8} {:>6} {:>71} {:>5}".format(name, engine, 0, "", result.timeouts))
+                continue
+            cpu = result.cpu_per_op()
+            print("{:<8} {:<8} {:>6} {:>8.0f} {:>8.0f} {:>8.0f} {:>8.0f} {:>8.0f} {:>8.0f} {:>8.0f} {:>8} {:>5}".format(
+                name, engine, len(samples),
+                statistics.mean(samples), statistics.pstdev(samples),
+                percentile(samples, 50), percentile(samples, 90), percentile(samples, 99), max(samples),
+                result.rate(), "-" if cpu is None else "{:.0f}".format(cpu), result.timeouts))
+    print("(latency and hub cpu/op in microseconds, op is message or SIO transaction i.e. sector, "
+          "tmo is sync requests without device response)")
+
+
+def get_arg_parser():
+    arg_parser = argparse.ArgumentParser(description =
+            "Measures NetSIO hub latency with fake Altirra custom device and fake NetSIO device.")
+    arg_parser.add_argument('--engine', dest='engines', action='append', choices=['thread','asyncio'],
+        help='Engine to benchmark, can be repeated (default all)')
+    arg_parser.add_argument('--workload', dest='workloads', action='append', choices=list(WORKLOADS),
+        help='Workload to run, can be repeated (default all)')
+    arg_parser.add_argument('-n', '--count', type=int, default=2000, help='Messages per workload (default 2000)')
+    arg_parser.add_argument('--warmup', type=int, default=100, help='Warm-up messages per workload (default 100)')
+    arg_parser.add_argument('--load', type=int, default=0,
+        help='Background traffic, ping requests per second from another peer (default 0, no load)')
+    arg_parser.add_argument('--batch', action='store_true',
+        help='Fake device negotiates batch framing (several messages in one datagram)')
+    arg_parser.add_argument('--disk', action='store_true',
+        help='Run SIO workloads against disk drives emulated by the hub, local baseline without '
+             'NetSIO device (thread engine only)')
+    arg_parser.add_argument('--port', type=int, default=NETSIO_ATDEV_PORT + 10000,
+        help='TCP port for hub under test (default {})'.format(NETSIO_ATDEV_PORT + 10000))
+    arg_parser.add_argument('--netsio-port', type=int, default=NETSIO_PORT + 10000,
+        help='UDP port for hub under test (default {})'.format(NETSIO_PORT + 10000))
+    return arg_parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    if args.disk:
+        args.engines = args.engines or ['thread']
+        args.workloads = args.workloads or list(SIO_WORKLOADS)
+        if 'asyncio' in args.engines or not set(args.workloads) <= set(SIO_WORKLOADS):
+            print("Hub disk drives run {} workloads with thread engine only.".format(", ".join(SIO_WORKLOADS)))
+            return -1
+    args.engines = args.engines or ['thread', 'asyncio']
+    args.workloads = args.workloads or list(WORKLOADS)
+
+    report = {name: {} for name in args.workloads}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.disk = tmpdir if args.disk else None
+        for engine in args.engines:
+            print("Benchmarking {} engine ...".format(engine))
+            for name, result in run_engine(engine, args).items():
+                report[name][engine] = result
+    print_report(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
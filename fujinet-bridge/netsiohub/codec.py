@@ -0,0 +1,263 @@
+# NetSIO message codec
+#  Message ids, NetSIOMsg and conversion between messages and datagrams. Messages are slotted
+#  objects with integer nanosecond timestamps. Payload of received message is not copied,
+#  it refers to the datagram (memoryview for blocks), payload is never modified in place.
+#  Messages relayed from devices to Atari host are recycled via free list.
+
+import struct
+from time import monotonic_ns
+
+
+NETSIO_DATA_BYTE        = 0x01
+NETSIO_DATA_BLOCK       = 0x02
+NETSIO_DATA_BYTE_SYNC   = 0x09
+NETSIO_COMMAND_OFF      = 0x10
+NETSIO_COMMAND_ON       = 0x11
+NETSIO_COMMAND_OFF_SYNC = 0x18
+NETSIO_MOTOR_OFF        = 0x20
+NETSIO_MOTOR_ON         = 0x21
+NETSIO_PROCEED_OFF      = 0x30
+NETSIO_PROCEED_ON       = 0x31
+NETSIO_INTERRUPT_OFF    = 0x40
+NETSIO_INTERRUPT_ON     = 0x41
+NETSIO_SPEED_CHANGE     = 0x80
+NETSIO_SYNC_RESPONSE    = 0x81
+NETSIO_BUS_IDLE         = 0x88
+NETSIO_CANCEL           = 0x89 # not implemented
+NETSIO_DEVICE_DISCONNECT = 0xC0
+NETSIO_DEVICE_CONNECT   = 0xC1
+NETSIO_PING_REQUEST     = 0xC2
+NETSIO_PING_RESPONSE    = 0xC3
+NETSIO_ALIVE_REQUEST    = 0xC4
+NETSIO_ALIVE_RESPONSE   = 0xC5
+NETSIO_CREDIT_STATUS    = 0xC6
+NETSIO_CREDIT_UPDATE    = 0xC7
+NETSIO_BATCH            = 0xC8
+NETSIO_WARM_RESET       = 0xFE
+NETSIO_COLD_RESET       = 0xFF
+
+# events to manage device connection (connect, ping, alive) >= 0xC0
+NETSIO_CONN_MGMT        = 0xC0
+
+# NETSIO_DEVICE_CONNECT features, negotiated when device is connecting
+NETSIO_FEATURE_BATCH    = 0x01 # several messages in one datagram (NETSIO_BATCH)
+# features supported by hub
+NETSIO_FEATURES         = NETSIO_FEATURE_BATCH
+
+# max batch datagram size and max size of message inside batch
+NETSIO_BATCH_SIZE       = 512
+NETSIO_BATCH_MSG_SIZE   = 255
+
+# NETSIO_SYNC_RESPONSE types
+NETSIO_EMPTY_SYNC       = 0x00
+NETSIO_ACK_SYNC         = 0x01
+
+# Altirra specific
+ATDEV_READY             = 0x100
+ATDEV_TRANSMIT_BUFFER   = 0x101
+ATDEV_DEBUG_MESSAGE     = 0x102
+ATDEV_DEBUG_NOP         = 0x103
+ATDEV_EMPTY_SYNC        = 0x000
+
+# single byte bytes objects, message ids and one byte payloads are taken from here
+BYTES = tuple(bytes((i,)) for i in range(256))
+EMPTY = b''
+
+# payloads up to this size are copied out of datagram, longer ones are referenced by memoryview
+SHORT_BLOCK = 64
+
+# layout of fixed size payloads
+SPEED_ARG = struct.Struct('<L')             # NETSIO_SPEED_CHANGE baud
+SYNC_RESPONSE_ARG = struct.Struct('<BBBH')  # NETSIO_SYNC_RESPONSE sn, ack type, ack byte, write size
+BUS_IDLE_ARG = struct.Struct('<H')          # NETSIO_BUS_IDLE
+CREDIT_ARG = struct.Struct('B')             # NETSIO_CREDIT_STATUS, NETSIO_CREDIT_UPDATE
+
+ARG_STRUCTS = {
+    NETSIO_SPEED_CHANGE: SPEED_ARG,
+    NETSIO_SYNC_RESPONSE: SYNC_RESPONSE_ARG,
+    NETSIO_BUS_IDLE: BUS_IDLE_ARG,
+    NETSIO_CREDIT_STATUS: CREDIT_ARG,
+    NETSIO_CREDIT_UPDATE: CREDIT_ARG,
+}
+
+# compact data block, up to 6 bytes inlined in Altirra custom device call or interrupt:
+#   aux1: 9 bits event id, 7 bits size, 2 data bytes; aux2: 4 data bytes
+COMPACT_SIZE = 6
+
+# max messages kept on free list
+FREE_LIST_SIZE = 64
+
+class NetSIOMsg:
+    __slots__ = ['id', 'arg', 'time']
+
+    msg_labels = {
+        0x01 : "DATA_BYTE",
+        0x02 : "DATA_BLOCK",
+        0x09 : "DATA_BYTE_SYNC",
+        0x10 : "COMMAND_OFF",
+        0x11 : "COMMAND_ON",
+        0x18 : "COMMAND_OFF_SYNC",
+        0x20 : "MOTOR_OFF",
+        0x21 : "MOTOR_ON",
+        0x30 : "PROCEED_OFF",
+        0x31 : "PROCEED_ON",
+        0x40 : "INTERRUPT_OFF",
+        0x41 : "INTERRUPT_ON",
+        0x80 : "SPEED_CHANGE",
+        0x81 : "SYNC_RESPONSE",
+        0x88 : "BUS_IDLE",
+        0x89 : "CANCEL",
+        0xC0 : "DEVICE_DISCONNECT",
+        0xC1 : "DEVICE_CONNECT",
+        0xC2 : "PING_REQUEST",
+        0xC3 : "PING_RESPONSE",
+        0xC4 : "ALIVE_REQUEST",
+        0xC5 : "ALIVE_RESPONSE",
+        0xC6 : "CREDIT_STATUS",
+        0xC7 : "CREDIT_UPDATE",
+        0xC8 : "BATCH",
+        0xFE : "WARM_RESET",
+        0xFF : "COLD_RESET",
+
+        # Altirra specific
+        0x100 : "READY",
+        0x101 : "TRANSMIT_BUFFER",
+        0x102 : "DEBUG_TEXT",
+        0x103 : "NOP",
+    }
+
+    def __init__(self, id, arg=EMPTY):
+        self.time = monotonic_ns()
+        self.id:int = id
+        # bytes-like payload, int is single byte payload
+        self.arg = BYTES[arg] if type(arg) is int else \
+            arg if type(arg) in (bytes, bytearray, memoryview) else bytes(arg)
+
+    @property
+    def label(self):
+        return NetSIOMsg.msg_labels.get(self.id, "UNKNOWN")
+
+    def elapsed(self):
+        return (monotonic_ns() - self.time) * 1e-9
+
+    def elapsed_us(self):
+        return (monotonic_ns() - self.time) * 1e-3
+
+    def arg_str(self):
+        return " ".join(["{:02X}".format(b) for b in self.arg])
+
+    def __str__(self):
+        return "{:02X}:{}{} +{:.0f} {}".format(
+            self.id,
+            self.label,
+            "[{}]".format(len(self.arg)) if len(self.arg) else"",
+            self.elapsed_us(),
+            " ".join(["{:02X}".format(b) for b in self.arg])
+        )
+
+
+_free_msgs = []
+
+def new_msg(id, arg=EMPTY) -> NetSIOMsg:
+    """Message with bytes-like payload, taken from free list if possible"""
+    if not _free_msgs:
+        # no exception on common path, it costs more than new message
+        return NetSIOMsg(id, arg)
+    try:
+        msg = _free_msgs.pop()
+    except IndexError:
+        return NetSIOMsg(id, arg)
+    msg.time = monotonic_ns()
+    msg.id = id
+    msg.arg = arg
+    return msg
+
+def free_msg(msg:NetSIOMsg):
+    """Put message which is not referenced anymore on free list"""
+    msg.arg = EMPTY # release datagram
+    if len(_free_msgs) < FREE_LIST_SIZE:
+        _free_msgs.append(msg)
+
+def decode(data) -> NetSIOMsg:
+    """Message from datagram, payload refers to datagram"""
+    n = len(data)
+    if n == 2:
+        return new_msg(data[0], BYTES[data[1]])
+    if n <= SHORT_BLOCK + 1:
+        return new_msg(data[0], data[1:])
+    return new_msg(data[0], memoryview(data)[1:])
+
+def encode(msg:NetSIOMsg) -> bytes:
+    """Datagram from message"""
+    return BYTES[msg.id] + msg.arg
+
+def decode_arg(msg:NetSIOMsg) -> tuple:
+    """Unpack fixed size payload"""
+    return ARG_STRUCTS[msg.id].unpack(msg.arg)
+
+def encode_arg(id, *values) -> NetSIOMsg:
+    """Message with fixed size payload packed from values"""
+    return NetSIOMsg(id, ARG_STRUCTS[id].pack(*values))
+
+
+def compact_pack(id, data) -> tuple:
+    """Pack event id and up to COMPACT_SIZE bytes into (aux1, aux2)"""
+    n = len(data)
+    if n > COMPACT_SIZE:
+        raise ValueError("Compact data block too long: {}".format(n))
+    value = int.from_bytes(data, 'little')
+    return id | (n << 9) | ((value & 0xFFFF) << 16), value >> 16
+
+def compact_unpack(aux1, aux2) -> bytes:
+    """Data bytes of compact data block packed by compact_pack()"""
+    value = (aux1 >> 16) & 0xFFFF | (aux2 & 0xFFFFFFFF) << 16
+    return value.to_bytes(COMPACT_SIZE, 'little')[:(aux1 >> 9) & 0x7F]
+
+def compact_size(aux1) -> int:
+    """Size of compact data block, 0 if aux1 is plain event id"""
+    return (aux1 >> 9) & 0x7F
+
+
+def batch_pack(packets) -> list:
+    """Pack encoded messages into batch datagrams, return list of datagrams to send in order"""
+    datagrams = []
+    batch = []
+    size = 1
+    for packet in packets:
+        n = len(packet)
+        if batch and (n > NETSIO_BATCH_MSG_SIZE or size + 1 + n > NETSIO_BATCH_SIZE):
+            datagrams.append(_batch_datagram(batch))
+            batch = []
+            size = 1
+        if n > NETSIO_BATCH_MSG_SIZE:
+            # too long for batch, goes alone
+            datagrams.append(packet)
+        else:
+            batch.append(packet)
+            size += 1 + n
+    if batch:
+        datagrams.append(_batch_datagram(batch))
+    return datagrams
+
+def _batch_datagram(batch):
+    if len(batch) == 1:
+        return batch[0]
+    datagram = bytearray((NETSIO_BATCH,))
+    for packet in batch:
+        datagram.append(len(packet))
+        datagram += packet
+    return datagram
+
+def batch_unpack(data) -> list:
+    """Split batch datagram into encoded messages, malformed tail is dropped"""
+    packets = []
+    i = 1
+    end = len(data)
+    while i < end:
+        n = data[i]
+        i += 1
+        if n == 0 or i + n > end:
+            break
+        packets.append(data[i:i+n])
+        i += n
+    return packets
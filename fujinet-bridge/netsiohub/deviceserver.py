@@ -21,6 +21,7 @@
 
 import socketserver
 import struct
+import types
 import signal
 import sys
 import argparse
@@ -102,12 +103,17 @@ class DeviceMemoryLayer:
 
         self.handler.req_set_layer_readonly(self.layer_index, ro)
 
-class DeviceTCPHandler(socketserver.BaseRequestHandler):
+class DeviceProtocol:
     """
-    Base socketserver handler for implementing the custom device server
-    protocol. You should subclass this type in your own code and implement
-    handle_*() methods. Use req_*() methods or the methods on the reflected
-    device objects to call back into the emulator.
+    Custom device server protocol without I/O. You should subclass this type in
+    your own code and implement handle_*() methods. Use req_*() methods or the
+    methods on the reflected device objects to call back into the emulator.
+
+    Requests are written to self.request, anything with sendall(). Input is
+    consumed by protocol steps: serve() and steps it delegates to are generators
+    that yield number of bytes they need next and are resumed with these bytes.
+    Steps are driven by connection handler, blocking socket in DeviceTCPHandler
+    or event loop protocol.
 
     For convenience, memory layers and segment variables are reflected from the
     device script back into this handler to allow them to be referred to by name,
@@ -115,7 +121,13 @@ class DeviceTCPHandler(socketserver.BaseRequestHandler):
     'foo' becomes self.seg_foo, and a memory layer 'bar' becomes self.layer_bar.
     """
 
-    def __init__(self, *args, **kwargs):
+    # command packet: command, param1, param2, timestamp
+    COMMAND = struct.Struct('<BIiQ')
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
         self.verbose = False
         self.handlers = {};
 
@@ -125,35 +137,25 @@ class DeviceTCPHandler(socketserver.BaseRequestHandler):
         self.handlers[3] = ("Write byte", self.wrap_writebyte)
         self.handlers[4] = ("Cold reset", self.wrap_coldreset)
         self.handlers[5] = ("Warm reset", self.wrap_warmreset)
-        self.handlers[6] = ("Error", self.handle_error)
+        self.handlers[6] = ("Error", self.wrap_error)
         self.handlers[7] = ("Script event", self.wrap_script_event)
         self.handlers[8] = ("Script post", self.handle_script_post)
 
         self.counter = 0
 
-        super().__init__(*args, **kwargs)
-
-    def handle(self):
+    def serve(self):
         """
-        Main protocol service loop.
+        Main protocol service loop, returns when the connection is to be closed.
         """
 
-        self.verbose = self.server.cmdline_args.verbose
-
-        print("Connection received from emulator")
+        command = self.COMMAND
+        size = command.size
 
         while True:
-            command_packet = bytearray()
+            command_packet = yield size
+            self.wrap_command_packet(command_packet)
 
-            while len(command_packet) < 17:
-                command_subpacket = self.request.recv(17 - len(command_packet))
-                if len(command_subpacket) == 0:
-                    print("Connection closed")
-                    return
-
-                command_packet.extend(command_subpacket)
-
-            command_id, param1, param2, timestamp = struct.unpack('<BIiQ', command_packet)
+            command_id, param1, param2, timestamp = command.unpack(command_packet)
 
             try:
                 command_name, handler = self.handlers[command_id]
@@ -164,15 +166,22 @@ class DeviceTCPHandler(socketserver.BaseRequestHandler):
             if self.verbose:
                 print("{1:016X} {0}({2:08X}, {3:08X})".format(command_name, timestamp, param1, param2))
 
-            handler(param1, param2, timestamp)
+            step = handler(param1, param2, timestamp)
+            if isinstance(step, types.GeneratorType):
+                # handler reads data following the command
+                yield from step
 
     #----------------------------------------------------------------------------------
     # Raw extension points
     #
     # These adapt the raw protocol interface calls to more appropriate arguments and
     # return values. Typically these are not used unless there is some need to
-    # intercept or instrument the raw protocol.
+    # intercept or instrument the raw protocol. Wrappers reading data following
+    # the command are protocol steps.
     #
+    def wrap_command_packet(self, command_packet: bytes) -> None:
+        pass
+
     def wrap_debugreadbyte(self, address, param2, timestamp) -> int:
         rvalue = self.handle_debugreadbyte(address, timestamp)
 
@@ -187,7 +196,7 @@ class DeviceTCPHandler(socketserver.BaseRequestHandler):
         self.handle_writebyte(param1, param2, timestamp)
         self.request.sendall(b'\x01\0\0\0\0')
 
-    def wrap_coldreset(self, param1, param2, timestamp) -> int:
+    def wrap_coldreset(self, param1, param2, timestamp):
         # The V1 protocol unfortunately lacks an extension point and rejects unknown
         # calls, so the host abuses the cold reset command with different parameters as
         # the init command to detect downlevel hosts. We do not support V1 hosts here
@@ -195,7 +204,7 @@ class DeviceTCPHandler(socketserver.BaseRequestHandler):
         if param2 >= 0x7F000001 and param2 <= 0x7FFFFFFF:
             # tell host that we support V2 protocol
             self.request.sendall(b'\x0C\x02')
-            self.wrap_init()
+            yield from self.wrap_init()
 
         self.handle_coldreset(timestamp)
         self.request.sendall(b'\x01\0\0\0\0')
@@ -204,11 +213,15 @@ class DeviceTCPHandler(socketserver.BaseRequestHandler):
         self.handle_warmreset(timestamp)
         self.request.sendall(b'\x01\0\0\0\0')
 
+    def wrap_error(self, param1, param2, timestamp):
+        msg = (yield param2).decode('utf-8')
+        self.handle_error(msg, timestamp)
+
     def wrap_script_event(self, param1, param2, timestamp) -> int:
         self.request.sendall(struct.pack('<Bi', 1, self.handle_script_event(param1, param2, timestamp)))
 
     def wrap_init(self):
-        self.reflect_vars()
+        yield from self.reflect_vars()
 
     #----------------------------------------------------------------------------------
     # Extension points
@@ -276,16 +289,14 @@ class DeviceTCPHandler(socketserver.BaseRequestHandler):
 
         pass
 
-    def handle_error(self, param1, param2, timestamp) -> int:
+    def handle_error(self, msg: str, timestamp) -> None:
         """
         Handler invoked when the emulator detects a device server protocol error.
         This indicates either a programming error in the device server or incompatible
         emulator/server versions.
         """
 
-        msg = self._readall(param2).decode('utf-8')
         print("Error from emulator: " + msg)
-        return 0
 
     def handle_script_event(self, param1, param2, timestamp) -> int:
         """
@@ -351,10 +362,10 @@ class DeviceTCPHandler(socketserver.BaseRequestHandler):
 
         self.request.sendall(struct.pack('<BBB', 5, layer_index, 1 if ro else 0))
 
-    def req_read_seg_mem(self, segment_index: int, offset: int, len: int):
+    def read_seg_mem(self, segment_index: int, offset: int, len: int):
         """
-        Read a block of memory from a segment as a bytes object. The region to read
-        must be fully contained within the segment.
+        Protocol step reading a block of memory from a segment as a bytes object.
+        The region to read must be fully contained within the segment.
         """
 
         if offset < 0:
@@ -368,7 +379,7 @@ class DeviceTCPHandler(socketserver.BaseRequestHandler):
 
 
         self.request.sendall(struct.pack('<BBII', 6, segment_index, offset, len))
-        return self._readall(len)
+        return (yield len)
 
     def req_write_seg_mem(self, segment_index: int, offset: int, data:bytes):
         """
@@ -432,25 +443,25 @@ class DeviceTCPHandler(socketserver.BaseRequestHandler):
 
         self.request.sendall(struct.pack('<BII', 9, aux1, aux2))
 
-    def req_get_segment_names(self):
+    def get_segment_names(self):
         """
-        Retrieve a list of segment variable names from the device script, in ascending
-        index order (first = index 0). This is not normally called directly as the init
-        handler will call it and reflect the segment names.
+        Protocol step retrieving a list of segment variable names from the device script,
+        in ascending index order (first = index 0). This is not normally called directly
+        as the init handler will call it and reflect the segment names.
         """
 
         self.request.sendall(b'\x0A')
-        return self._read_names()
+        return (yield from self.read_names())
 
-    def req_get_layer_names(self):
+    def get_layer_names(self):
         """
-        Retrieve a list of memory layer names from the device script, in ascending
-        index order (first = index 0). This is not normally called directly as the init
-        handler will call it and reflect the memory layer names.
+        Protocol step retrieving a list of memory layer names from the device script,
+        in ascending index order (first = index 0). This is not normally called directly
+        as the init handler will call it and reflect the memory layer names.
         """
 
         self.request.sendall(b'\x0B')
-        return self._read_names()
+        return (yield from self.read_names())
 
     def reflect_vars(self):
         """
@@ -459,43 +470,155 @@ class DeviceTCPHandler(socketserver.BaseRequestHandler):
         memory layers with layer_.
         """
 
-        for segment_index, segment_name in enumerate(self.req_get_segment_names(), start=0):
+        for segment_index, segment_name in enumerate((yield from self.get_segment_names()), start=0):
             setattr(self, "seg_" + segment_name, DeviceSegment(self, segment_index))
 
-        for layer_index, layer_name in enumerate(self.req_get_layer_names(), start=0):
+        for layer_index, layer_name in enumerate((yield from self.get_layer_names()), start=0):
             setattr(self, "layer_" + layer_name, DeviceMemoryLayer(self, layer_index))
 
-    def _read_names(self):
+    def read_names(self):
         """
-        Read a list of names from the inbound stream in the form: name count,
-        [name len, name chars*]*.
+        Protocol step reading a list of names from the inbound stream in the form:
+        name count, [name len, name chars*]*.
         """
 
-        num_names = struct.unpack('<I', self._readall(4))[0]
+        num_names = struct.unpack('<I', (yield 4))[0]
         names = []
 
         for i in range(0, num_names):
-            name_len = struct.unpack('<I', self._readall(4))[0]
-            print(name_len)
-            names.append(self._readall(name_len).decode('utf-8'))
+            name_len = struct.unpack('<I', (yield 4))[0]
+            names.append((yield name_len).decode('utf-8'))
 
         return names
 
+class DeviceTCPHandler(DeviceProtocol, socketserver.BaseRequestHandler):
+    """
+    Base socketserver handler for implementing the custom device server
+    protocol, protocol steps are driven by blocking reads from the socket.
+    Use req_*() methods or the methods on the reflected device objects to call
+    back into the emulator.
+    """
+
+    RX_BUFFER_SIZE = 65536
+
+    def __init__(self, request, client_address, server):
+        # receive buffer, data between rx_start and rx_end was received but not processed yet
+        self.rx_buffer = bytearray(self.RX_BUFFER_SIZE)
+        self.rx_view = memoryview(self.rx_buffer)
+        self.rx_start = 0
+        self.rx_end = 0
+
+        DeviceProtocol.__init__(self, request, client_address, server)
+        socketserver.BaseRequestHandler.__init__(self, request, client_address, server)
+
+    def handle(self):
+        """
+        Main protocol service loop.
+        """
+
+        self.verbose = self.server.cmdline_args.verbose
+
+        print("Connection received from emulator")
+
+        try:
+            self._drive(self.serve())
+        except EOFError:
+            print("Connection closed")
+
+    def resolve(self, want):
+        """
+        Return what the protocol step waits for, number of bytes to read by default.
+        """
+
+        return self._readall(want)
+
+    def req_read_seg_mem(self, segment_index: int, offset: int, len: int):
+        """
+        Read a block of memory from a segment as a bytes object. The region to read
+        must be fully contained within the segment.
+        """
+
+        return self._drive(self.read_seg_mem(segment_index, offset, len))
+
+    def req_get_segment_names(self):
+        """
+        Retrieve a list of segment variable names from the device script.
+        """
+
+        return self._drive(self.get_segment_names())
+
+    def req_get_layer_names(self):
+        """
+        Retrieve a list of memory layer names from the device script.
+        """
+
+        return self._drive(self.get_layer_names())
+
+    def _drive(self, step):
+        """
+        Run protocol step to its end, blocking until data it needs arrive, and
+        return its result.
+        """
+
+        try:
+            want = next(step)
+            while True:
+                want = step.send(self.resolve(want))
+        except StopIteration as e:
+            return e.value
+
     def _readall(self, readlen):
         """
         Read the specified number of bytes from the inbound stream, blocking if
-        necessary until they all arrive.
+        necessary until they all arrive. Raises EOFError if the connection was
+        closed before.
+        """
+
+        start = self.rx_start
+        if self.rx_end - start < readlen:
+            if readlen > self.RX_BUFFER_SIZE:
+                # take what is buffered, receive the rest directly
+                seg_data = bytearray(self.rx_view[start:self.rx_end])
+                self.rx_start = self.rx_end
+                while len(seg_data) < readlen:
+                    seg_subdata = self.request.recv(readlen - len(seg_data))
+                    if len(seg_subdata) == 0:
+                        raise EOFError
+
+                    seg_data.extend(seg_subdata)
+
+                return seg_data
+
+            if not self._fill(readlen):
+                raise EOFError
+            start = self.rx_start
+
+        self.rx_start = start + readlen
+        return bytearray(self.rx_view[start:start + readlen])
+
+    def _fill(self, want: int) -> bool:
+        """
+        Receive into the buffer, as much as available. Returns False if the
+        connection was closed before want bytes are buffered.
         """
 
-        seg_data = bytearray()
-        while len(seg_data) < readlen:
-            seg_subdata = self.request.recv(readlen - len(seg_data))
-            if len(seg_subdata) == 0:
-                raise ConnectionError
+        start = self.rx_start
+        pending = self.rx_end - start
+        if start == self.rx_end:
+            self.rx_start = self.rx_end = 0
+        elif self.RX_BUFFER_SIZE - self.rx_end < want:
+            # move incomplete packet to the beginning
+            self.rx_view[:pending] = bytes(self.rx_view[start:self.rx_end])
+            self.rx_start = 0
+            self.rx_end = pending
 
-            seg_data.extend(seg_subdata)
+        while self.rx_end - self.rx_start < want:
+            n = self.request.recv_into(self.rx_view[self.rx_end:])
+            if n == 0:
+                return False
+            self.rx_end += n
 
-        return seg_data
+        return True
 
 def print_banner():
     print("Altirra Custom Device Server v0.8")
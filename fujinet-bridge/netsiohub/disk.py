@@ -0,0 +1,276 @@
+
+from netsiohub.netsio import *
+from array import array
+import mmap
+import os
+import re
+
+
+ATR_MAGIC = 0x0296
+ATR_HEADER_SIZE = 16
+# single, enhanced and double density images
+XFD_SD_SIZE = 720 * 128
+XFD_ED_SIZE = 1040 * 128
+# boot sectors 1-3 are always transferred as 128 bytes
+BOOT_SECTORS = 3
+# POKEY divisor returned by GET HSIO command
+DISK_HSIO_INDEX = 8
+
+
+class DiskImage:
+    """ATR or XFD disk image mapped into memory
+
+    Sector offsets are computed once, sector read returns slice of mapped file and
+    sector write goes straight into the mapping. Read-only file is write protected image."""
+
+    def __init__(self, path):
+        self.path = path
+        self.readonly = False
+        try:
+            self.file = open(path, 'r+b')
+        except PermissionError:
+            self.file = open(path, 'rb')
+            self.readonly = True
+        try:
+            size = os.fstat(self.file.fileno()).st_size
+            if size == 0:
+                raise ValueError("Empty disk image: {}".format(path))
+            self.mm = mmap.mmap(self.file.fileno(), 0,
+                access=mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE)
+        except:
+            self.file.close()
+            raise
+        header = self.mm[:ATR_HEADER_SIZE]
+        if size >= ATR_HEADER_SIZE and struct.unpack('<H', header[:2])[0] == ATR_MAGIC:
+            # ATR, image size in 16 bytes paragraphs
+            paragraphs, self.sector_size, paragraphs_high = struct.unpack('<HHB', header[2:7])
+            data_size = min((paragraphs | paragraphs_high << 16) * 16, size - ATR_HEADER_SIZE)
+            self.offsets = self.index(ATR_HEADER_SIZE, data_size)
+        else:
+            # XFD, raw sectors, density by image size
+            self.sector_size = 128 if size <= XFD_ED_SIZE else 256
+            self.offsets = self.index(0, size)
+        self.sectors = len(self.offsets) - 1
+
+    def index(self, start, data_size) -> array:
+        """Offsets of sectors 1..N in image, item 0 is unused"""
+        size = self.sector_size
+        if size not in (128, 256, 512):
+            raise ValueError("Unsupported sector size {}: {}".format(size, self.path))
+        offsets = array('Q', [0])
+        if size > 128 and data_size % size == 128 * BOOT_SECTORS % size:
+            # short boot sectors are packed
+            offsets.extend(start + i * 128 for i in range(BOOT_SECTORS))
+            start += 128 * BOOT_SECTORS
+            data_size -= 128 * BOOT_SECTORS
+        offsets.extend(range(start, start + data_size - size + 1, size))
+        return offsets
+
+    def size_of(self, sector) -> int:
+        """Number of bytes transferred with sector"""
+        return 128 if sector <= BOOT_SECTORS else self.sector_size
+
+    def valid(self, sector) -> bool:
+        return 1 <= sector <= self.sectors
+
+    def read(self, sector) -> bytes:
+        offset = self.offsets[sector]
+        return self.mm[offset:offset+self.size_of(sector)]
+
+    def write(self, sector, data):
+        offset = self.offsets[sector]
+        self.mm[offset:offset+len(data)] = data
+
+    def status(self) -> bytes:
+        """Drive status: flags, FDC status (inverted), format timeout, unused"""
+        flags = 0x10 # motor on
+        if self.sector_size > 128:
+            flags |= 0x20 # double density
+        elif self.sectors == XFD_ED_SIZE // 128:
+            flags |= 0x80 # enhanced density
+        if self.readonly:
+            flags |= 0x08
+        return bytes((flags, 0xBF if self.readonly else 0xFF, 0xE0, 0x00))
+
+    def close(self):
+        if not self.readonly:
+            self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+    def __str__(self):
+        return "{} ({} sectors, {} bytes{})".format(self.path, self.sectors, self.sector_size,
+            ", read-only" if self.readonly else "")
+
+
+def parse_disk_args(disks) -> dict:
+    """Parse --disk arguments [Dn=]FILE, return {unit: path}, file without unit goes to next free drive"""
+    units = {}
+    images = []
+    for arg in disks:
+        m = re.match(r'^[Dd]([1-8])[=:](.+)$', arg)
+        if m is None:
+            images.append(arg)
+        elif int(m.group(1)) in units:
+            raise ValueError("Drive D{}: given twice".format(m.group(1)))
+        else:
+            units[int(m.group(1))] = m.group(2)
+    for path in images:
+        free = [u for u in range(1, 9) if u not in units]
+        if not free:
+            raise ValueError("No free drive for {}".format(path))
+        units[free[0]] = path
+    return units
+
+
+class LocalDiskManager(DeviceManager):
+    """Disk drives D1: - D8: emulated inside hub
+
+    Commands to mounted drives are answered right in the sync request call, ACK/NAK
+    goes back with zero network round trip, complete byte and sector data follow as one
+    data block. Sync requests for other devices are answered empty, together with
+    NetSIO devices in CompositeDeviceManager the other devices are served remotely."""
+
+    def __init__(self, units:dict):
+        super().__init__('disk')
+        self.hub:NetSIOHub = None
+        self.lock = threading.Lock()
+        self.drives = {} # device ID -> DiskImage
+        try:
+            for unit, path in sorted(units.items()):
+                self.drives[SIO_DISK1 + unit - 1] = DiskImage(path)
+        except:
+            self.close_drives()
+            raise
+        self.command = False # collecting command frame
+        self.frame = bytearray()
+        self.write_to = None # (drive, sector) waiting for data frame
+        self.data = bytearray()
+        # statistics
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+
+    def start(self, hub):
+        self.hub = hub
+        for device_id, drive in self.drives.items():
+            print("D{}: {}".format(device_id - SIO_DISK1 + 1, drive))
+
+    def stop(self):
+        self.close_drives()
+
+    def close_drives(self):
+        for drive in self.drives.values():
+            drive.close()
+        self.drives = {}
+
+    def to_peripheral(self, msg):
+        trace_msg(TRACE_DISK_OUT, msg)
+        with self.lock:
+            if msg.id == NETSIO_COMMAND_ON:
+                self.command = True
+                self.frame.clear()
+                self.write_to = None
+            elif msg.id in (NETSIO_DATA_BYTE, NETSIO_DATA_BLOCK):
+                if self.command:
+                    self.frame += msg.arg[:6 - len(self.frame)]
+                elif self.write_to is not None:
+                    self.data += msg.arg[:self.write_size() - len(self.data)]
+            elif msg.id == NETSIO_COMMAND_OFF:
+                self.command = False
+            elif msg.id in (NETSIO_WARM_RESET, NETSIO_COLD_RESET):
+                self.command = False
+                self.write_to = None
+                return
+            if msg.id != NETSIO_SPEED_CHANGE:
+                return
+        # host changed port speed, drives follow
+        self.reply(msg)
+
+    def to_peripheral_sync(self, msg):
+        trace_msg(TRACE_DISK_OUT, msg)
+        sn = msg.arg[-1]
+        with self.lock:
+            if msg.id == NETSIO_COMMAND_OFF_SYNC:
+                replies = self.command_frame(sn)
+            elif msg.id == NETSIO_DATA_BYTE_SYNC:
+                replies = self.data_frame(msg.arg[0], sn)
+            else:
+                replies = [self.sync_response(sn)]
+        for m in replies:
+            self.reply(m)
+
+    def reply(self, msg:NetSIOMsg):
+        trace_msg(TRACE_DISK_IN, msg)
+        self.hub.handle_device_msg(msg, None)
+
+    def write_size(self) -> int:
+        drive, sector = self.write_to
+        return drive.size_of(sector)
+
+    def sync_response(self, sn, ack=None, write_size=0) -> NetSIOMsg:
+        if ack is None:
+            # not our device
+            return NetSIOMsg(NETSIO_SYNC_RESPONSE, bytes((sn, NETSIO_EMPTY_SYNC, 0, 0, 0)))
+        return NetSIOMsg(NETSIO_SYNC_RESPONSE, struct.pack('<BBBH', sn, NETSIO_ACK_SYNC, ack, write_size))
+
+    def complete(self, data=b'', status=SIO_COMPLETE) -> NetSIOMsg:
+        """Complete byte followed by data frame with checksum"""
+        if data:
+            return NetSIOMsg(NETSIO_DATA_BLOCK, bytes((status,)) + data + bytes((sio_checksum(data),)))
+        return NetSIOMsg(NETSIO_DATA_BYTE, bytes((status,)))
+
+    def command_frame(self, sn) -> list:
+        """Command frame is complete, return messages to host, called with lock held"""
+        self.command = False
+        frame = self.frame
+        if len(frame) != 5 or sio_checksum(frame[:4]) != frame[4] or frame[0] not in self.drives:
+            return [self.sync_response(sn)]
+        drive = self.drives[frame[0]]
+        command = frame[1]
+        aux = frame[2] | frame[3] << 8
+        debug_print("DISK D{}: command 0x{:02X} aux {}".format(frame[0] - SIO_DISK1 + 1, command, aux))
+        if command == SIO_READ:
+            if not drive.valid(aux):
+                self.errors += 1
+                return [self.sync_response(sn, SIO_NAK)]
+            self.reads += 1
+            return [self.sync_response(sn, SIO_ACK), self.complete(drive.read(aux))]
+        if command in (SIO_WRITE, SIO_PUT):
+            if not drive.valid(aux):
+                self.errors += 1
+                return [self.sync_response(sn, SIO_NAK)]
+            # data frame and its checksum follow
+            self.write_to = (drive, aux)
+            self.data.clear()
+            return [self.sync_response(sn, SIO_ACK, drive.size_of(aux) + 1)]
+        if command == SIO_STATUS:
+            return [self.sync_response(sn, SIO_ACK), self.complete(drive.status())]
+        if command == SIO_GET_HSIO:
+            return [self.sync_response(sn, SIO_ACK), self.complete(bytes((DISK_HSIO_INDEX,)))]
+        self.errors += 1
+        return [self.sync_response(sn, SIO_NAK)]
+
+    def data_frame(self, checksum, sn) -> list:
+        """Data frame is complete, return messages to host, called with lock held"""
+        if self.write_to is None:
+            return [self.sync_response(sn)]
+        drive, sector = self.write_to
+        self.write_to = None
+        data = bytes(self.data)
+        if len(data) != drive.size_of(sector) or sio_checksum(data) != checksum:
+            self.errors += 1
+            return [self.sync_response(sn, SIO_NAK)]
+        if drive.readonly:
+            self.errors += 1
+            return [self.sync_response(sn, SIO_ACK), self.complete(status=SIO_ERROR)]
+        drive.write(sector, data)
+        self.writes += 1
+        return [self.sync_response(sn, SIO_ACK), self.complete()]
+
+    def connected(self):
+        """Return true if any image is mounted"""
+        return bool(self.drives)
+
+    def stats(self) -> dict:
+        return {'drives': len(self.drives), 'reads': self.reads, 'writes': self.writes, 'errors': self.errors}
@@ -2,11 +2,17 @@
 
 from netsiohub import deviceserver
 from netsiohub.netsio import *
+from netsiohub.disk import *
+from netsiohub.lanes import LaneQueue
 
 from enum import IntEnum
 import socket, socketserver
+import signal
 import threading
 import queue
+import collections
+import itertools
+import heapq
 import sys
 import time
 import struct
@@ -28,21 +34,24 @@ class NetSIOClient:
     def __init__(self, address, sock):
         self.address = address
         self.sock = sock
-        self.expire_time = time.time() + ALIVE_EXPIRATION
+        self.expire_time = timer() + ALIVE_EXPIRATION # see ClientExpiry
         # self.cpb = 94 # default 94 CPB (19200 baud)
         self.credit = 0
+        # features negotiated on connect, NETSIO_FEATURE_*
+        self.features = 0
         self.lock = threading.Lock()
-
-    def expired(self, t=None):
-        if t is None:
-            t = time.time()
-        with self.lock:
-            expired = True if self.expire_time < t else False
-        return expired
+        # credit stalls and round trip time, see CreditControl
+        self.stalled_at = 0.0 # device reported no credit left
+        self.granted_at = 0.0 # credit sent to stalled device, its next message measures round trip
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.stall_max = 0.0
+        self.srtt = 0.0
+        self.rttvar = 0.0
 
     def refresh(self):
-        with self.lock:
-            self.expire_time = time.time() + ALIVE_EXPIRATION
+        # single store, no lock, expiry re-reads it when deadline comes
+        self.expire_time = timer() + ALIVE_EXPIRATION
 
     def update_credit(self, credit, threshold=0):
         update = False
@@ -50,8 +59,237 @@ class NetSIOClient:
             if self.credit <= threshold:
                 self.credit = credit
                 update = True
+                if self.stalled_at:
+                    self.granted_at = timer()
+                    stall = self.granted_at - self.stalled_at
+                    self.stall_time += stall
+                    if stall > self.stall_max:
+                        self.stall_max = stall
+                    self.stalled_at = 0.0
         return update
 
+    def credit_status(self, credit):
+        """Device reported its remaining credit"""
+        with self.lock:
+            self.credit = credit
+            if credit == 0 and not self.stalled_at:
+                # device waits for credit update
+                self.stalled_at = timer()
+                self.stalls += 1
+
+    def rtt_sample(self):
+        """First message after credit was given to stalled device"""
+        with self.lock:
+            if not self.granted_at:
+                return
+            rtt = timer() - self.granted_at
+            self.granted_at = 0.0
+            # smoothed round trip time and its variation, as TCP does
+            if not self.srtt:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+                self.srtt += (rtt - self.srtt) / 8
+
+    def credit_stats(self) -> dict:
+        """Credit stalls and round trip time, times in microseconds"""
+        with self.lock:
+            return {
+                'credit': self.credit,
+                'stalls': self.stalls,
+                'stall_total_us': int(self.stall_time * 1e6),
+                'stall_max_us': int(self.stall_max * 1e6),
+                'rtt_us': int(self.srtt * 1e6),
+                'rttvar_us': int(self.rttvar * 1e6),
+            }
+
+
+class CreditControl:
+    """Sizes credit given to NetSIO devices
+
+    Credit covers messages emulator drains during client's round trip time (with jitter
+    margin), plus DEFAULT_CREDIT. Device which got credit after stall can refill the
+    host queue before it runs empty. Drain time per message is measured from POKEY
+    busy time (ATDEV_READY), until measured it is estimated from SIO baud."""
+
+    def __init__(self):
+        self.baud = 19200
+        self.msg_len = 1.0 # average data message length
+        self.drain_time = 0.0 # average POKEY busy time per message, seconds
+
+    def speed(self, baud):
+        if baud > 0:
+            self.baud = baud
+            self.drain_time = 0.0 # measure again
+
+    def queued(self, msg:NetSIOMsg):
+        if msg.id == NETSIO_DATA_BLOCK:
+            self.msg_len += (len(msg.arg) - self.msg_len) / 8
+        elif msg.id == NETSIO_DATA_BYTE:
+            self.msg_len += (1 - self.msg_len) / 8
+
+    def drained(self, busy):
+        if busy > 1.0:
+            return # ready timeout, not a drain
+        if not self.drain_time:
+            self.drain_time = busy
+        else:
+            self.drain_time += (busy - self.drain_time) / 8
+
+    def message_time(self) -> float:
+        """Time emulator needs to take one message"""
+        return self.drain_time or self.msg_len * 10 / self.baud
+
+    def target(self, client:NetSIOClient) -> int:
+        rtt = client.srtt + 4 * client.rttvar
+        window = rtt / self.message_time()
+        return min(MAX_CREDIT, DEFAULT_CREDIT + int(window + 0.999))
+
+    def stats(self) -> dict:
+        return {
+            'baud': self.baud,
+            'msg_len': round(self.msg_len, 1),
+            'drain_us': int(self.message_time() * 1e6),
+        }
+
+class SioRouter:
+    """Routes data phase of SIO transaction to device owning SIO device ID
+
+    Command frame (bytes between COMMAND_ON and COMMAND_OFF), signals and everything else
+    go to all devices. Device ID (first byte of command frame) is owned by client which
+    answered command's sync request with ACK or NAK byte. Data Atari sends after command
+    frame (e.g. sector to write) go to the owner only. Data phase ends with data frame sync
+    byte, when write size announced by the owner is transferred, when the owner NAKs or
+    has nothing to receive, or when the owner sends complete byte, bytes after that (e.g.
+    concurrent mode stream) are broadcast again. Unknown device IDs, frames with bad
+    checksum and commands without sync request are broadcast."""
+
+    IDLE = 0
+    COMMAND = 1
+    DATA = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owners = {} # device ID -> client
+        self.state = self.IDLE
+        self.frame = bytearray()
+        self.device_id = None # device ID of current transaction
+        self.sync_sn = None # command sync request sn
+        self.target = None # client receiving data phase, None is broadcast
+        self.remaining = None # data phase bytes left, None if unknown
+        # statistics
+        self.unicast = 0
+        self.broadcast = 0
+
+    def route(self, msgs) -> list:
+        """Split messages into runs of (client, count), client None is broadcast"""
+        runs = []
+        with self.lock:
+            for msg in msgs:
+                client = self.destination(msg)
+                if runs and runs[-1][0] is client:
+                    runs[-1][1] += 1
+                else:
+                    runs.append([client, 1])
+                if client is None:
+                    self.broadcast += 1
+                else:
+                    self.unicast += 1
+        return runs
+
+    def destination(self, msg):
+        """Follow SIO transaction, return client for data phase message, called with lock held"""
+        if msg.id in (NETSIO_DATA_BYTE, NETSIO_DATA_BLOCK, NETSIO_DATA_BYTE_SYNC):
+            if self.state == self.DATA:
+                target = self.target
+                if msg.id == NETSIO_DATA_BYTE_SYNC:
+                    # last byte of data frame
+                    self.end_data()
+                elif self.remaining is not None:
+                    self.remaining -= len(msg.arg)
+                    if self.remaining <= 0:
+                        self.end_data()
+                return target
+            if self.state == self.COMMAND and len(self.frame) < 5:
+                # sync byte sn is not part of the frame
+                self.frame += msg.arg[:1] if msg.id == NETSIO_DATA_BYTE_SYNC else msg.arg
+        elif msg.id == NETSIO_COMMAND_ON:
+            self.state = self.COMMAND
+            self.frame.clear()
+            self.device_id = None
+            self.sync_sn = None
+            self.target = None
+            self.remaining = None
+        elif msg.id in (NETSIO_COMMAND_OFF, NETSIO_COMMAND_OFF_SYNC):
+            if self.state == self.COMMAND:
+                self.state = self.DATA
+                frame = self.frame
+                if len(frame) == 5 and sio_checksum(frame[:4]) == frame[4] and msg.id == NETSIO_COMMAND_OFF_SYNC:
+                    self.device_id = frame[0]
+                    self.sync_sn = msg.arg[-1]
+                    self.target = self.owners.get(self.device_id)
+        elif msg.id in (NETSIO_COLD_RESET, NETSIO_WARM_RESET):
+            self.end_data()
+        return None
+
+    def end_data(self):
+        """Data phase is over, following bytes are broadcast, called with lock held"""
+        self.state = self.IDLE
+        self.target = None
+        self.remaining = None
+
+    def response(self, client, msg:NetSIOMsg):
+        """Learn device ID owner from sync response to command frame"""
+        if len(msg.arg) < 2:
+            return
+        with self.lock:
+            if self.device_id is None or msg.arg[0] != self.sync_sn:
+                return
+            if msg.arg[1] != NETSIO_EMPTY_SYNC:
+                # ACK or NAK, client serves this device ID
+                self.owners[self.device_id] = client
+                if self.state != self.DATA:
+                    return
+                self.target = client
+                if len(msg.arg) >= 5:
+                    sn, kind, ack, write_size = struct.unpack('<BBBH', msg.arg[:5])
+                    if ack != SIO_ACK or write_size == 0:
+                        # no data frame follows
+                        self.end_data()
+                    else:
+                        self.remaining = write_size
+            elif self.owners.get(self.device_id) is client:
+                # owner does not serve the device ID anymore
+                del self.owners[self.device_id]
+                self.target = None
+
+    def reply(self, client):
+        """Data from device, complete byte from the owner ends data phase"""
+        if self.target is not client:
+            # cheap check first, device data are on relay path
+            return
+        with self.lock:
+            if self.state == self.DATA and self.target is client:
+                self.end_data()
+
+    def forget(self, client):
+        """Client is gone, its device IDs are unknown again"""
+        with self.lock:
+            for device_id in [d for d, c in self.owners.items() if c is client]:
+                del self.owners[device_id]
+            if self.target is client:
+                self.target = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'unicast': self.unicast,
+                'broadcast': self.broadcast,
+                'owners': {"{:02X}".format(d): addrtos(c.address) for d, c in self.owners.items()},
+            }
+
+
 class NetInThread(threading.Thread):
     """Thread to handle incoming network traffic"""
     def __init__(self, hub, port):
@@ -76,181 +314,331 @@ class NetInThread(threading.Thread):
             self.server.shutdown()
 
 class NetInBuffer:
-    """Byte buffer with auto flush on size or age"""
+    """Byte buffer with auto flush on size or age
+
+    Flush deadline is armed once per batch, when first byte enters empty buffer.
+    Receive path never waits for the monitor, monitor re-checks the deadline
+    (age of the last byte) when it expires."""
 
     BUFFER_SIZE = 130 # 130 bytes
     BUFFER_MAX_AGE = 0.005 # 5 ms
 
+    # flush reasons
+    FLUSH_SIZE = 'size'
+    FLUSH_AGE = 'age'
+    FLUSH_FORCED = 'forced'
+
     def __init__(self, server):
         self.server = server
         self.data = bytearray()
-        self.lock = threading.RLock()
-        self.monitor_condition = threading.Condition()
-        self.monitor_event = threading.Event()
-        self.tmout = 0.0
-        threading.Thread(target=self.buffer_monitor).start()
+        self.timestamp = 0.0 # time of last extend
+        self.lock = threading.Condition()
+        self.flush_lock = threading.Lock() # keeps flushed data in order with other messages
+        self.running = True
+        self.flushes = {self.FLUSH_SIZE: 0, self.FLUSH_AGE: 0, self.FLUSH_FORCED: 0}
+        self.start_monitor()
+
+    def start_monitor(self):
+        self.monitor = threading.Thread(target=self.buffer_monitor)
+        self.monitor.start()
 
     def buffer_monitor(self):
         debug_print("buffer_monitor started")
-        self.monitor_condition.acquire()
         while True:
-            #debug_print("buffer_monitor long waiting")
-            self.monitor_condition.wait()
-            tmout = self.tmout
-            #debug_print("buffer_monitor tmout:", tmout)
-            self.monitor_event.set()
-            if tmout is None:
-                break
-            while True:
-                #debug_print("buffer_monitor timeout waiting")
-                reset = self.monitor_condition.wait(tmout)
-                if not reset:
-                    #debug_print("buffer_monitor expired")
-                    self.monitor_event.set() # in case set_delay is waiting when we timed-out
-                    self.flush()
-                    break
-                tmout = self.tmout
-                #debug_print("buffer_monitor new tmout:", tmout)
-                self.monitor_event.set()
-                if tmout is None:
+            with self.lock:
+                if not self.running:
                     break
-            if tmout is None:
-                break
-        self.monitor_condition.release()
+                if not len(self.data):
+                    # wait for first byte
+                    self.lock.wait()
+                    continue
+                tmout = self.time_left()
+                if tmout > 0.0:
+                    self.lock.wait(tmout)
+                    continue
+            self.flush(self.FLUSH_AGE)
         debug_print("buffer_monitor stopped")
 
-    def set_delay(self, t):
-        with self.monitor_condition:
-            #debug_print("buffer_monitor notify")
-            self.tmout = t
-            self.monitor_event.clear()
-            self.monitor_condition.notify()
-            #debug_print("buffer_monitor notification sent")
-        self.monitor_event.wait()
-        #debug_print("buffer_monitor delay applied")
+    def arm(self):
+        """Start flush deadline, called with lock held"""
+        self.lock.notify()
+
+    def time_left(self) -> float:
+        return self.timestamp + self.BUFFER_MAX_AGE - timer()
 
     def stop(self):
-        self.set_delay(None)
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        self.monitor.join()
+        debug_print("NetInBuffer flushes:", self.flushes)
 
     def extend(self, b:bytearray):
         with self.lock:
+            if not len(self.data):
+                self.arm()
             self.data.extend(b)
+            self.timestamp = timer()
             l = len(self.data)
         if l >= self.BUFFER_SIZE:
-            self.flush()
-        else:
-            self.set_delay(self.BUFFER_MAX_AGE)
+            self.flush(self.FLUSH_SIZE)
 
-    def flush(self):
-        msg = None
-        with self.lock:
-            if len(self.data):
+    def flush(self, reason=FLUSH_FORCED):
+        with self.flush_lock:
+            with self.lock:
+                if not len(self.data):
+                    return
+                metric_observe(METRIC_FLUSH_SIZE, len(self.data))
                 if len(self.data) > 1:
-                    msg = NetSIOMsg(NETSIO_DATA_BLOCK, self.data)
+                    msg = new_msg(NETSIO_DATA_BLOCK, self.data)
+                    self.data = bytearray()
                 else:
-                    msg = NetSIOMsg(NETSIO_DATA_BYTE, self.data)
-                self.data = bytearray()
-        if msg:
-            debug_print("< NET FLUSH", msg)
+                    msg = new_msg(NETSIO_DATA_BYTE, BYTES[self.data[0]])
+                    self.data.clear()
+                self.flushes[reason] += 1
+            trace_msg(TRACE_NET_FLUSH, msg)
             self.server.hub.handle_device_msg(msg, None)
 
+class ClientExpiry:
+    """Disconnects clients when their alive deadline passes
+
+    Deadlines are kept in heap, one entry per client. Refresh does not touch the heap,
+    when the entry comes due and client was refreshed meanwhile, the entry is pushed
+    again with new deadline."""
+
+    def __init__(self, server):
+        self.server = server
+        self.heap = [] # (deadline, seq, client)
+        self.seq = itertools.count()
+        self.lock = threading.Condition()
+        self.running = True
+        self.start_monitor()
+
+    def start_monitor(self):
+        self.monitor = threading.Thread(target=self.expiry_monitor)
+        self.monitor.start()
+
+    def expiry_monitor(self):
+        debug_print("expiry_monitor started")
+        while True:
+            with self.lock:
+                if not self.running:
+                    break
+                if not self.heap:
+                    # wait for first client
+                    self.lock.wait()
+                    continue
+                tmout = self.heap[0][0] - timer()
+                if tmout > 0.0:
+                    self.lock.wait(tmout)
+                    continue
+            self.expire()
+        debug_print("expiry_monitor stopped")
+
+    def arm(self):
+        """Earliest deadline changed, called with lock held"""
+        self.lock.notify()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        self.monitor.join()
+
+    def add(self, client:NetSIOClient):
+        with self.lock:
+            heapq.heappush(self.heap, (client.expire_time, next(self.seq), client))
+            if self.heap[0][2] is client:
+                self.arm()
+
+    def expire(self):
+        """Disconnect clients with passed deadline"""
+        expired = []
+        t = timer()
+        with self.lock:
+            while self.heap and self.heap[0][0] <= t:
+                deadline, seq, client = heapq.heappop(self.heap)
+                if self.server.clients.get(client.address) is not client:
+                    continue # disconnected
+                if client.expire_time > t:
+                    # refreshed, watch new deadline
+                    heapq.heappush(self.heap, (client.expire_time, seq, client))
+                    continue
+                expired.append(client)
+        for client in expired:
+            metric_event(METRIC_CLIENT_EXPIRED)
+            self.server.deregister_client(client.address, expired=True)
+
+
 class NetSIOServer(socketserver.UDPServer):
     """NetSIO UDP Server"""
 
+    inbuffer_class = NetInBuffer
+    expiry_class = ClientExpiry
+
+    # debugging aid, append sequence number to every message sent to devices, see --sequence-byte
+    SEQUENCE_BYTE = False
+
     def __init__(self, hub:NetSIOHub, port:int):
         self.hub:NetSIOHub = hub
+        # clients by address, dict is replaced (not modified) when clients change,
+        # readers take it without lock
         self.clients_lock = threading.Lock()
         self.clients = {}
-        self.last_recv = timer()
-        self.sn = 0 # TODO test only
+        # connected clients and their addresses for fan-out,
+        # tuples are replaced (not modified) when clients change
+        self.live = ()
+        self.live_addresses = ()
+        self.batch_addresses = ()
+        self.plain_addresses = ()
+        self.sn = 0 # message sequence number, with SEQUENCE_BYTE
+        # unicast of SIO data phase
+        self.router = SioRouter()
         # single bytes buffering
-        self.inbuffer = NetInBuffer(self)
+        self.inbuffer = self.inbuffer_class(self)
+        # alive deadlines
+        self.expiry = self.expiry_class(self)
         super().__init__(('', port), NetSIOHandler)
 
     def shutdown(self):
         self.inbuffer.stop()
+        self.expiry.stop()
+        debug_print("Routing{}:".format(self.hub.tag), self.router.stats())
         super().shutdown()
 
-    def register_client(self, address, sock):
+    def register_client(self, address, sock, features=None):
         with self.clients_lock:
-            if address not in self.clients:
+            client = self.clients.get(address)
+            if client is None:
                 client = NetSIOClient(address, sock)
-                self.clients[address] = client
-                info_print("Device connected: {}  Devices: {}".format(addrtos(address), len(self.clients)))
+                clients = dict(self.clients)
+                clients[address] = client
+                self.clients = clients
+                self.expiry.add(client)
+                info_print("Device connected{}: {}  Devices: {}".format(self.hub.tag, addrtos(address), len(self.clients)))
             else:
-                client = self.clients[address]
                 client.sock = sock
                 client.refresh()
-                info_print("Device reconnected: {}  Devices: {}".format(addrtos(address), len(self.clients)))
+                info_print("Device reconnected{}: {}  Devices: {}".format(self.hub.tag, addrtos(address), len(self.clients)))
+            client.features = 0 if features is None else features & NETSIO_FEATURES
+            self.update_live()
+        if features is not None:
+            # device advertised its features, confirm the ones we will use
+            self.send_to_client(client, NetSIOMsg(NETSIO_DEVICE_CONNECT, client.features))
         # give the client initial credit
-        client.update_credit(DEFAULT_CREDIT) # initial credit
-        self.send_to_client(client, NetSIOMsg(NETSIO_CREDIT_UPDATE, DEFAULT_CREDIT))
+        credit = self.hub.credit.target(client)
+        client.update_credit(credit) # initial credit
+        self.send_to_client(client, NetSIOMsg(NETSIO_CREDIT_UPDATE, credit))
         # notify hub
         self.hub.handle_device_msg(NetSIOMsg(NETSIO_DEVICE_CONNECT), client)
         return client
 
     def deregister_client(self, address, expired=False):
         with self.clients_lock:
-            try:
-                client = self.clients.pop(address)
-            except KeyError:
-                client = None
-            count = len(self.clients)
+            clients = dict(self.clients)
+            client = clients.pop(address, None)
+            self.clients = clients
+            count = len(clients)
+            self.update_live()
         if client is not None:
-            info_print("Device disconnected{}: {}  Devices: {}".format(
-                " (connection expired)" if expired else "", addrtos(address), count))
+            info_print("Device disconnected{}{}: {}  Devices: {}".format(
+                self.hub.tag, " (connection expired)" if expired else "", addrtos(address), count))
+            debug_print("Credit{} {}:".format(self.hub.tag, addrtos(address)), client.credit_stats())
+            self.router.forget(client)
             self.hub.handle_device_msg(NetSIOMsg(NETSIO_DEVICE_DISCONNECT), client)
 
     def get_client(self, address):
-        with self.clients_lock:
-            client = self.clients.get(address)
-        return client
+        return self.clients.get(address)
 
     def send_to_client(self, client:NetSIOClient, msg):
-        client.sock.sendto(struct.pack('B', msg.id) + msg.arg, client.address)
-        debug_print("> NET {} {}".format(addrtos(client.address), msg))
+        packet = encode(msg)
+        client.sock.sendto(packet, client.address)
+        record(REC_NET_OUT, packet, client.address[1])
+        trace_msg(TRACE_NET_OUT, msg, client.address[1])
+
+    def update_live(self):
+        """rebuild fan-out destinations, called with clients_lock held"""
+        clients = tuple(self.clients.values())
+        self.live_addresses = tuple(c.address for c in clients)
+        self.batch_addresses = tuple(c.address for c in clients if c.features & NETSIO_FEATURE_BATCH)
+        self.plain_addresses = tuple(c.address for c in clients if not c.features & NETSIO_FEATURE_BATCH)
+        self.live = clients
 
     def send_to_all(self, msg):
         """broadcast all connected netsio devices"""
-        t = time.time()
-        expire = False
-        with self.clients_lock:
-            clients = list(self.clients.values())
-        # TODO test only
-        msg.arg.append(self.sn)
-        self.sn = (1 + self.sn) & 255
-        for c in clients:
-            # skip sending to expired clients
-            if c.expired(t):
-                expire = True
-                continue
-            self.send_to_client(c, msg)
-        if expire:
-            # remove expired clients
-            self.expire_clients()
+        self.send_batch_to_all((msg,))
+
+    def send_batch_to_all(self, msgs):
+        """broadcast messages to all connected netsio devices, SIO data phase goes to
+        device owning the SIO device ID only (see SioRouter),
+        devices with batch feature get them in as few datagrams as possible"""
+        if not self.live:
+            return
+        # every datagram is encoded once and sent to all destinations in tight loop
+        if self.SEQUENCE_BYTE:
+            packets = []
+            for msg in msgs:
+                packets.append(encode(msg) + BYTES[self.sn])
+                self.sn = (1 + self.sn) & 255
+        else:
+            packets = [encode(msg) for msg in msgs]
+        live = self.live
+        start = 0
+        for client, count in self.router.route(msgs):
+            chunk = packets[start:start+count] if count < len(packets) else packets
+            broadcast = client is None or client not in live
+            clients = live if broadcast else (client,)
+            if recording() or tracing():
+                # prior sending, response can be traced before send returns
+                for c in clients:
+                    port = c.address[1]
+                    for msg, packet in zip(msgs[start:start+count], chunk):
+                        record(REC_NET_OUT, packet, port)
+                        trace_msg(TRACE_NET_OUT, msg, port)
+            if broadcast:
+                self.send_packets(chunk, self.live_addresses, self.batch_addresses, self.plain_addresses)
+            else:
+                address = (client.address,)
+                if client.features & NETSIO_FEATURE_BATCH:
+                    self.send_packets(chunk, address, address, ())
+                else:
+                    self.send_packets(chunk, address, (), address)
+            start += count
+
+    def send_packets(self, packets, addresses, batch_addresses, plain_addresses):
+        sendto = self.socket.sendto
+        if len(packets) == 1:
+            packet = packets[0]
+            for address in addresses:
+                sendto(packet, address)
+        else:
+            if batch_addresses:
+                for datagram in batch_pack(packets):
+                    for address in batch_addresses:
+                        sendto(datagram, address)
+            for packet in packets:
+                for address in plain_addresses:
+                    sendto(packet, address)
     
-    def expire_clients(self):
-        t = time.time()
-        with self.clients_lock:
-            expired = [c for c in self.clients.values() if c.expired(t)]
-        for c in expired:
-            self.deregister_client(c.address, expired=True)
-        
     def connected(self):
         """Return true if any client is connected"""
-        with self.clients_lock:
-            return len(self.clients) > 0
+        return len(self.live) > 0
 
     def credit_clients(self):
         # send credits to waiting clients if there is a room in a queue
-        credit = DEFAULT_CREDIT - self.hub.host_queue.qsize()
-        if credit >= 2:
-            with self.clients_lock:
-                clients = list(self.clients.values())
-            msg = NetSIOMsg(NETSIO_CREDIT_UPDATE, credit)
-            for c in clients:
-                if c.update_credit(credit):
-                    self.send_to_client(c, msg)
+        queued = self.hub.host_queue.qsize()
+        for c in self.live:
+            self.credit_client(c, queued)
+
+    def credit_client(self, client:NetSIOClient, queued):
+        """Give credit to client which has none left, queued messages count against it"""
+        credit = self.hub.credit.target(client) - queued
+        if credit >= 2 and client.update_credit(credit):
+            self.send_to_client(client, NetSIOMsg(NETSIO_CREDIT_UPDATE, credit))
+
+    def credit_stats(self) -> dict:
+        """Credit statistics of connected clients, by address"""
+        return {addrtos(c.address): c.credit_stats() for c in self.live}
 
 
 class NetSIOHandler(socketserver.BaseRequestHandler):
@@ -258,31 +646,39 @@ class NetSIOHandler(socketserver.BaseRequestHandler):
 
     def handle(self):
         data, sock = self.request
-        msg = NetSIOMsg(data[0], data[1:])
-        ca = self.client_address
+        if len(data) and data[0] == NETSIO_BATCH:
+            for packet in batch_unpack(data):
+                self.handle_packet(packet, sock)
+        else:
+            self.handle_packet(data, sock)
 
-        debug_print("< NET IN +{:.0f} {} {}".format(
-            (timer()-self.server.last_recv)*1.e6,
-            addrtos(ca), msg))
-        self.server.last_recv = timer()
+    def handle_packet(self, data, sock):
+        """handle single NetSIO message"""
+        record(REC_NET_IN, data, self.client_address[1])
+        msg = decode(data)
+        trace_msg(TRACE_NET_IN, msg, self.client_address[1])
 
         if msg.id < NETSIO_CONN_MGMT:
             # events from connected/registered devices
             client = self.server.get_client(self.client_address)
             if client is not None:
-                if client.expired():
-                    # expired connection
-                    self.server.deregister_client(client.address, expired=True)
+                # update expiration
+                client.refresh()
+                if client.granted_at:
+                    client.rtt_sample()
+                if msg.id == NETSIO_DATA_BYTE:
+                    # buffering
+                    self.server.router.reply(client)
+                    self.server.inbuffer.extend(msg.arg)
                 else:
-                    # update expiration
-                    client.refresh()
-                    if msg.id == NETSIO_DATA_BYTE:
-                        # buffering
-                        self.server.inbuffer.extend(msg.arg)
-                    else:
-                        # send buffer firts, if any
-                        self.server.inbuffer.flush()
-                        self.server.hub.handle_device_msg(msg, client)
+                    if msg.id == NETSIO_SYNC_RESPONSE:
+                        # learn which client serves SIO device ID, before host continues
+                        self.server.router.response(client, msg)
+                    elif msg.id == NETSIO_DATA_BLOCK:
+                        self.server.router.reply(client)
+                    # send buffer firts, if any
+                    self.server.inbuffer.flush()
+                    self.server.hub.handle_device_msg(msg, client)
         else:
             # connection management
             if msg.id == NETSIO_DEVICE_DISCONNECT:
@@ -290,7 +686,7 @@ class NetSIOHandler(socketserver.BaseRequestHandler):
                 self.server.deregister_client(self.client_address)
             elif msg.id == NETSIO_DEVICE_CONNECT:
                 # device connected, register client for netsio messages
-                self.server.register_client(self.client_address, sock)
+                self.server.register_client(self.client_address, sock, msg.arg[0] if len(msg.arg) else None)
             elif msg.id == NETSIO_PING_REQUEST:
                 # ping request, send ping response (always)
                 self.server.send_to_client(
@@ -307,34 +703,113 @@ class NetSIOHandler(socketserver.BaseRequestHandler):
                 client = self.server.get_client(self.client_address)
                 if client is not None and len(msg.arg):
                     # update client's credit
-                    client.update_credit(msg.arg[0], 10) # threshold 10 to force credit update
+                    client.credit_status(msg.arg[0])
                     # send new credit immediately if there is a room in a queue
-                    credit = DEFAULT_CREDIT - self.server.hub.host_queue.qsize()
-                    if credit >= 2 and client.update_credit(credit):
-                        self.server.send_to_client(client, NetSIOMsg(NETSIO_CREDIT_UPDATE, credit))
+                    self.server.credit_client(client, self.server.hub.host_queue.qsize())
+
+
+class NetOutQueue:
+    """Messages waiting for NetOutThread
+
+    NetOutThread takes all waiting messages at once. Sync request is sent by the calling
+    thread together with waiting messages (send_now). Messages are taken and the send lock
+    is acquired under the same lock, so batches are sent in the order they were taken."""
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def put(self, msg):
+        with self.not_full:
+            if len(self.items) >= self.maxsize:
+                metric_event(METRIC_QUEUE_FULL)
+            while len(self.items) >= self.maxsize and not self.closed:
+                self.not_full.wait()
+            self.items.append(msg)
+            self.not_empty.notify()
+
+    def qsize(self):
+        return len(self.items)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.not_full.notify_all()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.items.clear()
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def take(self) -> list:
+        """Wait for messages and take them all, return None if queue is closed.
+        Send lock is held on return, call sent() when messages are sent."""
+        with self.not_empty:
+            while not self.items and not self.closed:
+                self.not_empty.wait()
+            if self.closed:
+                return None
+            msgs = list(self.items)
+            self.items.clear()
+            self.not_full.notify_all()
+            self.send_lock.acquire()
+        return msgs
+
+    def sent(self):
+        self.send_lock.release()
+
+    def send_now(self, msg, send):
+        """Send message from calling thread, right after waiting messages"""
+        with self.lock:
+            msgs = list(self.items)
+            msgs.append(msg)
+            self.items.clear()
+            self.not_full.notify_all()
+            self.send_lock.acquire()
+        try:
+            send(msgs)
+        finally:
+            self.send_lock.release()
 
 
 class NetOutThread(threading.Thread):
     """Thread to send "messages" to connected netsio devices"""
-    def __init__(self, q:queue.Queue, server:NetSIOServer):
-        self.queue:queue.Queue = q
+    def __init__(self, q:NetOutQueue, server:NetSIOServer, coalesce_size=COALESCE_SIZE):
+        self.queue:NetOutQueue = q
         self.server:NetSIOServer = server
+        self.coalesce_size = coalesce_size
         super().__init__()
 
     def run(self):
         debug_print("NetOutThread started")
         while True:
-            msg = self.queue.get()
-            if msg is None:
+            # messages waiting in queue go out together, in one batch
+            msgs = self.queue.take()
+            if msgs is None:
                 break
-            self.server.send_to_all(msg)
+            try:
+                self.send(msgs)
+            finally:
+                self.queue.sent()
 
         debug_print("NetOutThread stopped")
 
+    def send(self, msgs):
+        if len(msgs) > 1:
+            # data bytes waiting in queue go out as data block
+            msgs = coalesce_bytes(msgs, self.coalesce_size)
+        self.server.send_batch_to_all(msgs)
+
     def stop(self):
         debug_print("Stop NetOutThread")
-        clear_queue(self.queue)
-        self.queue.put(None) # stop sign
+        self.queue.close() # stop sign
         self.join()
 
 
@@ -343,9 +818,10 @@ class NetSIOManager(DeviceManager):
 
     def __init__(self, port=NETSIO_PORT):
         super().__init__(port)
-        self.device_queue = queue.Queue(16)
+        self.device_queue = NetOutQueue(16)
         self.netin_thread:NetInThread = None
         self.netout_thread:NetOutThread = None
+        self.outbuffer:DeviceOutBuffer = None
 
     def start(self, hub):
         print("UDP port (NetSIO):", self.port)
@@ -359,11 +835,18 @@ class NetSIOManager(DeviceManager):
             print("Time out waiting for NetSIOServer to start")
 
         # network sender
-        self.netout_thread = NetOutThread(self.device_queue, self.netin_thread.server)
+        self.netout_thread = NetOutThread(self.device_queue, self.netin_thread.server, self.coalesce_size)
         self.netout_thread.start()
 
+        # data bytes coalescing
+        if self.coalesce_age > 0.0:
+            self.outbuffer = DeviceOutBuffer(self.queue_msg, self.coalesce_age, self.coalesce_size)
+
     def stop(self):
         debug_print("Stop NetSIOManager")
+        if self.outbuffer:
+            self.outbuffer.stop()
+            self.outbuffer = None
         if self.netin_thread:
             self.netin_thread.stop()
             self.netin_thread = None
@@ -374,16 +857,26 @@ class NetSIOManager(DeviceManager):
     def to_peripheral(self, msg):
         if msg.id in (NETSIO_COLD_RESET, NETSIO_WARM_RESET):
             debug_print("CLEAR DEV QUEUE")
-            clear_queue(self.device_queue)
+            self.device_queue.clear()
 
-        if self.device_queue.full():
-            debug_print("device queue FULL")
+        if self.outbuffer is not None:
+            # data bytes are merged, other messages flush them
+            self.outbuffer.add(msg)
         else:
-            debug_print("device queue [{}]".format(self.device_queue.qsize()))
+            self.queue_msg(msg)
 
+    def queue_msg(self, msg):
+        trace_msg(TRACE_DEVICE_QUEUE, msg, value=self.device_queue.qsize())
         self.device_queue.put(msg)
         # debug_print("> DEV", msg)
 
+    def to_peripheral_sync(self, msg):
+        # no waiting in device queue, sync request is sent by calling thread
+        if self.outbuffer is not None:
+            self.outbuffer.flush()
+        trace_msg(TRACE_DEVICE_QUEUE, msg, value=self.device_queue.qsize())
+        self.device_queue.send_now(msg, self.netout_thread.send)
+
     def connected(self):
         """Return true if any device is connected"""
         return self.netin_thread.server.connected()
@@ -391,60 +884,351 @@ class NetSIOManager(DeviceManager):
     def credit_clients(self):
         return self.netin_thread.server.credit_clients()
 
+    def stats(self) -> dict:
+        netin_thread = self.netin_thread
+        return {'device_queue': self.device_queue.qsize(),
+                'clients': netin_thread.server.credit_stats() if netin_thread is not None else {}}
+
+
+class BackendHub:
+    """Hub as seen by one backend of CompositeDeviceManager
+
+    Messages from devices go through composite, everything else (tag, credit, host queue, ...)
+    is the hub's."""
+    def __init__(self, composite, backend, hub:NetSIOHub):
+        self.composite = composite
+        self.backend = backend
+        self.hub = hub
+
+    def handle_device_msg(self, msg:NetSIOMsg, device):
+        self.composite.from_backend(self.backend, msg, device)
+
+    def __getattr__(self, name):
+        return getattr(self.hub, name)
+
+
+class CompositeBackend:
+    """Device manager inside CompositeDeviceManager with its held messages and sync statistics"""
+
+    HELD_SIZE = 64 # messages held while other backend owns the bus
+
+    def __init__(self, manager:DeviceManager):
+        self.manager = manager
+        self.name = str(manager.port)
+        self.held = collections.deque()
+        # statistics
+        self.dropped = 0 # held messages over HELD_SIZE
+        self.sync_requests = 0
+        self.acks = 0 # ACK or NAK responses
+        self.empties = 0
+        self.wins = 0 # ACK or NAK passed to hub
+        self.late = 0 # ACK or NAK after other backend answered
+        self.rtt_total = 0 # ns
+        self.rtt_max = 0
+        self.responses = 0
+
+    def hold(self, msg:NetSIOMsg, device):
+        if len(self.held) >= self.HELD_SIZE:
+            self.held.popleft()
+            self.dropped += 1
+        self.held.append((msg, device))
+
+    def response(self, rtt):
+        self.responses += 1
+        self.rtt_total += rtt
+        if rtt > self.rtt_max:
+            self.rtt_max = rtt
+
+    def stats(self) -> dict:
+        return {
+            'connected': self.manager.connected(),
+            'sync_requests': self.sync_requests,
+            'acks': self.acks,
+            'empties': self.empties,
+            'wins': self.wins,
+            'late': self.late,
+            'rtt_avg_us': self.rtt_total // self.responses // 1000 if self.responses else 0,
+            'rtt_max_us': self.rtt_max // 1000,
+            'held': len(self.held),
+            'dropped': self.dropped,
+        }
+
+
+class CompositeDeviceManager(DeviceManager):
+    """Several device managers (serial ports, NetSIO) on one emulated SIO bus
+
+    Messages from host go to every backend. Sync request goes to every connected backend,
+    the first ACK/NAK response is passed to hub and its backend owns the bus until next
+    command frame. Empty response is passed once all backends responded empty. Data from
+    other backends while the bus is owned is held per backend and passed in order when the
+    next command frame starts, it is not mixed into the owner's data frame. Speed change
+    echoed by the hub's local backends (serial ports, disk drives) is passed once."""
+
+    def __init__(self, managers:list):
+        super().__init__(None)
+        self.backends = [CompositeBackend(m) for m in managers]
+        self.sync_tmout = max(m.sync_tmout for m in managers)
+        self.hub:NetSIOHub = None
+        self.lock = threading.Lock()
+        self.owner:CompositeBackend = None
+        self.sync_sn = None
+        self.sync_at = 0
+        self.pending = set() # backends to respond to sync request
+        self.resolved = True
+        self.speed_echo = None # payload of host speed change not echoed yet
+
+    def start(self, hub):
+        self.hub = hub
+        for b in self.backends:
+            b.manager.coalesce_age = self.coalesce_age
+            b.manager.coalesce_size = self.coalesce_size
+            b.manager.start(BackendHub(self, b, hub))
+
+    def stop(self):
+        for b in self.backends:
+            debug_print("Backend {}:".format(b.name), b.stats())
+            b.manager.stop()
+
+    def to_peripheral(self, msg):
+        held = self.new_transaction() if msg.id == NETSIO_COMMAND_ON else ()
+        if msg.id == NETSIO_SPEED_CHANGE:
+            with self.lock:
+                self.speed_echo = bytes(msg.arg)
+        for b in self.backends:
+            b.manager.to_peripheral(msg)
+        for m, device in held:
+            self.hub.handle_device_msg(m, device)
+
+    def to_peripheral_sync(self, msg):
+        with self.lock:
+            self.sync_sn = msg.arg[-1]
+            self.sync_at = monotonic_ns()
+            self.resolved = False
+            self.pending = set(b for b in self.backends if b.manager.connected())
+            pending = [b for b in self.backends if b in self.pending]
+            for b in pending:
+                b.sync_requests += 1
+        for b in pending:
+            b.manager.to_peripheral_sync(msg)
+
+    def new_transaction(self) -> list:
+        """Command frame starts, bus is free, return held messages to pass to hub"""
+        with self.lock:
+            self.owner = None
+            held = []
+            for b in self.backends:
+                held.extend(b.held)
+                b.held.clear()
+        return held
+
+    def from_backend(self, backend:CompositeBackend, msg:NetSIOMsg, device):
+        """Message from device connected to backend"""
+        empty = None
+        with self.lock:
+            if msg.id == NETSIO_SYNC_RESPONSE:
+                if not self.sync_response(backend, msg):
+                    return
+            elif msg.id in (NETSIO_DATA_BYTE, NETSIO_DATA_BLOCK):
+                if self.owner is not None and self.owner is not backend:
+                    backend.hold(msg, device)
+                    return
+            elif msg.id == NETSIO_SPEED_CHANGE and device is None:
+                # local echo, first one goes to hub, echoes of other backends are dropped
+                if self.speed_echo is None or bytes(msg.arg) != self.speed_echo:
+                    return
+                self.speed_echo = None
+            elif msg.id == NETSIO_DEVICE_DISCONNECT and backend in self.pending and not backend.manager.connected():
+                # no device left to respond, maybe others responded empty already
+                self.pending.discard(backend)
+                if not self.resolved and not self.pending:
+                    self.resolved = True
+                    empty = NetSIOMsg(NETSIO_SYNC_RESPONSE, bytes((self.sync_sn, NETSIO_EMPTY_SYNC, 0, 0, 0)))
+        self.hub.handle_device_msg(msg, device)
+        if empty is not None:
+            self.hub.handle_device_msg(empty, None)
+
+    def sync_response(self, backend:CompositeBackend, msg:NetSIOMsg) -> bool:
+        """Resolve sync response, return True if it goes to hub, called with lock held"""
+        if len(msg.arg) < 2 or msg.arg[0] != self.sync_sn or backend not in self.pending:
+            # not for current request, hub decides
+            return True
+        self.pending.discard(backend)
+        backend.response(monotonic_ns() - self.sync_at)
+        if msg.arg[1] != NETSIO_EMPTY_SYNC:
+            backend.acks += 1
+            if self.resolved:
+                # other backend answered first
+                backend.late += 1
+                return False
+            self.resolved = True
+            self.owner = backend
+            backend.wins += 1
+            return True
+        backend.empties += 1
+        if not self.resolved and not self.pending:
+            self.resolved = True
+            return True
+        return False
+
+    def connected(self):
+        """Return true if device is connected to any backend"""
+        return any(b.manager.connected() for b in self.backends)
+
+    def credit_clients(self):
+        for b in self.backends:
+            b.manager.credit_clients()
+
+    def stats(self) -> dict:
+        device_queue = 0
+        clients = {}
+        backends = {}
+        for b in self.backends:
+            stats = b.manager.stats()
+            device_queue += stats.get('device_queue', 0)
+            clients.update(stats.get('clients', {}))
+            backends[b.name] = dict(stats, **b.stats())
+        return {'device_queue': device_queue, 'clients': clients, 'backends': backends}
+
+
 class AtDevManager(HostManager):
     """Altirra custom device manager"""
     def __init__(self, arg_parser):
         super().__init__()
         self.arg_parser = arg_parser
         self.hub = None
+        self.hubs = []
+        # servers for additional hubs, on consecutive ports
+        self.servers = []
 
     def run(self, hub):
-        self.hub = hub
+        self.run_all([hub])
+
+    def run_all(self, hubs):
+        self.hub = hubs[0]
+        self.hubs = hubs
         deviceserver.run_deviceserver(AtDevHandler, NETSIO_ATDEV_PORT, self.arg_parser, self.run_server)
 
     def run_server(self, server):
         # make hub available to handler (via server object)
         server.hub = self.hub
+        port = server.server_address[1]
+        for i, hub in enumerate(self.hubs[1:], start=1):
+            extra = socketserver.TCPServer(("localhost", port + i), AtDevHandler)
+            extra.cmdline_args = server.cmdline_args
+            extra.hub = hub
+            self.servers.append(extra)
+            print("Waiting for localhost connection from emulator on port {}{}".format(port + i, hub.tag))
+            threading.Thread(target=extra.serve_forever, name="AtDevServer{}".format(i), daemon=True).start()
         server.serve_forever()
 
     def stop(self):
-        # TODO stop AtDevThread, if still running
-        pass
+        for server in self.servers:
+            # close emulator connection, handler stops its AtDevThread
+            handler = server.hub.host_handler
+            if handler is not None:
+                try:
+                    handler.request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            # waits for serve_forever(), i.e. for the handler to finish
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+        # handler of the first hub runs in main thread, it may have been left
+        # without cleanup, stop AtDevThread of any hub still connected
+        for hub in self.hubs:
+            handler = hub.host_handler
+            if handler is not None and handler.atdev_thread is not None and handler.atdev_thread.is_alive():
+                handler.atdev_thread.stop()
+
+
+class AtDevChannel:
+    """Socket-like wrapper of connection to netsio.atdevice, the only writer to the socket
+
+    Writes from handler and AtDevThread are serialized. Writes made inside "with channel:"
+    block are gathered and sent at the end of the block with single sendmsg()."""
+
+    def __init__(self, sock:socket.socket):
+        self.sock = sock
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.pending = []
+        # do not wait for more data, every write is a complete request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.recv = sock.recv
+        self.recv_into = sock.recv_into
+        self.shutdown = sock.shutdown
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.depth -= 1
+            if self.depth == 0 and self.pending:
+                buffers = self.pending
+                self.pending = []
+                self.send_buffers(buffers)
+        finally:
+            self.lock.release()
 
+    def sendall(self, data):
+        with self.lock:
+            if self.depth:
+                self.pending.append(data)
+            else:
+                self.sock.sendall(data)
+
+    def send_buffers(self, buffers):
+        if len(buffers) == 1:
+            self.sock.sendall(buffers[0])
+        elif hasattr(self.sock, 'sendmsg'):
+            sent = self.sock.sendmsg(buffers)
+            size = sum(len(b) for b in buffers)
+            if sent < size:
+                self.sock.sendall(b''.join(buffers)[sent:])
+        else:
+            # no scatter-gather on Windows
+            self.sock.sendall(b''.join(buffers))
 
-class AtDevHandler(deviceserver.DeviceTCPHandler):
-    """Handler to communicate with netsio.atdevice which lives in Altirra"""
+
+class AtDevHandlerBase(deviceserver.DeviceProtocol):
+    """netsio.atdevice protocol shared by engines, connection handling is engine's
+
+    Script event is protocol step, it yields the hub's sync request when emulator
+    waits for device response."""
     def __init__(self, *args, **kwargs):
         debug_print("AtDevHandler")
         self.hub = None
         self.atdev_ready = None
-        self.atdev_thread = None
         self.busy_at = timer()
         self.idle_at = timer()
         self.emu_ts = 0
         super().__init__(*args, **kwargs)
 
-    def handle(self):
-        """handle messages from netsio.atdevice"""
-        # start thread for outgoing messages to atdevice
-        self.hub = self.server.hub
-        self.atdev_ready = threading.Event()
-        self.atdev_ready.set()
-        host_queue = self.hub.host_connected(self)
-        self.atdev_thread = AtDevThread(host_queue, self)
-        self.atdev_thread.start()
+    def wrap_command_packet(self, command_packet):
+        record(REC_ATD_COMMAND, command_packet)
 
-        try:
-            super().handle()
-        except ConnectionResetError:
-            info_print("Host reset connection")
-        finally:
-            self.hub.host_disconnected()
-            self.atdev_thread.stop()
+    def wrap_script_event(self, param1, param2, timestamp):
+        result = yield from self.serve_script_event(param1, param2, timestamp)
+        record(REC_ATD_RESULT, ATD_RESULT.pack(result & 0xFFFFFFFF))
+        self.request.sendall(struct.pack('<Bi', 1, result))
+
+    def req_interrupt(self, aux1: int, aux2: int):
+        record(REC_ATD_INTERRUPT, ATD_INTERRUPT.pack(aux1, aux2))
+        super().req_interrupt(aux1, aux2)
+
+    def req_write_seg_mem(self, segment_index: int, offset: int, data:bytes):
+        record(REC_ATD_WRITE, ATD_WRITE.pack(segment_index, offset) + data)
+        with self.request:
+            # header and data in one send
+            super().req_write_seg_mem(segment_index, offset, data)
 
     def handle_script_post(self, event: int, arg: int, timestamp: int):
         """handle post_message from netsio.atdevice"""
-        ts = timer()
+        ts = monotonic_ns()
         self.emu_ts = timestamp
         msg:NetSIOMsg = None
 
@@ -453,12 +1237,12 @@ class AtDevHandler(deviceserver.DeviceTCPHandler):
             msg = NetSIOMsg(event)
         elif event == NETSIO_DATA_BYTE:
             # serial byte from POKEY
-            msg = NetSIOMsg(event, arg)
+            msg = new_msg(event, BYTES[arg])
             # self.hub.handle_host_msg(NetSIOMsg(event, arg))
         elif event == NETSIO_SPEED_CHANGE:
             # serial output speed changed
-            msg = NetSIOMsg(event, struct.pack("<L", arg))
-            # self.hub.handle_host_msg(NetSIOMsg(event, struct.pack("<L", arg)))
+            msg = NetSIOMsg(event, SPEED_ARG.pack(arg))
+            # self.hub.handle_host_msg(NetSIOMsg(event, SPEED_ARG.pack(arg)))
         elif event < 0x100: # fit byte
             # all other (one byte) events from atdevice
             msg = NetSIOMsg(event)
@@ -471,20 +1255,46 @@ class AtDevHandler(deviceserver.DeviceTCPHandler):
             msg = NetSIOMsg(event)
 
         if msg is None:
-            debug_print("> ATD {:02X} {:02X} ++{} -> {}".format(event, arg, timestamp-self.emu_ts))
+            trace(TRACE_ATD_IN, event & 0xFFFF, value=arg)
             info_print("Invalid ATD")
             return
 
         msg.time = ts
-        debug_print("> ATD {:02X} {:02X} ++{} -> {}".format(event, arg, timestamp-self.emu_ts, msg))
+        trace_msg(TRACE_ATD_IN, msg, value=arg)
         if event == ATDEV_READY:
+            if not self.atdev_ready.is_set():
+                # POKEY took the message, busy time sizes device credit
+                busy = timer() - self.busy_at
+                self.hub.credit.drained(busy)
+                metric_observe(METRIC_BUSY_TIME, busy)
             self.set_rtr()
         else:
             # send message to connected device
             self.hub.handle_host_msg(msg)
 
-    def handle_script_event(self, event: int, arg: int, timestamp: int) -> int:
-        ts = timer()
+    def serve_script_event(self, event: int, arg: int, timestamp: int):
+        msg, result = self.script_event_msg(event, arg, timestamp)
+        if msg is None:
+            return result
+
+        if event == NETSIO_DATA_BLOCK:
+            # get data from rxbuffer segment
+            debug_print("< ATD READ_BUFFER", arg)
+            msg.arg = yield from self.read_seg_mem(1, 0, arg)
+            record(REC_ATD_READ, msg.arg)
+            debug_print("  ATD ->", msg)
+        if self.hub.send_sync_request(msg):
+            # emulator is paused until response arrives
+            result = yield self.hub.sync
+        else:
+            result = ATDEV_EMPTY_SYNC
+        trace_msg(TRACE_ATD_RESPONSE, msg, value=result)
+        return result
+
+    def script_event_msg(self, event: int, arg: int, timestamp: int):
+        """Translate script event into message for connected devices,
+        return (None, result) if the event is handled locally"""
+        ts = monotonic_ns()
         self.emu_ts = timestamp
         msg:NetSIOMsg = None
         local = False
@@ -496,28 +1306,26 @@ class AtDevHandler(deviceserver.DeviceTCPHandler):
             msg = NetSIOMsg(event) # request sn will be appended
         elif event == NETSIO_DATA_BLOCK:
             msg = NetSIOMsg(event) # data block will be read
+        elif event & 0x1FF == NETSIO_DATA_BLOCK and compact_size(event):
+            # compact data block, bytes are packed into event and arg, no segment read
+            msg = NetSIOMsg(NETSIO_DATA_BLOCK, compact_unpack(event, arg))
         elif event == ATDEV_DEBUG_NOP:
             msg = NetSIOMsg(event, arg)
             local = True
             result = arg
 
         if msg is None:
-            debug_print("> ATD CALL {:02X} {:02X} ++{}".format(event, arg, timestamp-self.emu_ts))
+            trace(TRACE_ATD_CALL, event & 0xFFFF, value=arg)
             info_print("Invalid ATD CALL")
-            debug_print("< ATD RESPONSE {}".format(result))
-            return result
+            trace(TRACE_ATD_RESPONSE, event & 0xFFFF, value=result)
+            return None, result
 
         msg.time = ts
-        debug_print("> ATD CALL {:02X} {:02X} ++{} -> {}".format(event, arg, timestamp-self.emu_ts, msg))
-        if event == NETSIO_DATA_BLOCK:
-            # get data from rxbuffer segment
-            debug_print("< ATD READ_BUFFER", arg)
-            msg.arg = self.req_read_seg_mem(1, 0, arg)
-            debug_print("  ATD ->", msg)
-        if not local:
-            result = self.hub.handle_host_msg_sync(msg)
-        debug_print("< ATD RESPONSE {} = 0x{:02X} +{:.0f}".format(result, result, msg.elapsed_us()))
-        return result
+        trace_msg(TRACE_ATD_CALL, msg, value=arg)
+        if local:
+            trace_msg(TRACE_ATD_RESPONSE, msg, value=result)
+            return None, result
+        return msg, result
 
     def handle_coldreset(self, timestamp):
         debug_print("> ATD COLD RESET")
@@ -534,13 +1342,83 @@ class AtDevHandler(deviceserver.DeviceTCPHandler):
         """Clear Ready To Receive"""
         self.busy_at = timer()
         self.atdev_ready.clear()
-        debug_print("ATD BUSY  idle time: {:.0f}".format((self.busy_at-self.idle_at)*1.e6))
+        trace(TRACE_ATD_BUSY, aux=int((self.busy_at-self.idle_at)*1.e6))
 
     def set_rtr(self):
         """Set Ready To receive"""
         self.idle_at = timer()
         self.atdev_ready.set()
-        debug_print("ATD READY busy time: {:.0f}".format((self.idle_at-self.busy_at)*1.e6))
+        trace(TRACE_ATD_READY, aux=int((self.idle_at-self.busy_at)*1.e6))
+
+    def transmit(self, msg:NetSIOMsg):
+        """Send message to netsio.atdevice"""
+        trace_msg(TRACE_ATD_OUT, msg)
+        if msg.id == NETSIO_DATA_BLOCK:
+            rxsize = len(msg.arg)
+            if rxsize <= COMPACT_SIZE:
+                # compact short data block, data bytes are packed into aux1 and aux2
+                self.req_interrupt(*compact_pack(ATDEV_TRANSMIT_BUFFER, msg.arg))
+            else:
+                with self.request:
+                    # place serial data to netsio.atdevice rxbuffer i.e. segment 0
+                    self.req_write_seg_mem(0, 0, msg.arg)
+                    # instruct netsio.atdevice to send rxbuffer to emulated Atari
+                    self.req_interrupt(ATDEV_TRANSMIT_BUFFER, rxsize)
+        elif msg.id == NETSIO_DATA_BYTE:
+            # serial byte from remote device
+            self.req_interrupt(msg.id, msg.arg[0])
+        elif msg.id == NETSIO_SPEED_CHANGE:
+            # speed change
+            if len(msg.arg) == 4:
+                self.req_interrupt(msg.id, SPEED_ARG.unpack(msg.arg)[0])
+            else:
+                info_print("Invalid NETSIO_SPEED_CHANGE message")
+        elif msg.id == NETSIO_BUS_IDLE:
+            # speed change
+            if len(msg.arg) == 2:
+                self.req_interrupt(msg.id, BUS_IDLE_ARG.unpack(msg.arg)[0])
+            else:
+                info_print("Invalid NETSIO_BUS_IDLE message")
+        else:
+            # all other
+            self.req_interrupt(msg.id, msg.arg[0] if len(msg.arg) else 0)
+
+
+class AtDevHandler(AtDevHandlerBase, deviceserver.DeviceTCPHandler):
+    """Handler to communicate with netsio.atdevice which lives in Altirra"""
+    def __init__(self, *args, **kwargs):
+        self.atdev_thread = None
+        super().__init__(*args, **kwargs)
+
+    def handle(self):
+        """handle messages from netsio.atdevice"""
+        # start thread for outgoing messages to atdevice
+        self.hub = self.server.hub
+        self.request = AtDevChannel(self.request)
+        self.atdev_ready = threading.Event()
+        self.atdev_ready.set()
+        host_queue = self.hub.host_connected(self)
+        self.atdev_thread = AtDevThread(host_queue, self)
+        self.atdev_thread.start()
+
+        try:
+            super().handle()
+        except ConnectionResetError:
+            info_print("Host reset connection")
+        finally:
+            self.hub.host_disconnected()
+            self.atdev_thread.stop()
+
+    def resolve(self, want):
+        if want is self.hub.sync:
+            # emulator is paused until response arrives or timeout
+            return self.hub.sync.get_response(self.hub.device_manager.sync_tmout, ATDEV_EMPTY_SYNC)
+        return super().resolve(want)
+
+    def set_rtr(self):
+        super().set_rtr()
+        if self.atdev_thread is not None:
+            self.atdev_thread.queue.wake() # data lane is open
 
     def wait_rtr(self, timeout):
         """Wait for ready receiver"""
@@ -569,21 +1447,22 @@ class AtDevThread(threading.Thread):
         # debug_print("< ATD +{:.0f} {:02X} {:02X}".format(msg.elapsed_us(), ATDEV_DEBUG_MESSAGE, msglen))
 
         while True:
-            msg = self.queue.get()
-            if self.stop_flag.is_set():
-                break
-
-            if not self.atdev_handler.wait_rtr(5): # TODO adjustable
-                info_print("ATD TIMEOUT")
-                # TODO timeout recovery
-                clear_queue(self.queue)
-                self.atdev_handler.set_rtr()
-
+            # control messages go out even if POKEY is busy, data waits for ready
+            try:
+                msg = self.queue.get(self.atdev_handler.atdev_ready.is_set, 1.0)
+            except queue.Empty:
+                if self.queue.data_waiting() and timer() - self.atdev_handler.busy_at > 5: # TODO adjustable
+                    info_print("ATD TIMEOUT")
+                    metric_event(METRIC_ATD_TIMEOUT)
+                    # TODO timeout recovery
+                    clear_queue(self.queue)
+                    self.atdev_handler.set_rtr()
+                continue
             if self.stop_flag.is_set():
                 break
 
-            if self.queue.qsize() < 2:
-                self.atdev_handler.hub.credit_clients()
+            # credit is given when queue drains below stalled client's target
+            self.atdev_handler.hub.credit_clients()
 
             if msg.id in (NETSIO_DATA_BYTE, NETSIO_DATA_BLOCK, NETSIO_BUS_IDLE):
                 # send byte and send buffer makes POKEY busy and
@@ -591,59 +1470,8 @@ class AtDevThread(threading.Thread):
                 # prior sending more data
                 self.atdev_handler.clear_rtr()
 
-            if msg.id == NETSIO_DATA_BLOCK:
-                rxsize = len(msg.arg)
-                if rxsize <= 6:
-                    # prepare compact short data block
-                    aux1 = ATDEV_TRANSMIT_BUFFER | (rxsize << 9)
-                    aux2 = 0
-                    # place firts 2 bytes into aux1
-                    if rxsize:
-                        aux1 |= (msg.arg[0] << 16)
-                    if rxsize > 1:
-                        aux1 |= (msg.arg[1] << 24)
-                    # place next 4 bytes into aux2
-                    if rxsize > 2:
-                        aux2 = msg.arg[2]
-                    if rxsize > 3:
-                        aux2 |= (msg.arg[3] << 8)
-                    if rxsize > 4:
-                        aux2 |= (msg.arg[4] << 16)
-                    if rxsize > 5:
-                        aux2 |= (msg.arg[5] << 24)
-                    debug_print("< ATD {:08X}:WRITE_&_TRANSMIT_BUFFER 0x{:08X} +{:.0f} <- {}".format(
-                        aux1, aux2, msg.elapsed_us(), msg))
-                    self.atdev_handler.req_interrupt(aux1, aux2)
-                else:
-                    # place serial data to netsio.atdevice rxbuffer i.e. segment 0
-                    debug_print("< ATD WRITE_BUFFER {} <- {}".format(rxsize, msg))
-                    self.atdev_handler.req_write_seg_mem(0, 0, msg.arg)
-                    # instruct netsio.atdevice to send rxbuffer to emulated Atari
-                    debug_print("< ATD {:02X}:TRANSMIT_BUFFER {} +{:.0f}".format(
-                        ATDEV_TRANSMIT_BUFFER, rxsize, msg.elapsed_us()))
-                    self.atdev_handler.req_interrupt(ATDEV_TRANSMIT_BUFFER, rxsize)
-            elif msg.id == NETSIO_DATA_BYTE:
-                # serial byte from remote device
-                debug_print("< ATD {}".format(msg))
-                self.atdev_handler.req_interrupt(msg.id, msg.arg[0])
-            elif msg.id == NETSIO_SPEED_CHANGE:
-                # speed change
-                if len(msg.arg) == 4:
-                    debug_print("< ATD {}".format(msg))
-                    self.atdev_handler.req_interrupt(msg.id, struct.unpack('<L', msg.arg)[0])
-                else:
-                    info_print("Invalid NETSIO_SPEED_CHANGE message")
-            elif msg.id == NETSIO_BUS_IDLE:
-                # speed change
-                if len(msg.arg) == 2:
-                    debug_print("< ATD {}".format(msg))
-                    self.atdev_handler.req_interrupt(msg.id, struct.unpack('<H', msg.arg)[0])
-                else:
-                    info_print("Invalid NETSIO_BUS_IDLE message")
-            else:
-                # all other
-                debug_print("< ATD {}".format(msg))
-                self.atdev_handler.req_interrupt(msg.id, msg.arg[0] if len(msg.arg) else 0)
+            self.atdev_handler.transmit(msg)
+            free_msg(msg)
 
         debug_print("AtDevThread stopped")
 
@@ -659,24 +1487,58 @@ class NetSIOHub:
     """HUB connecting NetSIO devices with Atari host"""
 
     class SyncRequest:
-        """Synchronized request-response"""
+        """Synchronized request-response
+
+        Waiting side is woken up by response, by cancel() when response cannot come
+        (no device left, host gone) or by timeout. Round trip time of answered
+        requests is measured."""
         def __init__(self):
             self.sn = 0
             self.request = None
             self.response = None
             self.lock = threading.Lock()
             self.completed = threading.Event()
+            self.sent_at = 0
+            # statistics, see stats()
+            self.requests = 0
+            self.responses = 0
+            self.timeouts = 0
+            self.cancels = 0
+            self.rtt_last = 0 # ns
+            self.rtt_min = 0
+            self.rtt_max = 0
+            self.rtt_total = 0
 
         def set_request(self, request):
             with self.lock:
                 self.sn = (self.sn + 1) & 255
                 self.request = request
+                self.requests += 1
                 self.completed.clear()
+                self.sent_at = monotonic_ns()
             return self.sn
 
         def set_response(self, response, sn):
             with self.lock:
                 if self.request is not None and self.sn == sn:
+                    rtt = monotonic_ns() - self.sent_at
+                    metric_observe(METRIC_SYNC_RTT, rtt / 1e9)
+                    self.rtt_last = rtt
+                    if not self.responses or rtt < self.rtt_min:
+                        self.rtt_min = rtt
+                    if rtt > self.rtt_max:
+                        self.rtt_max = rtt
+                    self.rtt_total += rtt
+                    self.responses += 1
+                    self.request = None
+                    self.response = response
+                    self.completed.set()
+
+        def cancel(self, response=ATDEV_EMPTY_SYNC):
+            """Complete pending request without waiting for response"""
+            with self.lock:
+                if self.request is not None:
+                    self.cancels += 1
                     self.request = None
                     self.response = response
                     self.completed.set()
@@ -688,6 +1550,8 @@ class NetSIOHub:
                     return self.response
             else:
                 with self.lock:
+                    if self.request is not None:
+                        self.timeouts += 1
                     self.request = None
                     return timout_value
 
@@ -695,13 +1559,30 @@ class NetSIOHub:
             with self.lock:
                 return self.request, self.sn
 
+        def stats(self) -> dict:
+            """Sync request counters and round trip times in microseconds"""
+            with self.lock:
+                return {
+                    'requests': self.requests,
+                    'responses': self.responses,
+                    'timeouts': self.timeouts,
+                    'cancels': self.cancels,
+                    'rtt_last_us': self.rtt_last // 1000,
+                    'rtt_min_us': self.rtt_min // 1000,
+                    'rtt_avg_us': self.rtt_total // self.responses // 1000 if self.responses else 0,
+                    'rtt_max_us': self.rtt_max // 1000,
+                }
+
     def __init__(self, device_manager:DeviceManager, host_manager:HostManager):
         self.device_manager = device_manager
         self.host_manager = host_manager
-        self.host_queue = queue.Queue(8) # max 3-4 items should be there, anyhow make it bit larger, to avoid blocked netin thread
+        self.host_queue = LaneQueue(MAX_CREDIT + 8) # up to MAX_CREDIT data items should be there, anyhow make it bit larger, to avoid blocked netin thread
         self.host_ready = threading.Event()
         self.host_handler:AtDevHandler = None
         self.sync = NetSIOHub.SyncRequest()
+        self.credit = CreditControl()
+        # instance label for log messages, set when several hubs are running
+        self.tag = ""
 
     def run(self):
         try:
@@ -710,44 +1591,50 @@ class NetSIOHub:
         finally:
             self.device_manager.stop()
             self.host_manager.stop()
+            debug_print("Sync{}:".format(self.tag), self.sync.stats())
+            debug_print("Host queue{}:".format(self.tag), self.host_queue.stats())
+            debug_print("Credit{}:".format(self.tag), self.credit.stats())
 
     def host_connected(self, host_handler:AtDevHandler): # TODO replace call to AtDevHandler.clear_rtr()
-        info_print("Host connected")
+        info_print("Host connected{}".format(self.tag))
         self.host_handler = host_handler
         self.host_ready.set()
         return self.host_queue
 
     def host_disconnected(self):
-        info_print("Host disconnected")
+        info_print("Host disconnected{}".format(self.tag))
         self.host_ready.clear()
         self.host_handler = None
         clear_queue(self.host_queue)
+        self.sync.cancel()
 
     def handle_host_msg(self, msg:NetSIOMsg):
         """handle message from Atari host emulator, emulation is running"""
         if msg.id in (NETSIO_COLD_RESET, NETSIO_WARM_RESET):
-            info_print("HOST {} RESET".format("COLD" if msg.id == NETSIO_COLD_RESET else "WARM"))
+            info_print("HOST {} RESET{}".format("COLD" if msg.id == NETSIO_COLD_RESET else "WARM", self.tag))
             # # clear I/O queues on emulator cold / warm reset
             # debug_print("CLEAR HOST QUEUE")
             # clear_queue(self.host_queue)
         # send message down to connected peripherals
         self.device_manager.to_peripheral(msg)
 
-    def handle_host_msg_sync(self, msg:NetSIOMsg) ->int:
-        """handle message from Atari host emulator, emulation is paused, emulator is waiting for reply"""
+    def send_sync_request(self, msg:NetSIOMsg) -> bool:
+        """send message from paused emulator to devices, return True if sync response is expected"""
         if msg.id == NETSIO_DATA_BLOCK:
             self.handle_host_msg(msg) # send to devices
-            return ATDEV_EMPTY_SYNC # return no ACK byte
+            return False
         # handle sync request
-        msg.arg.append(self.sync.set_request(msg.id)) # append request sn prior sending
-        clear_queue(self.host_queue)
+        msg.arg = msg.arg + BYTES[self.sync.set_request(msg.id)] # append request sn prior sending
+        if self.host_queue.qsize():
+            # drop what devices sent before, host waits for response
+            clear_queue(self.host_queue)
         if not self.device_manager.connected():
-            # shortcut: no device is connected, set response now
-            self.sync.set_response(ATDEV_EMPTY_SYNC, self.sync.sn) # no ACK byte
+            # shortcut: no device is connected, complete request now
+            self.sync.cancel() # no ACK byte
         else:
-            self.handle_host_msg(msg) # send to devices
-        result = self.sync.get_response(self.device_manager.sync_tmout, ATDEV_EMPTY_SYNC)
-        return result
+            # sent right away, after messages waiting for devices
+            self.device_manager.to_peripheral_sync(msg)
+        return True
 
     def handle_device_msg(self, msg:NetSIOMsg, device:NetSIOClient):
         """handle message from peripheral device"""
@@ -755,6 +1642,10 @@ class NetSIOHub:
             # discard, host is not connected
             return
 
+        if msg.id == NETSIO_DEVICE_DISCONNECT and not self.device_manager.connected():
+            # there is no device to respond pending sync request
+            self.sync.cancel()
+
         # handle sync request/response
         req, sn = self.sync.check_request()
         if req is not None:
@@ -781,34 +1672,92 @@ class NetSIOHub:
             # but there is a byte inside response, deliver it as normal byte to host ...
             debug_print("replace", msg)
             msg.id = NETSIO_DATA_BYTE
-            msg.arg = bytes( (msg.arg[2],) )
+            msg.arg = BYTES[msg.arg[2]]
 
-        if self.host_queue.full():
-            debug_print("host queue FULL")
+        if msg.id == NETSIO_SPEED_CHANGE and len(msg.arg) == 4:
+            self.credit.speed(SPEED_ARG.unpack(msg.arg)[0])
         else:
-            debug_print("host queue [{}]".format(self.host_queue.qsize()))
-
+            self.credit.queued(msg)
+        trace_msg(TRACE_HOST_QUEUE, msg, value=self.host_queue.qsize())
         self.host_queue.put(msg)
 
     def credit_clients(self):
         self.device_manager.credit_clients()
 
+
+class NetSIOHubGroup:
+    """Several hubs in one process, every hub connects one Atari host (emulator instance)
+    with its own NetSIO devices. Hubs share the host manager only, its run_all() serves
+    every hub (AtDevManager, AsyncAtDevManager), sync state, queues and credit are kept
+    by every hub."""
+
+    def __init__(self, hubs:list, host_manager:HostManager):
+        self.hubs = hubs
+        self.host_manager = host_manager
+        for i, hub in enumerate(hubs):
+            hub.tag = " [{}]".format(i)
+
+    def run(self):
+        try:
+            for hub in self.hubs:
+                hub.device_manager.start(hub)
+            self.host_manager.run_all(self.hubs)
+        finally:
+            for hub in self.hubs:
+                hub.device_manager.stop()
+            self.host_manager.stop()
+            for hub in self.hubs:
+                debug_print("Sync{}:".format(hub.tag), hub.sync.stats())
+                debug_print("Host queue{}:".format(hub.tag), hub.host_queue.stats())
+                debug_print("Credit{}:".format(hub.tag), hub.credit.stats())
+
 # workaround for calling parse_args() twice
 def get_arg_parser(full=True):
     arg_parser = argparse.ArgumentParser(description = 
             "Connects NetSIO protocol (SIO over UDP) talking peripherals with "
             "NetSIO Altirra custom device (localhost TCP).")
-    port_grp = arg_parser.add_mutually_exclusive_group()
-    port_grp.add_argument('--netsio-port', type=int, default=NETSIO_PORT,
-        help='Change UDP port used by NetSIO peripherals (default {})'.format(NETSIO_PORT))
-    #serial_grp = port_grp.add_argument_group("Serial port")
-    port_grp.add_argument('--serial',
-        help='Switch to serial port mode. Specify serial port (device) to use for communication with peripherals.')
+    arg_parser.add_argument('--netsio-port', type=int,
+        help='Change UDP port used by NetSIO peripherals (default {}). '
+             'Together with --serial NetSIO peripherals and serial port(s) share the bus.'.format(NETSIO_PORT))
+    arg_parser.add_argument('--serial', action='append',
+        help='Switch to serial port mode. Specify serial port (device) to use for communication with peripherals. '
+             'Can be repeated to use several serial ports.')
+    arg_parser.add_argument('--disk', action='append', metavar='[Dn=]FILE',
+        help='Emulate disk drive inside the hub with ATR or XFD image, e.g. D2=dos.atr. Can be repeated '
+             'for drives D1-D8, image without drive number goes to the next free drive. '
+             'Other devices are served by NetSIO peripherals or serial port(s).')
     arg_parser.add_argument('--command', default='RTS', choices=['RTS','DTR'],
         help='Specify how is COMMAND signal connected, value can be RTS (default) or DTR')
     arg_parser.add_argument('--proceed', default='CTS', choices=['CTS','DSR'],
         help='Specify how is PROCEED signal connected, value can be CTS (default) or DSR')
+    arg_parser.add_argument('--instances', type=int, default=1,
+        help='Number of Altirra instances served by the hub (default 1). Instance N connects to TCP port '
+             'PORT+N and talks to NetSIO devices on UDP port NETSIO_PORT+N.')
+    arg_parser.add_argument('--coalesce', type=float, default=0.0, metavar='MS',
+        help='Merge data bytes from Atari to devices into data blocks within MS milliseconds window '
+             '(default 0, only bytes already waiting for sending are merged)')
+    arg_parser.add_argument('--coalesce-size', type=int, default=COALESCE_SIZE,
+        help='Max size of data block merged from data bytes (default {})'.format(COALESCE_SIZE))
+    arg_parser.add_argument('--engine', default='thread', choices=['thread','asyncio'],
+        help='Select I/O engine, thread (default) or asyncio (single event loop, NetSIO port only)')
     arg_parser.add_argument('-d', '--debug', dest='debug', action='store_true', help='Print debug output')
+    arg_parser.add_argument('--sequence-byte', action='store_true',
+        help='Debugging aid, append sequence number byte to every message sent to NetSIO devices')
+    arg_parser.add_argument('--trace', metavar='FILE',
+        help='Record binary trace of hub traffic, trace is written to FILE on exit or on SIGUSR1 signal. '
+             'Use "python -m netsiohub.trace FILE" to decode it.')
+    arg_parser.add_argument('--trace-size', type=int, default=TRACE_SIZE,
+        help='Number of records kept in trace ring buffer (default {})'.format(TRACE_SIZE))
+    arg_parser.add_argument('--record', metavar='FILE',
+        help='Record all messages crossing the hub into FILE. '
+             'Use "python -m netsiohub.replay FILE" to replay the session.')
+    arg_parser.add_argument('--metrics', type=int, metavar='PORT',
+        help='Export hub metrics in Prometheus text format on http://127.0.0.1:PORT/metrics')
+    arg_parser.add_argument('--sio-report', metavar='FILE',
+        help='Time phases of SIO transactions, write transactions into CSV file or summary '
+             'and transactions into JSON file (.json) on exit')
+    arg_parser.add_argument('--sio-summary', type=float, default=0.0, metavar='SEC',
+        help='Time phases of SIO transactions, print summary every SEC seconds')
     if full:
         arg_parser.add_argument('--port', type=int, default=NETSIO_ATDEV_PORT,
             help='Change TCP port used by Altirra NetSIO custom device (default {})'.format(NETSIO_ATDEV_PORT))
@@ -833,25 +1782,116 @@ def main():
     if args.debug:
         enable_debug()
 
-    # get device manager (to talk to peripheral device)
-    if args.serial:
-        if has_serial:
-            device_manager = SerialSIOManager(args.serial, args.command, args.proceed)
-        else:
-            print("pySerial module was not found. To install pySerial module run 'python -m pip install pyserial'.")
-            return -1
-    else:
-        device_manager = NetSIOManager(args.netsio_port)
+    if args.record:
+        enable_record(args.record)
+
+    if args.sequence_byte:
+        NetSIOServer.SEQUENCE_BYTE = True
+
+    if args.trace:
+        enable_trace(args.trace_size)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: trace_dump(args.trace))
+
+    if args.instances < 1:
+        print("Invalid number of instances:", args.instances)
+        return -1
 
-    # get host manager (to talk to Atari host emulator)
-    host_manager = AtDevManager(get_arg_parser(False))
+    # NetSIO port is used unless only serial port(s) are given
+    netsio = args.netsio_port is not None or not args.serial
+    if args.netsio_port is None:
+        args.netsio_port = NETSIO_PORT
 
-    # hub for host <-> devices communication
-    hub = NetSIOHub(device_manager, host_manager)
+    if args.instances > 1 and (args.serial or args.disk):
+        print("Multiple instances are supported with NetSIO devices only.")
+        return -1
+
+    if args.engine == 'asyncio':
+        if args.serial:
+            print("Serial port mode is not supported by asyncio engine.")
+            return -1
+        if args.disk:
+            print("Disk images are not supported by asyncio engine.")
+            return -1
+        # device managers, host manager and hubs are sharing single event loop
+        from netsiohub import aio
+        loop = aio.new_event_loop()
+        host_manager = aio.AsyncAtDevManager(loop, args)
+        hubs = [aio.AsyncNetSIOHub(loop, aio.AsyncNetSIOManager(loop, args.netsio_port + i), host_manager)
+                for i in range(args.instances)]
+        hub = hubs[0] if args.instances == 1 else NetSIOHubGroup(hubs, host_manager)
+    elif args.instances > 1:
+        # one host manager serving hub per emulator instance
+        host_manager = AtDevManager(get_arg_parser(False))
+        hubs = [NetSIOHub(NetSIOManager(args.netsio_port + i), host_manager) for i in range(args.instances)]
+        hub = NetSIOHubGroup(hubs, host_manager)
+    else:
+        # get device manager (to talk to peripheral device)
+        managers = []
+        if args.disk:
+            try:
+                managers.append(LocalDiskManager(parse_disk_args(args.disk)))
+            except (OSError, ValueError) as e:
+                print("Failed to open disk image:", e)
+                return -1
+        if args.serial:
+            if has_serial:
+                managers += [SerialSIOManager(port, args.command, args.proceed) for port in args.serial]
+            else:
+                print("pySerial module was not found. To install pySerial module run 'python -m pip install pyserial'.")
+                return -1
+        if netsio:
+            managers.append(NetSIOManager(args.netsio_port))
+        # several buses are served by composite
+        device_manager = managers[0] if len(managers) == 1 else CompositeDeviceManager(managers)
+
+        # get host manager (to talk to Atari host emulator)
+        host_manager = AtDevManager(get_arg_parser(False))
+
+        # hub for host <-> devices communication
+        hub = NetSIOHub(device_manager, host_manager)
+        hubs = [hub]
+
+    for h in hubs:
+        h.device_manager.coalesce_age = args.coalesce / 1000.0
+        h.device_manager.coalesce_size = max(1, min(args.coalesce_size, 512))
+
+    sio_analyzer = summary_thread = None
+    if args.sio_report or args.sio_summary > 0:
+        if args.instances > 1:
+            print("SIO transaction analyzer is supported with single instance only.")
+            return -1
+        from netsiohub import analyzer
+        sio_analyzer = enable_sio_analyzer()
+        if args.debug:
+            sio_analyzer.on_transaction = lambda tx: debug_print(analyzer.transaction_str(tx))
+        if args.sio_summary > 0:
+            summary_thread = analyzer.SummaryThread(sio_analyzer, args.sio_summary)
+            summary_thread.start()
+
+    metrics_server = None
+    if args.metrics:
+        from netsiohub.metrics import MetricsServer
+        enable_metrics()
+        metrics_server = MetricsServer(args.metrics, hubs)
+        metrics_server.start()
 
     try:
         hub.run()
     except KeyboardInterrupt:
         print("\nStopped from keyboard")
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+        if summary_thread is not None:
+            summary_thread.stop()
+        if sio_analyzer is not None:
+            sio_analyzer.finish()
+            analyzer.print_summary(sio_analyzer)
+            if args.sio_report:
+                analyzer.write_report(sio_analyzer, args.sio_report)
+        record_close()
+        if args.trace:
+            trace_dump(args.trace)
 
     return 0
@@ -0,0 +1,129 @@
+# Two lane queue for messages to Atari host
+#  Control messages (PROCEED, INTERRUPT) may overtake serial data waiting for POKEY, see LaneQueue.
+#  QueueLane and control_lane() are shared with asyncio engine (aio.py).
+
+from netsiohub.netsio import *
+
+from time import monotonic_ns
+import collections
+import queue
+import threading
+
+
+# messages to Atari host which may overtake serial data, PROCEED and INTERRUPT are separate
+# lines, they do not depend on position in the byte stream
+CONTROL_LANE_MSGS = frozenset((NETSIO_PROCEED_OFF, NETSIO_PROCEED_ON, NETSIO_INTERRUPT_OFF, NETSIO_INTERRUPT_ON))
+
+def control_lane(msg) -> bool:
+    """True if message goes to control lane, None (stop sign) goes there too"""
+    return msg is None or msg.id in CONTROL_LANE_MSGS
+
+
+class QueueLane:
+    """FIFO lane of LaneQueue with depth and wait time statistics"""
+    __slots__ = ['items', 'maxsize', 'count', 'max_depth', 'wait_total', 'wait_max']
+
+    def __init__(self, maxsize=0):
+        self.items = collections.deque() # (enqueue time, message)
+        self.maxsize = maxsize
+        self.count = 0
+        self.max_depth = 0
+        self.wait_total = 0 # ns
+        self.wait_max = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def push(self, msg):
+        self.items.append((monotonic_ns(), msg))
+        self.count += 1
+        if len(self.items) > self.max_depth:
+            self.max_depth = len(self.items)
+
+    def pop(self):
+        t, msg = self.items.popleft()
+        wait = monotonic_ns() - t
+        self.wait_total += wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+        return msg
+
+    def stats(self) -> dict:
+        """Lane counters, wait times in microseconds"""
+        taken = self.count - len(self.items)
+        return {
+            'depth': len(self.items),
+            'max_depth': self.max_depth,
+            'count': self.count,
+            'wait_avg_us': self.wait_total // taken // 1000 if taken else 0,
+            'wait_max_us': self.wait_max // 1000,
+        }
+
+
+class LaneQueue:
+    """Two lane queue for messages to Atari host, compatible with queue.Queue as used by hub
+
+    Control lane is served first, its messages may overtake data lane. Each lane keeps
+    its order. Data, SPEED_CHANGE, BUS_IDLE and anything else bound to the byte stream
+    goes to data lane, so speed change never overtakes data it applies to. Taking from
+    data lane can be gated (POKEY busy), control lane is not gated. Lanes are bounded
+    independently, full data lane does not block control messages."""
+
+    def __init__(self, maxsize=0, control_maxsize=8):
+        self.control = QueueLane(control_maxsize)
+        self.data = QueueLane(maxsize)
+        self.lock = threading.Condition()
+
+    def qsize(self):
+        return len(self.control) + len(self.data)
+
+    def empty(self):
+        return not self.qsize()
+
+    def put(self, msg, block=True, timeout=None):
+        lane = self.control if control_lane(msg) else self.data
+        with self.lock:
+            if lane.full():
+                metric_event(METRIC_QUEUE_FULL)
+            if block and lane.full():
+                self.lock.wait_for(lambda: not lane.full(), timeout)
+            if lane.full():
+                raise queue.Full
+            lane.push(msg)
+            self.lock.notify_all()
+
+    def put_nowait(self, msg):
+        self.put(msg, False)
+
+    def get(self, gate=None, timeout=None):
+        """Take next message, control lane first. Data lane is taken only if gate() is true,
+        call wake() when gate opens. Raises queue.Empty on timeout."""
+        with self.lock:
+            ready = lambda: len(self.control) or (len(self.data) and (gate is None or gate()))
+            if not self.lock.wait_for(ready, timeout):
+                raise queue.Empty
+            msg = self.control.pop() if len(self.control) else self.data.pop()
+            self.lock.notify_all()
+            return msg
+
+    def get_nowait(self):
+        with self.lock:
+            if not self.qsize():
+                raise queue.Empty
+            msg = self.control.pop() if len(self.control) else self.data.pop()
+            self.lock.notify_all()
+            return msg
+
+    def data_waiting(self) -> int:
+        return len(self.data)
+
+    def wake(self):
+        with self.lock:
+            self.lock.notify_all()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'control': self.control.stats(), 'data': self.data.stats()}
@@ -0,0 +1,200 @@
+# NetSIO hub metrics endpoint
+#  Optional local HTTP server (hub --metrics PORT) exporting hub metrics in Prometheus text format.
+#  Counters and histograms are collected by HubMetrics, fed from trace points when enabled by
+#  enable_metrics() (netsio.py), gauges are read from hubs when metrics are scraped. Nothing is
+#  formatted on relay paths.
+
+from netsiohub.netsio import *
+
+import bisect
+import http.server
+import threading
+
+
+# counted directions by trace point
+METRIC_DIRECTIONS = {
+    TRACE_NET_IN    : "net_in",
+    TRACE_NET_OUT   : "net_out",
+    TRACE_ATD_IN    : "atd_in",
+    TRACE_ATD_CALL  : "atd_call",
+    TRACE_ATD_OUT   : "atd_out",
+    TRACE_SER_IN    : "ser_in",
+    TRACE_SER_OUT   : "ser_out",
+}
+
+# upper bounds of histogram buckets
+METRIC_BUCKETS = {
+    METRIC_SYNC_RTT     : (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25),
+    METRIC_BUSY_TIME    : (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1),
+    METRIC_FLUSH_SIZE   : (1, 2, 4, 8, 16, 32, 64, 128, 256),
+}
+
+
+class Histogram:
+    """Bucket counts, sum and count of observed values"""
+    __slots__ = ['bounds', 'buckets', 'count', 'total']
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1) # last is +Inf
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+
+class HubMetrics:
+    """Message and byte counters per direction and message id, event counters, histograms"""
+
+    IDS = 0x200 # message ids, Altirra events included
+
+    def __init__(self):
+        # counter index by trace point, -1 for trace points which are not directions
+        self.slot = [-1] * 256
+        for i, point in enumerate(METRIC_DIRECTIONS):
+            self.slot[point] = i * self.IDS
+        self.messages = [0] * (len(METRIC_DIRECTIONS) * self.IDS)
+        self.bytes = [0] * (len(METRIC_DIRECTIONS) * self.IDS)
+        self.events = {METRIC_ATD_TIMEOUT: 0, METRIC_CLIENT_EXPIRED: 0, METRIC_QUEUE_FULL: 0}
+        self.histograms = {name: Histogram(bounds) for name, bounds in METRIC_BUCKETS.items()}
+
+    def message(self, point, id, length):
+        slot = self.slot[point]
+        if slot >= 0:
+            i = slot + (id & 0x1FF)
+            self.messages[i] += 1
+            self.bytes[i] += length
+
+
+class MetricsWriter:
+    """Prometheus text exposition format"""
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, kind, help):
+        self.lines.append("# HELP netsio_{} {}".format(name, help))
+        self.lines.append("# TYPE netsio_{} {}".format(name, kind))
+
+    def sample(self, name, value, **labels):
+        if labels:
+            self.lines.append("netsio_{}{{{}}} {}".format(name,
+                ",".join('{}="{}"'.format(k, v) for k, v in labels.items()), value))
+        else:
+            self.lines.append("netsio_{} {}".format(name, value))
+
+    def histogram(self, name, hist:Histogram, help):
+        self.family(name, 'histogram', help)
+        total = 0
+        for bound, count in zip(hist.bounds, hist.buckets):
+            total += count
+            self.sample(name + "_bucket", total, le=bound)
+        self.sample(name + "_bucket", hist.count, le="+Inf")
+        self.sample(name + "_sum", hist.total)
+        self.sample(name + "_count", hist.count)
+
+    def text(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+def render(hubs) -> str:
+    """Metrics of hubs as exposition text"""
+    m = get_metrics()
+    w = MetricsWriter()
+
+    if m is not None:
+        for name, values, help in (
+                ("messages_total", m.messages, "Messages by direction and message id"),
+                ("bytes_total", m.bytes, "Message payload bytes by direction and message id")):
+            w.family(name, 'counter', help)
+            for i, direction in enumerate(METRIC_DIRECTIONS.values()):
+                base = i * HubMetrics.IDS
+                for id in range(HubMetrics.IDS):
+                    if m.messages[base + id]:
+                        w.sample(name, values[base + id], direction=direction,
+                            id="0x{:02X}".format(id), msg=NetSIOMsg.msg_labels.get(id, "UNKNOWN"))
+        for name, help in (
+                (METRIC_ATD_TIMEOUT, "Emulator ready timeouts recovered by clearing host queue"),
+                (METRIC_CLIENT_EXPIRED, "Devices disconnected on alive expiration"),
+                (METRIC_QUEUE_FULL, "Messages put into full queue")):
+            w.family(name + "_total", 'counter', help)
+            w.sample(name + "_total", m.events[name])
+
+    sync = [hub.sync.stats() for hub in hubs]
+    for key, help in (
+            ('requests', "Sync requests sent to devices"),
+            ('responses', "Sync requests answered by device"),
+            ('timeouts', "Sync requests without response"),
+            ('cancels', "Sync requests completed without device")):
+        w.family("sync_{}_total".format(key), 'counter', help)
+        for i, stats in enumerate(sync):
+            w.sample("sync_{}_total".format(key), stats[key], instance=i)
+
+    w.family("host_queue_depth", 'gauge', "Messages waiting for emulator, by lane")
+    for i, hub in enumerate(hubs):
+        for lane, stats in hub.host_queue.stats().items():
+            w.sample("host_queue_depth", stats['depth'], instance=i, lane=lane)
+
+    devices = [hub.device_manager.stats() for hub in hubs]
+    w.family("device_queue_depth", 'gauge', "Messages waiting for devices")
+    for i, stats in enumerate(devices):
+        w.sample("device_queue_depth", stats.get('device_queue', 0), instance=i)
+    w.family("clients", 'gauge', "Connected NetSIO devices")
+    for i, stats in enumerate(devices):
+        w.sample("clients", len(stats.get('clients', ())), instance=i)
+    for key, name, kind, scale, help in (
+            ('credit', "client_credit", 'gauge', 1, "Credit given to device"),
+            ('stalls', "client_credit_stalls_total", 'counter', 1, "Device ran out of credit"),
+            ('stall_total_us', "client_credit_stall_seconds_total", 'counter', 1e-6, "Time device waited for credit"),
+            ('rtt_us', "client_rtt_seconds", 'gauge', 1e-6, "Smoothed device round trip time")):
+        w.family(name, kind, help)
+        for i, stats in enumerate(devices):
+            for address, client in stats.get('clients', {}).items():
+                w.sample(name, client[key] * scale, instance=i, client=address)
+
+    if m is not None:
+        w.histogram(METRIC_SYNC_RTT, m.histograms[METRIC_SYNC_RTT], "Sync request round trip time")
+        w.histogram(METRIC_BUSY_TIME, m.histograms[METRIC_BUSY_TIME], "Emulator busy time per message (RTR)")
+        w.histogram(METRIC_FLUSH_SIZE, m.histograms[METRIC_FLUSH_SIZE], "Bytes per NetInBuffer flush")
+    return w.text()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /metrics"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render(self.server.hubs).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        debug_print("Metrics", self.address_string(), format % args)
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """Local HTTP endpoint with hub metrics"""
+
+    daemon_threads = True
+
+    def __init__(self, port, hubs, host='127.0.0.1'):
+        self.hubs = hubs
+        self.thread:threading.Thread = None
+        super().__init__((host, port), MetricsHandler)
+
+    def start(self):
+        print("Metrics on http://{}:{}/metrics".format(*self.server_address[:2]))
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
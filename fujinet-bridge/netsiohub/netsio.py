@@ -1,53 +1,17 @@
 
 import struct
 import queue
+import collections
+import threading
+import time
 from datetime import datetime
 from timeit import default_timer as timer
 
+from netsiohub.codec import *
 
-HUB_VERSION = "v0.16"
 
+HUB_VERSION = "v0.16"
 
-NETSIO_DATA_BYTE        = 0x01
-NETSIO_DATA_BLOCK       = 0x02
-NETSIO_DATA_BYTE_SYNC   = 0x09
-NETSIO_COMMAND_OFF      = 0x10
-NETSIO_COMMAND_ON       = 0x11
-NETSIO_COMMAND_OFF_SYNC = 0x18
-NETSIO_MOTOR_OFF        = 0x20
-NETSIO_MOTOR_ON         = 0x21
-NETSIO_PROCEED_OFF      = 0x30
-NETSIO_PROCEED_ON       = 0x31
-NETSIO_INTERRUPT_OFF    = 0x40
-NETSIO_INTERRUPT_ON     = 0x41
-NETSIO_SPEED_CHANGE     = 0x80
-NETSIO_SYNC_RESPONSE    = 0x81
-NETSIO_BUS_IDLE         = 0x88
-NETSIO_CANCEL           = 0x89 # not implemented
-NETSIO_DEVICE_DISCONNECT = 0xC0
-NETSIO_DEVICE_CONNECT   = 0xC1
-NETSIO_PING_REQUEST     = 0xC2
-NETSIO_PING_RESPONSE    = 0xC3
-NETSIO_ALIVE_REQUEST    = 0xC4
-NETSIO_ALIVE_RESPONSE   = 0xC5
-NETSIO_CREDIT_STATUS    = 0xC6
-NETSIO_CREDIT_UPDATE    = 0xC7
-NETSIO_WARM_RESET       = 0xFE
-NETSIO_COLD_RESET       = 0xFF
-
-# events to manage device connection (connect, ping, alive) >= 0xC0
-NETSIO_CONN_MGMT        = 0xC0
-
-# NETSIO_SYNC_RESPONSE types
-NETSIO_EMPTY_SYNC       = 0x00
-NETSIO_ACK_SYNC         = 0x01
-
-# Altirra specific
-ATDEV_READY             = 0x100
-ATDEV_TRANSMIT_BUFFER   = 0x101
-ATDEV_DEBUG_MESSAGE     = 0x102
-ATDEV_DEBUG_NOP         = 0x103
-ATDEV_EMPTY_SYNC        = 0x000
 
 # local TCP port for Altirra custom device communication
 NETSIO_ATDEV_PORT   = 9996
@@ -60,6 +24,8 @@ NETSIO_PORT         = 9997
 ALIVE_EXPIRATION = 30.0
 
 DEFAULT_CREDIT = 3
+# upper limit of adaptive credit, see CreditControl
+MAX_CREDIT = 16
 
 # debug printing, disabled by default
 _debug_enabled = False
@@ -79,6 +45,219 @@ def info_print(*argv, **kwargs):
     print("{}".format(datetime.now().strftime("%H:%M:%S.%f")), *argv, **kwargs)
 
 
+# tracing, disabled by default
+#  trace points record fixed size binary records into ring buffer,
+#  records are formatted only if debug printing is enabled or when decoded from trace dump
+TRACE_NET_IN        = 0x01
+TRACE_NET_OUT       = 0x02
+TRACE_NET_FLUSH     = 0x03
+TRACE_ATD_IN        = 0x10
+TRACE_ATD_CALL      = 0x11
+TRACE_ATD_RESPONSE  = 0x12
+TRACE_ATD_OUT       = 0x13
+TRACE_ATD_BUSY      = 0x14
+TRACE_ATD_READY     = 0x15
+TRACE_SER_READ      = 0x20
+TRACE_SER_IN        = 0x21
+TRACE_SER_OUT       = 0x22
+TRACE_SER_SPEED     = 0x23
+TRACE_DISK_OUT      = 0x24
+TRACE_DISK_IN       = 0x25
+TRACE_HOST_QUEUE    = 0x30
+TRACE_DEVICE_QUEUE  = 0x31
+
+# trace point labels, {} is replaced by record value
+TRACE_LABELS = {
+    TRACE_NET_IN        : "< NET IN",
+    TRACE_NET_OUT       : "> NET",
+    TRACE_NET_FLUSH     : "< NET FLUSH",
+    TRACE_ATD_IN        : "> ATD",
+    TRACE_ATD_CALL      : "> ATD CALL",
+    TRACE_ATD_RESPONSE  : "< ATD RESPONSE 0x{:02X} <-",
+    TRACE_ATD_OUT       : "< ATD",
+    TRACE_ATD_BUSY      : "ATD BUSY  idle time:",
+    TRACE_ATD_READY     : "ATD READY busy time:",
+    TRACE_SER_READ      : "< SER IN",
+    TRACE_SER_IN        : "< SER",
+    TRACE_SER_OUT       : "> SER OUT",
+    TRACE_SER_SPEED     : "SER SPEED {} switch time:",
+    TRACE_DISK_OUT      : "> DISK",
+    TRACE_DISK_IN       : "< DISK",
+    TRACE_HOST_QUEUE    : "host queue [{}] <-",
+    TRACE_DEVICE_QUEUE  : "device queue [{}] <-",
+}
+
+# trace points without message id
+TRACE_NO_ID = (TRACE_ATD_BUSY, TRACE_ATD_READY, TRACE_SER_READ, TRACE_SER_SPEED)
+
+# default number of records in trace ring buffer
+TRACE_SIZE = 65536
+
+
+_trace_buffer = None
+
+def enable_trace(size=TRACE_SIZE):
+    global _trace_buffer
+    from netsiohub.trace import TraceBuffer
+    _trace_buffer = TraceBuffer(size)
+
+
+def trace(point:int, id:int=0, data=b'', port:int=0, aux:int=0, value:int=0):
+    """Record trace event"""
+    if _trace_buffer is not None:
+        _trace_buffer.add(point, id, data, port, aux, value)
+    if _sio_analyzer is not None and point in TRACE_NO_ID:
+        _sio_analyzer.event(timer(), point, id, data, len(data), value)
+    if _debug_enabled:
+        debug_print(trace_str(point, id, len(data), port, aux, value, data))
+
+
+def tracing() -> bool:
+    """Return true if trace events are recorded, printed, counted or analyzed"""
+    return _trace_buffer is not None or _debug_enabled or _metrics is not None or _sio_analyzer is not None
+
+
+def trace_msg(point:int, msg, port:int=0, value:int=0):
+    """Record trace event for message"""
+    if _metrics is not None:
+        _metrics.message(point, msg.id, len(msg.arg))
+    if _sio_analyzer is not None:
+        _sio_analyzer.event(timer(), point, msg.id, msg.arg, len(msg.arg), value)
+    if _trace_buffer is None and not _debug_enabled:
+        return
+    trace(point, msg.id, msg.arg, port, (monotonic_ns() - msg.time) // 1000, value)
+
+
+def trace_dump(path):
+    """Write trace ring buffer into file"""
+    if _trace_buffer is not None:
+        _trace_buffer.dump(path)
+        info_print("Trace written to", path)
+
+
+def trace_str(point, id, length, port, aux, value, data) -> str:
+    s = TRACE_LABELS.get(point, "TRACE {:02X}".format(point)).format(value)
+    if port:
+        s += " :{}".format(port)
+    if point not in TRACE_NO_ID:
+        s += " {:02X}:{}".format(id, NetSIOMsg.msg_labels.get(id, "UNKNOWN"))
+        if length:
+            s += "[{}]".format(length)
+    s += " +{}".format(aux)
+    if length:
+        s += " " + " ".join(["{:02X}".format(b) for b in data])
+        if len(data) < length:
+            s += " .."
+    return s
+
+
+# metrics, disabled by default
+#  counters are plain integers in preallocated lists, hot paths only increment them,
+#  exposition text is produced when metrics are scraped, see HubMetrics in metrics.py
+
+# events counted by metric_event()
+METRIC_ATD_TIMEOUT      = "atd_timeouts"
+METRIC_CLIENT_EXPIRED   = "clients_expired"
+METRIC_QUEUE_FULL       = "queue_full"
+
+# histograms fed by metric_observe(), bucket bounds are in metrics.py
+METRIC_SYNC_RTT         = "sync_rtt_seconds"
+METRIC_BUSY_TIME        = "rtr_busy_seconds"
+METRIC_FLUSH_SIZE       = "inbuffer_flush_bytes"
+
+_metrics = None
+
+def enable_metrics():
+    global _metrics
+    from netsiohub.metrics import HubMetrics
+    _metrics = HubMetrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def metric_event(name):
+    """Count event"""
+    if _metrics is not None:
+        _metrics.events[name] += 1
+
+
+def metric_observe(name, value):
+    """Add value to histogram"""
+    if _metrics is not None:
+        _metrics.histograms[name].observe(value)
+
+
+# SIO transaction analyzer, disabled by default
+#  rebuilds SIO transactions (command frame, ACK, data frame, complete and data) from trace points
+#  and times their phases, see SioAnalyzer in analyzer.py
+_sio_analyzer = None
+
+def enable_sio_analyzer(history=None):
+    """Start feeding trace points into new SioAnalyzer, return the analyzer"""
+    global _sio_analyzer
+    from netsiohub.analyzer import SioAnalyzer, SIO_HISTORY
+    _sio_analyzer = SioAnalyzer(history or SIO_HISTORY)
+    return _sio_analyzer
+
+
+def get_sio_analyzer():
+    return _sio_analyzer
+
+
+# session recording, disabled by default
+#  every message crossing the hub is written into record file, see recorder.py and replay.py
+REC_NET_IN          = 0x01 # datagram from NetSIO device
+REC_NET_OUT         = 0x02 # datagram to NetSIO device
+REC_ATD_COMMAND     = 0x10 # command packet from emulator (17 bytes)
+REC_ATD_READ        = 0x11 # segment memory read from emulator
+REC_ATD_RESULT      = 0x12 # script event result sent to emulator
+REC_ATD_INTERRUPT   = 0x13 # interrupt request sent to emulator (aux1, aux2)
+REC_ATD_WRITE       = 0x14 # segment memory write request sent to emulator (segment, offset, data)
+
+REC_LABELS = {
+    REC_NET_IN          : "NET IN",
+    REC_NET_OUT         : "NET OUT",
+    REC_ATD_COMMAND     : "ATD COMMAND",
+    REC_ATD_READ        : "ATD READ",
+    REC_ATD_RESULT      : "ATD RESULT",
+    REC_ATD_INTERRUPT   : "ATD INTERRUPT",
+    REC_ATD_WRITE       : "ATD WRITE",
+}
+
+ATD_COMMAND = struct.Struct('<BIiQ')
+ATD_INTERRUPT = struct.Struct('<II')
+ATD_WRITE = struct.Struct('<BI')
+ATD_RESULT = struct.Struct('<I')
+
+
+_recorder = None
+
+def enable_record(path):
+    global _recorder
+    from netsiohub.recorder import SessionRecorder
+    _recorder = SessionRecorder(path)
+
+
+def record(kind:int, data, port:int=0):
+    """Write message into session record"""
+    if _recorder is not None:
+        _recorder.add(kind, data, port)
+
+
+def recording() -> bool:
+    return _recorder is not None
+
+
+def record_close():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        info_print("Session recorded to {}, {} records".format(_recorder.path, _recorder.count))
+        _recorder = None
+
+
 def clear_queue(q):
     try:
         while True:
@@ -86,79 +265,139 @@ def clear_queue(q):
     except queue.Empty:
         pass
 
+
+# SIO bytes and commands
+SIO_ACK         = 0x41 # 'A'
+SIO_NAK         = 0x4E # 'N'
+SIO_COMPLETE    = 0x43 # 'C'
+SIO_ERROR       = 0x45 # 'E'
+SIO_READ        = 0x52 # 'R'
+SIO_WRITE       = 0x57 # 'W'
+SIO_PUT         = 0x50 # 'P'
+SIO_STATUS      = 0x53 # 'S'
+SIO_GET_HSIO    = 0x3F # '?'
+SIO_DISK1       = 0x31
+
+
+def sio_checksum(data) -> int:
+    """SIO frame checksum, sum with end-around carry"""
+    s = 0
+    for b in data:
+        s += b
+        s = (s & 0xFF) + (s >> 8)
+    return s
+
+
 def addrtos(addr):
     return "{}:{}".format(*addr)
 
-class NetSIOMsg:
-    msg_labels = {
-        0x01 : "DATA_BYTE",
-        0x02 : "DATA_BLOCK",
-        0x09 : "DATA_BYTE_SYNC",
-        0x10 : "COMMAND_OFF",
-        0x11 : "COMMAND_ON",
-        0x18 : "COMMAND_OFF_SYNC",
-        0x20 : "MOTOR_OFF",
-        0x21 : "MOTOR_ON",
-        0x30 : "PROCEED_OFF",
-        0x31 : "PROCEED_ON",
-        0x40 : "INTERRUPT_OFF",
-        0x41 : "INTERRUPT_ON",
-        0x80 : "SPEED_CHANGE",
-        0x81 : "SYNC_RESPONSE",
-        0x88 : "BUS_IDLE",
-        0x89 : "CANCEL",
-        0xC0 : "DEVICE_DISCONNECT",
-        0xC1 : "DEVICE_CONNECT",
-        0xC2 : "PING_REQUEST",
-        0xC3 : "PING_RESPONSE",
-        0xC4 : "ALIVE_REQUEST",
-        0xC5 : "ALIVE_RESPONSE",
-        0xC6 : "CREDIT_STATUS",
-        0xC7 : "CREDIT_UPDATE",
-        0xFE : "WARM_RESET",
-        0xFF : "COLD_RESET",
-
-        # Altirra specific
-        0x100 : "READY",
-        0x101 : "TRANSMIT_BUFFER",
-        0x102 : "DEBUG_TEXT",
-        0x103 : "NOP",
-    }
-
-    def __init__(self, id, arg=None):
-        self.time = timer()
-        self.id:int = id
-        self.arg:bytearray = \
-            bytearray() if arg is None else \
-            bytearray(arg) if isinstance(arg, (bytes, list, tuple)) else \
-            arg if isinstance(arg, bytearray) else \
-            bytearray(struct.pack('B', arg))
-
-    @property
-    def label(self):
-        return NetSIOMsg.msg_labels.get(self.id, "UNKNOWN")
-
-    def elapsed(self):
-        return timer() - self.time
-
-    def elapsed_us(self):
-        return (timer() - self.time) * 1e6
-
-    def arg_str(self):
-        return " ".join(["{:02X}".format(b) for b in self.arg])
-
-    # def __str__(self):
-    #     return "{:02X}{}{}".format(
-    #         self.id, " " if len(self.arg) else"", self.arg_str())
-
-    def __str__(self):
-        return "{:02X}:{}{} +{:.0f} {}".format(
-            self.id,
-            self.label,
-            "[{}]".format(len(self.arg)) if len(self.arg) else"",
-            (timer() - self.time)*1.e6,
-            " ".join(["{:02X}".format(b) for b in self.arg])
-        )
+
+# max size of DATA_BLOCK merged from host to device DATA_BYTE messages
+COALESCE_SIZE = 130
+
+def coalesce_bytes(msgs, size=COALESCE_SIZE) -> list:
+    """Merge runs of consecutive DATA_BYTE messages into DATA_BLOCK messages"""
+    result = []
+    run = []
+    for msg in msgs:
+        if msg.id == NETSIO_DATA_BYTE and len(run) < size:
+            run.append(msg)
+            continue
+        if run:
+            result.append(run[0] if len(run) == 1 else
+                NetSIOMsg(NETSIO_DATA_BLOCK, b''.join([m.arg for m in run])))
+            run = []
+        if msg.id == NETSIO_DATA_BYTE:
+            run.append(msg)
+        else:
+            result.append(msg)
+    if run:
+        result.append(run[0] if len(run) == 1 else
+            NetSIOMsg(NETSIO_DATA_BLOCK, b''.join([m.arg for m in run])))
+    return result
+
+
+class DeviceOutBuffer:
+    """Host to device DATA_BYTE coalescing with flush on size or age
+
+    Data bytes are merged into DATA_BLOCK, any other message flushes buffered bytes
+    first and is passed on right after them. Messages are passed to put() in order."""
+
+    # flush reasons
+    FLUSH_SIZE = 'size'
+    FLUSH_AGE = 'age'
+    FLUSH_FORCED = 'forced'
+
+    def __init__(self, put, max_age, size=COALESCE_SIZE):
+        self.put = put
+        self.max_age = max_age
+        self.size = size
+        self.data = bytearray()
+        self.timestamp = 0.0 # time of first byte in buffer
+        self.lock = threading.Condition()
+        self.flush_lock = threading.RLock() # keeps flushed data in order with other messages
+        self.running = True
+        self.flushes = {self.FLUSH_SIZE: 0, self.FLUSH_AGE: 0, self.FLUSH_FORCED: 0}
+        self.monitor = threading.Thread(target=self.buffer_monitor)
+        self.monitor.start()
+
+    def buffer_monitor(self):
+        debug_print("DeviceOutBuffer monitor started")
+        while True:
+            with self.lock:
+                if not self.running:
+                    break
+                if not len(self.data):
+                    # wait for first byte
+                    self.lock.wait()
+                    continue
+                tmout = self.timestamp + self.max_age - timer()
+                if tmout > 0.0:
+                    self.lock.wait(tmout)
+                    continue
+            self.flush(self.FLUSH_AGE)
+        debug_print("DeviceOutBuffer monitor stopped")
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        self.monitor.join()
+        debug_print("DeviceOutBuffer flushes:", self.flushes)
+
+    def add(self, msg:NetSIOMsg):
+        if msg.id == NETSIO_DATA_BYTE:
+            with self.lock:
+                if not len(self.data):
+                    self.timestamp = timer()
+                    self.lock.notify()
+                self.data += msg.arg
+                l = len(self.data)
+            if l >= self.size:
+                self.flush(self.FLUSH_SIZE)
+            return
+        # sync, command, reset, ... go right after buffered bytes
+        with self.flush_lock:
+            self.flush(self.FLUSH_FORCED)
+            self.put(msg)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def flush(self, reason=FLUSH_FORCED):
+        with self.flush_lock:
+            with self.lock:
+                if not len(self.data):
+                    return
+                if len(self.data) > 1:
+                    msg = NetSIOMsg(NETSIO_DATA_BLOCK, bytes(self.data))
+                else:
+                    msg = NetSIOMsg(NETSIO_DATA_BYTE, self.data[0])
+                self.data.clear()
+                self.flushes[reason] += 1
+            self.put(msg)
+
 
 class NetSIOHub:
     pass
@@ -168,6 +407,9 @@ class DeviceManager():
     def __init__(self, port):
         self.port = port
         self.sync_tmout = 0.1 # 100 ms
+        # host to device DATA_BYTE coalescing window, see DeviceOutBuffer, zero age disables it
+        self.coalesce_age = 0.0
+        self.coalesce_size = COALESCE_SIZE
         pass
 
     def start(self, hub:NetSIOHub):
@@ -179,6 +421,11 @@ class DeviceManager():
     def to_peripheral(self, msg:NetSIOMsg):
         pass
 
+    def to_peripheral_sync(self, msg:NetSIOMsg):
+        """Send sync request, emulator is paused until response arrives. Managers
+        should send it as soon as possible, right after messages sent before."""
+        self.to_peripheral(msg)
+
     def connected(self):
         """Return true if any device is connected"""
         return True
@@ -187,6 +434,10 @@ class DeviceManager():
         """Give credit to connected devices to send more messages"""
         pass
 
+    def stats(self) -> dict:
+        """Device side gauges: device_queue depth and connected clients with credit stats (by address)"""
+        return {}
+
 class HostManager():
     """Manages communication with Atari host / Atari emulator"""
     def __init__(self):
@@ -0,0 +1,88 @@
+# NetSIO hub session recorder
+#  SessionRecorder writes messages crossing the hub (hub --record FILE) into indexed binary file,
+#  read_session() reads it back for replay.py. Hub writes records through record() (netsio.py).
+
+from netsiohub.netsio import *
+
+from timeit import default_timer as timer
+import threading
+import time
+
+
+class SessionRecorder:
+    """Writes messages crossing the hub into indexed binary file
+
+    File: header, records, index (time and file offset of every INDEX_INTERVAL-th record), footer.
+    Index and footer are written on close, file without them is still readable."""
+
+    HEADER = struct.Struct('<4sHd')     # magic, version, start time (epoch)
+    RECORD = struct.Struct('<dBHI')     # time since start, kind, UDP port, data length
+    INDEX = struct.Struct('<dQ')        # time since start, file offset
+    FOOTER = struct.Struct('<4sQI')     # magic, index offset, number of records
+    MAGIC = b'NSRC'
+    INDEX_MAGIC = b'NSIX'
+    VERSION = 1
+    INDEX_INTERVAL = 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+        self.start = timer()
+        self.count = 0
+        self.index = []
+        self.file.write(self.HEADER.pack(self.MAGIC, self.VERSION, time.time()))
+
+    def add(self, kind, data, port):
+        with self.lock:
+            if self.file is None:
+                return
+            ts = timer() - self.start
+            if self.count % self.INDEX_INTERVAL == 0:
+                self.index.append((ts, self.file.tell()))
+            self.file.write(self.RECORD.pack(ts, kind, port, len(data)))
+            self.file.write(data)
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            offset = self.file.tell()
+            for entry in self.index:
+                self.file.write(self.INDEX.pack(*entry))
+            self.file.write(self.FOOTER.pack(self.INDEX_MAGIC, offset, self.count))
+            self.file.close()
+            self.file = None
+
+
+def read_session(path, start:float=0.0):
+    """Read session record, return start time (epoch) and list of (time, kind, port, data)
+    records, starting at time start (seconds since start of recording)"""
+    R = SessionRecorder
+    with open(path, 'rb') as f:
+        content = f.read()
+    magic, version, start_time = R.HEADER.unpack_from(content, 0)
+    if magic != R.MAGIC or version != R.VERSION:
+        raise ValueError("Not a NetSIO HUB session record: {}".format(path))
+    offset = R.HEADER.size
+    end = len(content)
+    if end >= R.HEADER.size + R.FOOTER.size:
+        index_magic, index_offset, count = R.FOOTER.unpack_from(content, end - R.FOOTER.size)
+        if index_magic == R.INDEX_MAGIC:
+            # skip to nearest indexed record
+            for ts, record_offset in R.INDEX.iter_unpack(content[index_offset:end - R.FOOTER.size]):
+                if ts > start:
+                    break
+                offset = record_offset
+            end = index_offset
+    records = []
+    while offset + R.RECORD.size <= end:
+        ts, kind, port, length = R.RECORD.unpack_from(content, offset)
+        offset += R.RECORD.size
+        if offset + length > end:
+            break # truncated record
+        if ts >= start:
+            records.append((ts, kind, port, bytes(content[offset:offset+length])))
+        offset += length
+    return start_time, records
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+# NetSIO hub session replay
+#  Drives the hub from session recorded with hub --record FILE. Replay acts as emulator (fake Altirra),
+#  as NetSIO device(s) (fake FujiNet) or as both. Messages are replayed in recorded order, as fast
+#  as possible or at recorded pace. Every replayed message waits until its side received from the hub
+#  as many messages as it had received when the message was recorded.
+
+from netsiohub.netsio import *
+from netsiohub.recorder import read_session
+from netsiohub.bench import FakeAltirra, FakeDevice, HubProcess, percentile
+
+import collections
+import statistics
+import struct
+import sys
+import threading
+import queue
+import time
+import argparse
+
+
+ATD_COMMAND_NAMES = {
+    0: "None",
+    1: "Debug read byte",
+    2: "Read byte",
+    3: "Write byte",
+    4: "Cold reset",
+    5: "Warm reset",
+    6: "Error",
+    7: "Script event",
+    8: "Script post",
+}
+
+# emulator commands the hub answers with return value
+ATD_CALLS = (1, 2, 3, 4, 5, 7)
+
+
+def describe(kind, port, data) -> str:
+    """Human-readable record content"""
+    if kind in (REC_NET_IN, REC_NET_OUT):
+        if not len(data):
+            return ":{} (empty)".format(port)
+        return ":{} {:02X}:{} {}".format(port, data[0], NetSIOMsg.msg_labels.get(data[0], "UNKNOWN"),
+            " ".join(["{:02X}".format(b) for b in data[1:]]))
+    elif kind == REC_ATD_COMMAND:
+        command, param1, param2, timestamp = ATD_COMMAND.unpack(data)
+        return "{:016X} {}({:08X}, {:08X})".format(
+            timestamp, ATD_COMMAND_NAMES.get(command, "Unknown"), param1, param2 & 0xFFFFFFFF)
+    elif kind == REC_ATD_INTERRUPT:
+        aux1, aux2 = ATD_INTERRUPT.unpack(data)
+        return "{:02X}:{} {:08X} {:08X}".format(
+            aux1 & 0x1FF, NetSIOMsg.msg_labels.get(aux1 & 0x1FF, "UNKNOWN"), aux1, aux2)
+    elif kind == REC_ATD_WRITE:
+        segment, offset = ATD_WRITE.unpack_from(data)
+        payload = data[ATD_WRITE.size:]
+        return "segment {} offset {} [{}] {}".format(segment, offset, len(payload),
+            " ".join(["{:02X}".format(b) for b in payload]))
+    elif kind == REC_ATD_RESULT:
+        return "0x{:08X}".format(ATD_RESULT.unpack(data)[0])
+    return "[{}] {}".format(len(data), " ".join(["{:02X}".format(b) for b in data]))
+
+
+class ReplayEvent:
+    __slots__ = ['ts', 'kind', 'port', 'data', 'seen', 'block', 'result']
+
+    def __init__(self, ts, kind, port, data, seen):
+        self.ts = ts
+        self.kind = kind
+        self.port = port
+        self.data = data
+        self.seen = seen    # messages the sending side had received from hub before this one
+        self.block = None   # rxbuffer content for DATA_BLOCK script event
+        self.result = None  # recorded script event result
+
+
+class Session:
+    """Recorded session prepared for replay"""
+
+    def __init__(self, records, altirra=True, devices=True):
+        self.events = []
+        self.ports = []
+        # recorded sync responses per device port, device answers sync requests with them
+        self.sync_responses = collections.defaultdict(collections.deque)
+        self.duration = records[-1][0] - records[0][0] if records else 0.0
+
+        interrupts = 0
+        received = collections.Counter()
+        calls = collections.deque()  # script events waiting for segment read and result
+        for ts, kind, port, data in records:
+            if kind == REC_ATD_INTERRUPT:
+                interrupts += 1
+            elif kind == REC_NET_OUT:
+                if len(data) and data[0] < NETSIO_CONN_MGMT:
+                    received[port] += 1
+            elif kind == REC_ATD_COMMAND and altirra:
+                command, param1, param2, timestamp = ATD_COMMAND.unpack(data)
+                if command == 6:
+                    continue # error text is not recorded
+                event = ReplayEvent(ts, kind, port, data, interrupts)
+                self.events.append(event)
+                if command == 7:
+                    if param1 & 0x1FF == NETSIO_DATA_BLOCK and compact_size(param1):
+                        event.block = b'' # compact data block, nothing is read from rxbuffer
+                    calls.append(event)
+            elif kind == REC_ATD_READ and altirra:
+                for event in calls:
+                    if event.block is None:
+                        event.block = data
+                        break
+            elif kind == REC_ATD_RESULT and altirra:
+                if calls:
+                    calls.popleft().result = ATD_RESULT.unpack(data)[0]
+            elif kind == REC_NET_IN and devices and len(data):
+                if port not in self.ports:
+                    self.ports.append(port)
+                    if data[0] == NETSIO_DEVICE_CONNECT:
+                        continue # replay connects every device first
+                if data[0] == NETSIO_SYNC_RESPONSE and len(data) >= 6:
+                    self.sync_responses[port].append(struct.unpack('<BBH', data[2:6]))
+                    continue
+                self.events.append(ReplayEvent(ts, kind, port, data, received[port]))
+
+
+class Replay:
+    """Replays prepared session against running hub"""
+
+    def __init__(self, session:Session, args):
+        self.session = session
+        self.speed = args.speed
+        self.wait = args.wait
+        self.received = collections.Counter()
+        self.received_cond = threading.Condition()
+        self.altirra:FakeAltirra = None
+        self.devices = {}
+        self.stats = collections.Counter()
+        self.call_times = []
+        self.mismatches = 0
+
+        if any(e.kind == REC_ATD_COMMAND for e in session.events):
+            self.altirra = FakeAltirra(args.port)
+            # READY is replayed from recording
+            self.altirra.auto_ready = False
+            self.altirra.on_receive = lambda evt, data: self.got_message('atd')
+        for port in session.ports:
+            device = FakeDevice(args.netsio_port)
+            device.on_message = lambda id, arg, port=port: \
+                self.got_message(port) if id < NETSIO_CONN_MGMT else None
+            device.on_sync = lambda id, arg, port=port: self.sync_response(port)
+            device.connect()
+            self.devices[port] = device
+
+    def close(self):
+        for device in self.devices.values():
+            device.close()
+        if self.altirra is not None:
+            self.altirra.close()
+
+    def got_message(self, side):
+        with self.received_cond:
+            self.received[side] += 1
+            self.received_cond.notify_all()
+
+    def sync_response(self, port):
+        responses = self.session.sync_responses[port]
+        if not responses:
+            return (NETSIO_EMPTY_SYNC, 0, 0)
+        return responses.popleft()
+
+    def wait_received(self, side, count) -> bool:
+        with self.received_cond:
+            return self.received_cond.wait_for(lambda: self.received[side] >= count, self.wait)
+
+    def run(self):
+        events = self.session.events
+        if not events:
+            return 0.0
+        start = timer()
+        first_ts = events[0].ts
+        for event in events:
+            if self.speed > 0.0:
+                delay = start + (event.ts - first_ts) / self.speed - timer()
+                if delay > 0.0:
+                    time.sleep(delay)
+            if event.kind == REC_ATD_COMMAND:
+                if not self.wait_received('atd', event.seen):
+                    self.stats['stalls'] += 1
+                self.replay_command(event)
+            else:
+                if not self.wait_received(event.port, event.seen):
+                    self.stats['stalls'] += 1
+                self.devices[event.port].sock.send(event.data)
+                self.stats['datagrams'] += 1
+        return timer() - start
+
+    def replay_command(self, event:ReplayEvent):
+        command, param1, param2, timestamp = ATD_COMMAND.unpack(event.data)
+        if command == 7 and param1 == NETSIO_DATA_BLOCK and event.block is not None:
+            self.altirra.segments[1][0:len(event.block)] = event.block
+        t = timer()
+        self.altirra.send_command(command, param1, param2)
+        self.stats['commands'] += 1
+        if command in ATD_CALLS:
+            try:
+                result = self.altirra.results.get(timeout=self.wait) & 0xFFFFFFFF
+            except queue.Empty:
+                self.stats['timeouts'] += 1
+                return
+            if command == 7:
+                self.call_times.append((timer() - t) * 1e6)
+                if event.result is not None and result != event.result:
+                    self.mismatches += 1
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description =
+            "Replays NetSIO hub session recorded with --record FILE.")
+    arg_parser.add_argument('file', help='Session record file')
+    arg_parser.add_argument('--as', dest='role', default='both', choices=['altirra', 'device', 'both'],
+        help='Replay emulator side, device side or both (default)')
+    arg_parser.add_argument('--speed', type=float, default=0.0,
+        help='Replay speed, 1.0 is recorded pace, 0 is as fast as possible (default)')
+    arg_parser.add_argument('--start', type=float, default=0.0,
+        help='Skip first START seconds of recording')
+    arg_parser.add_argument('--wait', type=float, default=1.0,
+        help='How long to wait for hub before replaying next message, in seconds (default 1.0)')
+    arg_parser.add_argument('--list', action='store_true', help='Print recorded messages and exit')
+    arg_parser.add_argument('--engine', choices=['thread','asyncio'],
+        help='Start hub with given engine for replay, otherwise replay against running hub')
+    arg_parser.add_argument('--port', type=int, default=NETSIO_ATDEV_PORT,
+        help='Hub TCP port for Altirra custom device (default {})'.format(NETSIO_ATDEV_PORT))
+    arg_parser.add_argument('--netsio-port', type=int, default=NETSIO_PORT,
+        help='Hub UDP port for NetSIO devices (default {})'.format(NETSIO_PORT))
+    args = arg_parser.parse_args()
+
+    try:
+        start_time, records = read_session(args.file, args.start)
+    except (OSError, ValueError, struct.error) as e:
+        print(e, file=sys.stderr)
+        return -1
+
+    if args.list:
+        for ts, kind, port, data in records:
+            print("{:12.6f} {:<14} {}".format(ts, REC_LABELS.get(kind, "{:02X}".format(kind)), describe(kind, port, data)))
+        return 0
+
+    session = Session(records, altirra=args.role != 'device', devices=args.role != 'altirra')
+    print("Session: {} records, {:.3f} s, replaying {} messages, {} device(s)".format(
+        len(records), session.duration, len(session.events), len(session.ports)))
+
+    hub = None if args.engine is None else HubProcess(args.engine, args.port, args.netsio_port)
+    replay = None
+    try:
+        replay = Replay(session, args)
+        elapsed = replay.run()
+    finally:
+        if replay is not None:
+            replay.close()
+        if hub is not None:
+            hub.stop()
+
+    print("Replayed in {:.3f} s: {} emulator commands, {} datagrams, {} stalls, {} timeouts".format(
+        elapsed, replay.stats['commands'], replay.stats['datagrams'], replay.stats['stalls'], replay.stats['timeouts']))
+    samples = replay.call_times
+    if samples:
+        print("Script events: {}, result mismatches: {}, latency mean {:.0f} p50 {:.0f} p99 {:.0f} max {:.0f} us".format(
+            len(samples), replay.mismatches, statistics.mean(samples),
+            percentile(samples, 50), percentile(samples, 99), max(samples)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,7 +3,21 @@
 from netsiohub.netsio import *
 import serial
 import threading
+import select
 import time
+import os
+
+
+# serial input is sent to host in blocks up to SER_BUFFER_SIZE bytes
+SER_BUFFER_SIZE = 130
+# max age of buffered input
+SER_BUFFER_MAX_AGE = 0.015 # 15 ms
+# SerPollThread sends buffered input when line is idle for this number of characters
+SER_IDLE_CHARS = 3
+# bytes read at once by SerPollThread
+SER_READ_SIZE = 4096
+# modem lines (PROCEED) check interval, same as read timeout of SerInThread
+SER_LINES_INTERVAL = 0.002 # 2 ms
 
 
 class SerialSIOManager:
@@ -29,8 +43,8 @@ class SerInThread(threading.Thread):
             buffer.extend(_b)
             return ts
 
-        BUFFER_SIZE = 130 # 130 bytes
-        BUFFER_MAX_AGE = 0.015 # 15 ms
+        BUFFER_SIZE = SER_BUFFER_SIZE
+        BUFFER_MAX_AGE = SER_BUFFER_MAX_AGE
 
         proceed_save = self.get_proceed()
 
@@ -39,14 +53,10 @@ class SerInThread(threading.Thread):
         buffer_timestamp = timer()
         msg = None
         errors = 0
+        input_epoch = self.manager.input_epoch
 
         # read data + poll proceed
         while not self.stop_flag.is_set():
-            # anything SerOutThread needs to do?
-            if not self.manager.allow_read.is_set():
-                self.yield_serial_output()
-                continue # repeat (handle output with priority)
-
             # handle proceed signal
             try:
                 proceed = self.get_proceed()
@@ -57,12 +67,10 @@ class SerInThread(threading.Thread):
             else:
                 if proceed != proceed_save:
                     proceed_save = proceed
-                    self.hub.handle_device_msg(
-                        NetSIOMsg(NETSIO_PROCEED_ON if proceed else NETSIO_PROCEED_OFF),
-                        None)
-                    debug_print("< SER PROCEED", "ON" if proceed else "OFF")
+                    self.report_proceed(proceed)
 
             # read (with timeout) bytes from serial port
+            epoch = self.manager.input_epoch
             try:
                 d = self.serial.read(BUFFER_SIZE-len(buffer))
             except Exception as e:
@@ -71,6 +79,13 @@ class SerInThread(threading.Thread):
                 d = bytes()
                 errors += 1
 
+            if epoch != input_epoch or self.manager.input_epoch != epoch:
+                # port was reconfigured, drop what was received at old speed
+                input_epoch = epoch
+                buffer.clear()
+                if self.manager.input_epoch != epoch:
+                    d = bytes()
+
             if errors >= 10:
                 print("Suspending SerInThread")
                 time.sleep(5)
@@ -79,7 +94,7 @@ class SerInThread(threading.Thread):
 
             if len(d):
                 # data was read
-                debug_print("< SER IN [{}] {}".format(len(d), " ".join(["{:02X}".format(b) for b in d])))
+                trace(TRACE_SER_READ, data=d)
                 if self.manager.sync_flag.is_set():
                     # send sync response if sync flag is set
                     msg = NetSIOMsg(NETSIO_SYNC_RESPONSE, bytes((self.manager.sync_num, 1, d[0], 0, 0)))
@@ -98,7 +113,6 @@ class SerInThread(threading.Thread):
                 # read timeout, no new data
                 # if buffer aged send whatever is in buffer
                 if len(buffer) and buffer_age() > BUFFER_MAX_AGE:
-                    debug_print("buffer age: {:.0f}".format(buffer_age() * 1e6))
                     if len(buffer) == 1:
                         msg = NetSIOMsg(NETSIO_DATA_BYTE, buffer)
                     else:
@@ -106,27 +120,201 @@ class SerInThread(threading.Thread):
                     buffer = bytearray() # reset buffer
             # anything to send?
             if msg:
-                debug_print("< SER", msg)
+                trace_msg(TRACE_SER_IN, msg)
                 self.hub.handle_device_msg(msg, None)
                 msg = None
         debug_print("SerInThread stopped")
 
+    def report_proceed(self, proceed:bool):
+        self.hub.handle_device_msg(
+            NetSIOMsg(NETSIO_PROCEED_ON if proceed else NETSIO_PROCEED_OFF),
+            None)
+        debug_print("< SER PROCEED", "ON" if proceed else "OFF")
+
     def stop(self):
         debug_print("Stop SerInThread")
         self.stop_flag.set()
         self.join()
 
-    def yield_serial_output(self):
-        #debug_print("SerIn:  3 - pausing")
-        with self.manager.read_paused:
-            #debug_print("SerIn:  4 - notify SerOut")
-            self.manager.read_paused.notify()
-            #debug_print("SerIn:  5 - notification sent")
-        #debug_print("SerIn:  6 - paused")
-        debug_print("SerIn paused")
-        self.manager.allow_read.wait()
-        #debug_print("SerIn:  9 - resumed")
-        debug_print("SerIn resumed")
+    def wake(self):
+        """Interrupt waiting for serial data, read timeout does it here"""
+        pass
+
+
+class SerPollThread(SerInThread):
+    """Thread to handle incoming serial data, event driven
+
+    Waits with poll() on serial port and on wake pipe (stop, port reconfigured) together,
+    reads all available bytes into reusable buffer. Buffered bytes are sent once the line
+    is idle for SER_IDLE_CHARS characters or when buffer is full or old. PROCEED line is
+    checked every SER_LINES_INTERVAL in the same loop, nothing is left waiting on the port
+    when the thread stops."""
+
+    def __init__(self, manager:SerialSIOManager, hub:NetSIOHub):
+        super().__init__(manager, hub)
+        self.fd = self.serial.fileno()
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self.rxbuffer = bytearray(SER_READ_SIZE)
+        self.buffer = bytearray()
+        self.first_at = 0.0 # first byte in buffer
+        self.last_at = 0.0 # last byte in buffer
+        self.proceed = False
+        self.input_epoch = manager.input_epoch
+        self.lines_at = None # next modem lines check, None if PROCEED is not configured
+
+    def run(self):
+        debug_print("SerPollThread started")
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        poller.register(self.wake_r, select.POLLIN)
+        rxview = memoryview(self.rxbuffer)
+        errors = 0
+        self.start_lines()
+
+        while not self.stop_flag.is_set():
+            deadline = self.deadline()
+            timeout = None if deadline is None else max(0.0, (deadline - timer()) * 1000.0)
+            events = poller.poll(timeout)
+
+            for fd, event in events:
+                if fd == self.wake_r:
+                    try:
+                        os.read(self.wake_r, 64)
+                    except BlockingIOError:
+                        pass
+                    continue
+                epoch = self.manager.input_epoch
+                try:
+                    n = os.readv(self.fd, (rxview,))
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    print("Serial port error:", e)
+                    errors += 1
+                    continue
+                if self.manager.input_epoch != epoch:
+                    # port was reconfigured while reading, bytes can be at old speed
+                    continue
+                if epoch != self.input_epoch:
+                    self.discard(epoch)
+                if n:
+                    self.received(rxview[:n])
+                elif event & (select.POLLHUP | select.POLLERR):
+                    print("Serial port error: hang up")
+                    errors += 1
+
+            if errors >= 10:
+                print("Suspending SerPollThread")
+                time.sleep(5)
+                print("SerPollThread resumed")
+                errors = 0
+
+            if self.manager.input_epoch != self.input_epoch:
+                self.discard(self.manager.input_epoch)
+
+            now = timer()
+            if len(self.buffer) and (now - self.last_at >= self.idle_time() or now - self.first_at >= SER_BUFFER_MAX_AGE):
+                self.flush()
+            if self.lines_at is not None and now >= self.lines_at:
+                self.lines_at = now + SER_LINES_INTERVAL
+                self.check_proceed()
+
+        poller.unregister(self.fd)
+        debug_print("SerPollThread stopped")
+
+    def deadline(self):
+        """Time of next buffer flush or modem lines check, None if there is nothing to wait for"""
+        deadline = self.lines_at
+        if len(self.buffer):
+            flush_at = min(self.last_at + self.idle_time(), self.first_at + SER_BUFFER_MAX_AGE)
+            if deadline is None or flush_at < deadline:
+                deadline = flush_at
+        return deadline
+
+    def idle_time(self) -> float:
+        """Line idle time, in seconds, after which buffered bytes are sent"""
+        return SER_IDLE_CHARS * 10.0 / self.serial.baudrate
+
+    def received(self, d:memoryview):
+        trace(TRACE_SER_READ, data=d)
+        now = timer()
+        if self.manager.sync_flag.is_set():
+            # send sync response if sync flag is set
+            msg = NetSIOMsg(NETSIO_SYNC_RESPONSE, bytes((self.manager.sync_num, 1, d[0], 0, 0)))
+            self.manager.sync_flag.clear()
+            debug_print("= SER SYNC OFF")
+            self.send(msg)
+            # keep the rest in buffer
+            d = d[1:]
+            if not len(d):
+                return
+        if not len(self.buffer):
+            self.first_at = now
+        self.last_at = now
+        self.buffer += d
+        # send full blocks
+        while len(self.buffer) >= SER_BUFFER_SIZE:
+            msg = NetSIOMsg(NETSIO_DATA_BLOCK, self.buffer[:SER_BUFFER_SIZE])
+            del self.buffer[:SER_BUFFER_SIZE]
+            self.first_at = now
+            self.send(msg)
+
+    def flush(self):
+        if len(self.buffer) == 1:
+            msg = NetSIOMsg(NETSIO_DATA_BYTE, self.buffer)
+        else:
+            msg = NetSIOMsg(NETSIO_DATA_BLOCK, self.buffer)
+        self.buffer = bytearray() # reset buffer
+        self.send(msg)
+
+    def discard(self, epoch):
+        """Port was reconfigured, drop input received at old speed"""
+        self.input_epoch = epoch
+        if len(self.buffer):
+            debug_print("= SER DROP", len(self.buffer))
+            self.buffer.clear()
+
+    def send(self, msg:NetSIOMsg):
+        trace_msg(TRACE_SER_IN, msg)
+        self.hub.handle_device_msg(msg, None)
+
+    def start_lines(self):
+        """Read PROCEED line and start checking it"""
+        if self.get_proceed == self.manager.get_false:
+            return
+        try:
+            self.proceed = self.get_proceed()
+        except OSError as e:
+            print("PROCEED is not available:", e)
+            return
+        self.lines_at = timer() + SER_LINES_INTERVAL
+
+    def check_proceed(self):
+        try:
+            proceed = self.get_proceed()
+        except OSError as e:
+            print("Serial port error:", e)
+            return
+        if proceed != self.proceed:
+            self.proceed = proceed
+            self.report_proceed(proceed)
+
+    def stop(self):
+        debug_print("Stop SerPollThread")
+        self.stop_flag.set()
+        self.wake()
+        self.join()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def wake(self):
+        """Interrupt poll(), e.g. to stop or to drop input after port was reconfigured"""
+        try:
+            os.write(self.wake_w, b'\0')
+        except BlockingIOError:
+            pass # pipe is full, wake up is pending anyway
 
 
 class SerOutThread(threading.Thread):
@@ -142,13 +330,11 @@ class SerOutThread(threading.Thread):
     def run(self):
         debug_print("SerOutThread started")
         self.assert_command(False)
-        self.manager.read_paused.acquire()
         while True:
             msg = self.queue.get()
             if msg is None:
                 break
             self.update_serial_port(msg)
-        self.manager.read_paused.release()
         debug_print("SerOutThread stopped")
 
     def stop(self):
@@ -157,17 +343,6 @@ class SerOutThread(threading.Thread):
         self.queue.put(None) # stop sign
         self.join()
 
-    def pause_serial_input(self):
-        #debug_print("SerOut: 1 - pause SerIn")
-        self.manager.allow_read.clear()
-        #debug_print("SerOut: 2 - wait for SerIn")
-        self.manager.read_paused.wait()
-        #debug_print("SerOut: 7 - notification received")
-
-    def resume_serial_input(self):
-        #debug_print("SerOut: 8 - resume SerIn")
-        self.manager.allow_read.set()
-
     def update_serial_port(self, msg:NetSIOMsg):
         if msg.id in (NETSIO_COMMAND_OFF, NETSIO_COMMAND_OFF_SYNC):
             self.assert_command(False)
@@ -184,34 +359,23 @@ class SerOutThread(threading.Thread):
                 self.manager.sync_num = msg.arg[1]
                 self.manager.sync_flag.set()
                 debug_print("= SER SYNC ON")
-            debug_print("> SER OUT +{:.0f} [{}] {}".format(
-                        msg.elapsed_us(), len(msg.arg), msg.arg_str()))
+            trace_msg(TRACE_SER_OUT, msg)
         elif msg.id == NETSIO_COMMAND_ON:
-            #self.pause_serial_input()
             #self.serial.reset_input_buffer()
             #self.serial.reset_output_buffer()
             self.assert_command(True)
             debug_print("> SER COMMAND ON")
-            #self.resume_serial_input()
         elif msg.id == NETSIO_SPEED_CHANGE:
             # host changed port speed
-            baud = struct.unpack('<L', msg.arg)[0]
-            self.pause_serial_input()
-            self.serial.reset_input_buffer()
-            self.serial.reset_output_buffer()
-            self.serial.baudrate = int(baud*0.979)
-            debug_print("= SER SPEED {} ({})".format(baud, int(baud*0.97)))
+            baud = SPEED_ARG.unpack(msg.arg)[0]
+            self.manager.reconfigure(int(baud*0.979))
+            debug_print("= SER SPEED {} ({})".format(baud, int(baud*0.979)))
             # notify host that device changed speed too (let's hope)
             self.hub.handle_device_msg(msg, None)
-            self.resume_serial_input()
         elif msg.id in (NETSIO_WARM_RESET, NETSIO_COLD_RESET):
-            self.pause_serial_input()
-            self.serial.reset_input_buffer()
-            self.serial.reset_output_buffer()
-            self.serial.baudrate = 19200
             self.manager.sync_flag.clear()
+            self.manager.reconfigure(19200)
             debug_print("= SER RESET")
-            self.resume_serial_input()
 
 
 class SerialSIOManager(DeviceManager):
@@ -227,12 +391,16 @@ class SerialSIOManager(DeviceManager):
         self.out_thread:threading.Thread = None
         self.serial:serial.Serial = None
         self.lock = threading.Lock()
-        self.allow_read = threading.Event()
-        self.read_paused = threading.Condition()
+        # incremented by SerOutThread when port is reconfigured, readers drop older input
+        self.input_epoch = 0
+        self.speed_at = 0.0 # time new speed took effect
+        self.speed_changes = 0
+        self.speed_switch = 0.0 # duration of last reconfiguration
         self.command_on = command_on.upper()
         self.proceed_on = proceed_on.upper()
         self.assert_command = self.set_none
         self.get_proceed = self.get_false
+        self.outbuffer:DeviceOutBuffer = None
 
     def start(self, hub):
         # open serial port and start threads
@@ -261,15 +429,30 @@ class SerialSIOManager(DeviceManager):
                 print("DSR <- PROCEED")
             else:
                 print("PROCEED not configured!")
-            # serial port receiver
-            self.allow_read.set()
-            self.in_thread = SerInThread(self, hub)
+            try:
+                self.serial.cts
+            except OSError as e:
+                # e.g. pseudo terminal, there are no modem lines
+                print("Modem lines are not available:", e)
+                self.assert_command = self.set_none
+                self.get_proceed = self.get_false
+            # serial port receiver, event driven where port can be polled
+            if self.pollable():
+                self.in_thread = SerPollThread(self, hub)
+            else:
+                self.in_thread = SerInThread(self, hub)
             self.in_thread.start()
             # serial port sender
             self.out_thread = SerOutThread(self, hub, self.device_queue)
             self.out_thread.start()
+            # data bytes coalescing, merged bytes go out with one serial write
+            if self.coalesce_age > 0.0:
+                self.outbuffer = DeviceOutBuffer(self.queue_msg, self.coalesce_age, self.coalesce_size)
 
     def stop(self):
+        if self.outbuffer:
+            self.outbuffer.stop()
+            self.outbuffer = None
         if self.in_thread:
             self.in_thread.stop()
             self.in_thread = None
@@ -280,6 +463,32 @@ class SerialSIOManager(DeviceManager):
             self.serial.close()
             self.serial = None
 
+    def reconfigure(self, baudrate:int):
+        """Set port speed and drop buffered data, called by SerOutThread only
+
+        Readers are not paused, they drop input received before input_epoch changed."""
+        t = timer()
+        self.serial.reset_output_buffer()
+        if self.serial.baudrate != baudrate:
+            self.serial.baudrate = baudrate
+            self.speed_changes += 1
+        self.serial.reset_input_buffer()
+        self.speed_at = timer()
+        self.input_epoch += 1
+        self.in_thread.wake()
+        self.speed_switch = self.speed_at - t
+        trace(TRACE_SER_SPEED, aux=int(self.speed_switch * 1e6), value=baudrate)
+
+    def pollable(self) -> bool:
+        """Return true if serial port file descriptor can be waited for with poll()"""
+        if not hasattr(select, 'poll'):
+            return False
+        try:
+            self.serial.fileno()
+        except (OSError, AttributeError):
+            return False
+        return True
+
     def set_none(self, value:bool):
         pass
 
@@ -303,13 +512,26 @@ class SerialSIOManager(DeviceManager):
             debug_print("CLEAR DEV QUEUE")
             clear_queue(self.device_queue)
 
-        if self.device_queue.full():
-            debug_print("device queue FULL")
+        if self.outbuffer is not None:
+            # data bytes are merged, other messages flush them
+            self.outbuffer.add(msg)
         else:
-            debug_print("device queue [{}]".format(self.device_queue.qsize()))
+            self.queue_msg(msg)
 
+    def queue_msg(self, msg):
+        trace_msg(TRACE_DEVICE_QUEUE, msg, value=self.device_queue.qsize())
+        if self.device_queue.full():
+            metric_event(METRIC_QUEUE_FULL)
         self.device_queue.put(msg)
         # debug_print("> DEV", msg)
 
     def connected(self):
         return True
+
+    def stats(self) -> dict:
+        return {
+            'device_queue': self.device_queue.qsize(),
+            'speed': self.serial.baudrate if self.serial else 0,
+            'speed_changes': self.speed_changes,
+            'speed_switch_us': int(self.speed_switch * 1e6),
+        }
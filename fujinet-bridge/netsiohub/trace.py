@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""NetSIO HUB trace ring buffer, decode binary trace dump (hub --trace FILE) into human-readable text"""
+
+from netsiohub.netsio import *
+
+from datetime import datetime
+from timeit import default_timer as timer
+import argparse
+import itertools
+import sys
+import time
+
+
+class TraceBuffer:
+    """Ring buffer with fixed size binary trace records"""
+
+    # timestamp, trace point, message id, length, UDP port, aux (elapsed us), value, first bytes
+    RECORD = struct.Struct('<dBxHHHII8s')
+    HEADER = struct.Struct('<4sHHIdd')
+    MAGIC = b'NSTR'
+    VERSION = 1
+
+    def __init__(self, size=TRACE_SIZE):
+        self.size = size
+        self.buffer = bytearray(size * self.RECORD.size)
+        self.counter = itertools.count()
+        self.pack_into = self.RECORD.pack_into
+        self.start = timer()
+        self.start_time = time.time()
+
+    def add(self, point, id, data, port, aux, value):
+        self.pack_into(self.buffer, (next(self.counter) % self.size) * self.RECORD.size,
+            timer(), point, id, len(data) & 0xFFFF, port, aux & 0xFFFFFFFF, value & 0xFFFFFFFF, bytes(data[:8]))
+
+    def dump(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD.size, self.size, self.start, self.start_time))
+            f.write(self.buffer)
+
+
+def read_trace_records(path):
+    """Read trace dump, return start timer, start wall clock time and records in time order"""
+    with open(path, 'rb') as f:
+        magic, version, record_size, size, start, start_time = TraceBuffer.HEADER.unpack(
+            f.read(TraceBuffer.HEADER.size))
+        if magic != TraceBuffer.MAGIC or version != TraceBuffer.VERSION or record_size != TraceBuffer.RECORD.size:
+            raise ValueError("Not a NetSIO HUB trace file: {}".format(path))
+        records = [r for r in TraceBuffer.RECORD.iter_unpack(f.read(size * record_size)) if r[0] != 0.0]
+    records.sort(key=lambda r: r[0])
+    return start, start_time, records
+
+
+def read_trace(path):
+    """Read trace dump, return list of lines in time order"""
+    start, start_time, records = read_trace_records(path)
+    lines = []
+    for ts, point, id, length, port, aux, value, data in records:
+        lines.append("{} {}".format(
+            datetime.fromtimestamp(start_time + ts - start).strftime("%H:%M:%S.%f"),
+            trace_str(point, id, length, port, aux, value, data[:length])))
+    return lines
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Decode NetSIO HUB binary trace dump.")
+    arg_parser.add_argument('file', help='Trace file written by hub --trace FILE')
+    arg_parser.add_argument('-n', '--tail', type=int, default=0,
+        help='Print only last N records')
+    args = arg_parser.parse_args()
+
+    try:
+        lines = read_trace(args.file)
+    except (OSError, ValueError, struct.error) as e:
+        print(e, file=sys.stderr)
+        return -1
+
+    if args.tail > 0:
+        lines = lines[-args.tail:]
+    for line in lines:
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import pytest
+
+from netsiohub.codec import *
+
+
+def test_decode_id_only():
+    msg = decode(BYTES[NETSIO_COMMAND_ON])
+    assert msg.id == NETSIO_COMMAND_ON
+    assert msg.arg == b''
+
+
+def test_decode_single_byte():
+    msg = decode(b'\x01\x41')
+    assert msg.id == NETSIO_DATA_BYTE
+    assert msg.arg is BYTES[0x41]
+
+
+def test_decode_short_block_is_copied():
+    data = BYTES[NETSIO_DATA_BLOCK] + bytes(range(SHORT_BLOCK))
+    msg = decode(data)
+    assert type(msg.arg) is bytes
+    assert msg.arg == data[1:]
+
+
+def test_decode_long_block_refers_to_datagram():
+    data = bytearray(BYTES[NETSIO_DATA_BLOCK] + bytes(SHORT_BLOCK + 1))
+    msg = decode(data)
+    assert type(msg.arg) is memoryview
+    data[1] = 0xFF
+    assert msg.arg[0] == 0xFF
+
+
+@pytest.mark.parametrize('arg', [b'', b'\x55', bytes(range(SHORT_BLOCK)), bytes(range(200))])
+def test_encode_decode(arg):
+    msg = decode(encode(NetSIOMsg(NETSIO_DATA_BLOCK, arg)))
+    assert msg.id == NETSIO_DATA_BLOCK
+    assert bytes(msg.arg) == arg
+
+
+def test_encode_int_arg():
+    assert encode(NetSIOMsg(NETSIO_DATA_BYTE, 0x41)) == b'\x01\x41'
+
+
+def test_encode_decode_arg():
+    msg = encode_arg(NETSIO_SYNC_RESPONSE, 7, NETSIO_ACK_SYNC, 0x41, 129)
+    assert encode(msg) == b'\x81\x07\x01\x41\x81\x00'
+    assert decode_arg(decode(encode(msg))) == (7, NETSIO_ACK_SYNC, 0x41, 129)
+
+
+@pytest.mark.parametrize('size', range(COMPACT_SIZE + 1))
+def test_compact_roundtrip(size):
+    data = bytes(range(0xF0, 0xF0 + size))
+    aux1, aux2 = compact_pack(ATDEV_TRANSMIT_BUFFER, data)
+    assert aux1 & 0x1FF == ATDEV_TRANSMIT_BUFFER
+    assert 0 <= aux1 <= 0xFFFFFFFF and 0 <= aux2 <= 0xFFFFFFFF
+    assert compact_size(aux1) == size
+    assert compact_unpack(aux1, aux2) == data
+
+
+def test_compact_empty_block_is_plain_event():
+    assert compact_pack(NETSIO_DATA_BLOCK, b'') == (NETSIO_DATA_BLOCK, 0)
+    assert compact_size(NETSIO_DATA_BLOCK) == 0
+
+
+def test_compact_full_block():
+    aux1, aux2 = compact_pack(NETSIO_DATA_BLOCK, b'\xFF' * COMPACT_SIZE)
+    assert aux2 == 0xFFFFFFFF
+    assert compact_unpack(aux1, aux2) == b'\xFF' * COMPACT_SIZE
+
+
+def test_compact_too_long():
+    with pytest.raises(ValueError):
+        compact_pack(NETSIO_DATA_BLOCK, bytes(COMPACT_SIZE + 1))
+
+
+def test_batch_roundtrip():
+    packets = [encode(NetSIOMsg(NETSIO_DATA_BYTE, i)) for i in range(10)]
+    datagrams = batch_pack(packets)
+    assert len(datagrams) == 1
+    assert datagrams[0][0] == NETSIO_BATCH
+    assert batch_unpack(datagrams[0]) == packets
+
+
+def test_batch_single_packet_is_not_wrapped():
+    packet = encode(NetSIOMsg(NETSIO_DATA_BYTE, 1))
+    assert batch_pack([packet]) == [packet]
+
+
+def test_batch_split_by_size():
+    packets = [bytes((NETSIO_DATA_BLOCK,)) + bytes(200) for i in range(5)]
+    datagrams = batch_pack(packets)
+    assert all(len(d) <= NETSIO_BATCH_SIZE for d in datagrams)
+    unpacked = []
+    for d in datagrams:
+        # batch of one packet is the packet itself
+        unpacked += batch_unpack(d) if d[0] == NETSIO_BATCH else [d]
+    assert unpacked == packets
+
+
+def test_batch_long_packet_goes_alone():
+    short = encode(NetSIOMsg(NETSIO_DATA_BYTE, 1))
+    long = bytes((NETSIO_DATA_BLOCK,)) + bytes(NETSIO_BATCH_MSG_SIZE)
+    datagrams = batch_pack([short, short, long, short])
+    assert datagrams[1] == long
+    assert batch_unpack(datagrams[0]) == [short, short]
+    assert datagrams[2] == short
+
+
+def test_batch_truncated():
+    packets = [encode(NetSIOMsg(NETSIO_DATA_BYTE, i)) for i in range(3)]
+    datagram = batch_pack(packets)[0]
+    assert batch_unpack(datagram[:-1]) == packets[:2]
+    # zero length ends batch
+    assert batch_unpack(bytes((NETSIO_BATCH, 2)) + packets[0] + b'\x00' + packets[1]) == packets[:1]
@@ -0,0 +1,66 @@
+from netsiohub.hub import *
+
+
+class Hub:
+    """Collects messages composite passes to host"""
+
+    def __init__(self):
+        self.msgs = []
+
+    def handle_device_msg(self, msg, device):
+        self.msgs.append((msg.id, bytes(msg.arg), device))
+
+
+class EchoManager(DeviceManager):
+    """Local backend echoing speed change like serial port or disk drives do"""
+
+    def __init__(self, port):
+        super().__init__(port)
+        self.received = []
+
+    def start(self, hub):
+        self.hub = hub
+
+    def to_peripheral(self, msg):
+        self.received.append(msg.id)
+        if msg.id == NETSIO_SPEED_CHANGE:
+            self.hub.handle_device_msg(msg, None)
+
+
+def composite(count=3):
+    managers = [EchoManager("echo{}".format(i)) for i in range(count)]
+    cm = CompositeDeviceManager(managers)
+    cm.start(Hub())
+    return cm, managers
+
+
+def speed(baud) -> NetSIOMsg:
+    return NetSIOMsg(NETSIO_SPEED_CHANGE, SPEED_ARG.pack(baud))
+
+
+def test_speed_change_echoed_once():
+    cm, managers = composite()
+    cm.to_peripheral(speed(57600))
+    cm.to_peripheral(speed(19200))
+    assert all(m.received == [NETSIO_SPEED_CHANGE] * 2 for m in managers)
+    assert cm.hub.msgs == [
+        (NETSIO_SPEED_CHANGE, SPEED_ARG.pack(57600), None),
+        (NETSIO_SPEED_CHANGE, SPEED_ARG.pack(19200), None),
+    ]
+
+
+def test_stale_speed_echo_dropped():
+    cm, managers = composite(2)
+    a, b = cm.backends
+    cm.to_peripheral(speed(57600))
+    # late echo of previous speed from slow backend
+    cm.from_backend(b, speed(19200), None)
+    assert cm.hub.msgs == [(NETSIO_SPEED_CHANGE, SPEED_ARG.pack(57600), None)]
+
+
+def test_device_speed_change_passed():
+    cm, managers = composite(2)
+    device = object()
+    cm.from_backend(cm.backends[0], speed(57600), device)
+    cm.from_backend(cm.backends[1], speed(57600), device)
+    assert len(cm.hub.msgs) == 2
@@ -0,0 +1,187 @@
+import pytest
+
+from netsiohub import disk
+from netsiohub.disk import *
+
+
+def write_image(path, sector_size, sectors, packed=True):
+    """ATR with numbered sectors, first two bytes of every sector are its number"""
+    data = bytearray()
+    for sector in range(1, sectors + 1):
+        size = 128 if sector <= BOOT_SECTORS and (packed or sector_size == 128) else sector_size
+        data += struct.pack('<H', sector) + bytes(size - 2)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<HHHB9x', ATR_MAGIC, (len(data) // 16) & 0xFFFF, sector_size, len(data) // 16 >> 16))
+        f.write(data)
+    return str(path)
+
+
+class Hub:
+    """Collects messages disk manager sends to host"""
+
+    def __init__(self):
+        self.msgs = []
+
+    def handle_device_msg(self, msg, client):
+        self.msgs.append(msg)
+
+
+@pytest.fixture
+def drives():
+    managers = []
+    def open_drives(units):
+        manager = LocalDiskManager(units)
+        manager.start(Hub())
+        managers.append(manager)
+        return manager
+    yield open_drives
+    for manager in managers:
+        manager.stop()
+
+
+def command(manager, device_id, command, aux, sn=1) -> list:
+    """Send command frame, return messages to host"""
+    frame = bytes((device_id, command, aux & 0xFF, aux >> 8))
+    manager.hub.msgs.clear()
+    manager.to_peripheral(NetSIOMsg(NETSIO_COMMAND_ON))
+    manager.to_peripheral(NetSIOMsg(NETSIO_DATA_BLOCK, frame + bytes((sio_checksum(frame),))))
+    manager.to_peripheral_sync(NetSIOMsg(NETSIO_COMMAND_OFF_SYNC, bytes((sn,))))
+    return list(manager.hub.msgs)
+
+
+def data_frame(manager, data, checksum=None, sn=2) -> list:
+    """Send data frame, return messages to host"""
+    manager.hub.msgs.clear()
+    manager.to_peripheral(NetSIOMsg(NETSIO_DATA_BLOCK, data))
+    if checksum is None:
+        checksum = sio_checksum(data)
+    manager.to_peripheral_sync(NetSIOMsg(NETSIO_DATA_BYTE_SYNC, bytes((checksum, sn))))
+    return list(manager.hub.msgs)
+
+
+def ack_of(msgs, sn=1):
+    """ACK/NAK byte and write size from sync response"""
+    assert msgs[0].id == NETSIO_SYNC_RESPONSE
+    rsn, kind, ack, write_size = struct.unpack('<BBBH', msgs[0].arg)
+    assert rsn == sn and kind == NETSIO_ACK_SYNC
+    return ack, write_size
+
+
+@pytest.mark.parametrize('packed', [True, False])
+def test_double_density_boot_sectors(tmp_path, packed):
+    image = DiskImage(write_image(tmp_path / 'dd.atr', 256, 720, packed))
+    try:
+        assert image.sectors == 720
+        for sector in (1, 2, 3):
+            data = image.read(sector)
+            assert len(data) == 128
+            assert data[:2] == struct.pack('<H', sector)
+        for sector in (4, 720):
+            data = image.read(sector)
+            assert len(data) == 256
+            assert data[:2] == struct.pack('<H', sector)
+    finally:
+        image.close()
+
+
+def test_xfd_density(tmp_path):
+    path = tmp_path / 'disk.xfd'
+    path.write_bytes(bytes(XFD_ED_SIZE))
+    image = DiskImage(str(path))
+    try:
+        assert image.sector_size == 128
+        assert image.sectors == 1040
+        assert image.status()[0] & 0x80 # enhanced density
+    finally:
+        image.close()
+
+
+def test_read(drives, tmp_path):
+    manager = drives({1: write_image(tmp_path / 'sd.atr', 128, 720)})
+    msgs = command(manager, SIO_DISK1, SIO_READ, 720)
+    assert ack_of(msgs) == (SIO_ACK, 0)
+    block = msgs[1].arg
+    assert msgs[1].id == NETSIO_DATA_BLOCK
+    assert block[0] == SIO_COMPLETE
+    assert block[1:3] == struct.pack('<H', 720)
+    assert block[-1] == sio_checksum(block[1:-1])
+
+
+@pytest.mark.parametrize('sector', [0, 721])
+def test_read_invalid_sector_naks(drives, tmp_path, sector):
+    manager = drives({1: write_image(tmp_path / 'sd.atr', 128, 720)})
+    msgs = command(manager, SIO_DISK1, SIO_READ, sector)
+    assert len(msgs) == 1
+    assert ack_of(msgs) == (SIO_NAK, 0)
+    assert manager.errors == 1
+
+
+def test_other_device_is_empty(drives, tmp_path):
+    manager = drives({1: write_image(tmp_path / 'sd.atr', 128, 720)})
+    msgs = command(manager, SIO_DISK1 + 1, SIO_READ, 1)
+    assert [m.arg for m in msgs] == [bytes((1, NETSIO_EMPTY_SYNC, 0, 0, 0))]
+
+
+def test_write(drives, tmp_path):
+    path = write_image(tmp_path / 'dd.atr', 256, 720)
+    manager = drives({2: path})
+    assert ack_of(command(manager, SIO_DISK1 + 1, SIO_WRITE, 10)) == (SIO_ACK, 257)
+    data = bytes(i & 0xFF for i in range(256))
+    msgs = data_frame(manager, data)
+    assert ack_of(msgs, 2) == (SIO_ACK, 0)
+    assert msgs[1].arg == bytes((SIO_COMPLETE,))
+    manager.stop()
+    with open(path, 'rb') as f:
+        f.seek(ATR_HEADER_SIZE + 3 * 128 + 6 * 256)
+        assert f.read(256) == data
+
+
+def test_write_bad_checksum_naks(drives, tmp_path):
+    path = write_image(tmp_path / 'sd.atr', 128, 720)
+    manager = drives({1: path})
+    command(manager, SIO_DISK1, SIO_PUT, 5)
+    data = bytes(range(128))
+    msgs = data_frame(manager, data, sio_checksum(data) ^ 1)
+    assert len(msgs) == 1
+    assert ack_of(msgs, 2) == (SIO_NAK, 0)
+    assert manager.drives[SIO_DISK1].read(5)[:2] == struct.pack('<H', 5)
+
+
+def test_write_read_only_errors(drives, tmp_path, monkeypatch):
+    path = write_image(tmp_path / 'sd.atr', 128, 720)
+    # permissions do not stop root, refuse write access the way the OS would
+    def read_only_open(file, mode='r', *args, **kwargs):
+        if '+' in mode or 'w' in mode:
+            raise PermissionError(file)
+        return open(file, mode, *args, **kwargs)
+    monkeypatch.setattr(disk, 'open', read_only_open, raising=False)
+    manager = drives({1: path})
+    drive = manager.drives[SIO_DISK1]
+    assert drive.readonly
+    assert drive.status()[0] & 0x08
+    command(manager, SIO_DISK1, SIO_WRITE, 5)
+    msgs = data_frame(manager, bytes(128))
+    assert ack_of(msgs, 2) == (SIO_ACK, 0)
+    assert msgs[1].arg == bytes((SIO_ERROR,))
+    assert drive.read(5)[:2] == struct.pack('<H', 5)
+
+
+def test_speed_change_is_echoed(drives, tmp_path):
+    manager = drives({1: write_image(tmp_path / 'sd.atr', 128, 720)})
+    manager.to_peripheral(NetSIOMsg(NETSIO_SPEED_CHANGE, SPEED_ARG.pack(57600)))
+    assert [(m.id, m.arg) for m in manager.hub.msgs] == [(NETSIO_SPEED_CHANGE, SPEED_ARG.pack(57600))]
+
+
+def test_parse_disk_args():
+    assert parse_disk_args(['a.atr', 'D1=b.atr', 'd3:c.atr', 'e.atr']) == \
+        {1: 'b.atr', 3: 'c.atr', 2: 'a.atr', 4: 'e.atr'}
+
+
+def test_parse_disk_args_duplicate_drive():
+    with pytest.raises(ValueError):
+        parse_disk_args(['D2=a.atr', 'd2:b.atr'])
+
+
+def test_parse_disk_args_no_free_drive():
+    with pytest.raises(ValueError):
+        parse_disk_args(['D{}=d{}.atr'.format(i, i) for i in range(1, 9)] + ['extra.atr'])
@@ -0,0 +1,84 @@
+from netsiohub.hub import *
+
+
+class Server:
+    """Client registry of NetSIOServer"""
+
+    def __init__(self):
+        self.clients = {}
+        self.expired = []
+
+    def connect(self, port, expiry, expire_in=ALIVE_EXPIRATION) -> NetSIOClient:
+        client = NetSIOClient(('127.0.0.1', port), None)
+        client.expire_time = timer() + expire_in
+        self.clients[client.address] = client
+        expiry.add(client)
+        return client
+
+    def deregister_client(self, address, expired=False):
+        self.expired.append(self.clients.pop(address))
+
+
+class ManualExpiry(ClientExpiry):
+    """Expiry driven by the test, no monitor thread"""
+
+    def start_monitor(self):
+        pass
+
+
+def test_passed_deadline_expires():
+    server = Server()
+    expiry = ManualExpiry(server)
+    a = server.connect(1, expiry, -1.0)
+    b = server.connect(2, expiry)
+    expiry.expire()
+    assert server.expired == [a]
+    assert [entry[2] for entry in expiry.heap] == [b]
+
+
+def test_refreshed_client_is_rearmed():
+    server = Server()
+    expiry = ManualExpiry(server)
+    a = server.connect(1, expiry, -1.0)
+    # entry comes due, client was refreshed meanwhile
+    a.refresh()
+    expiry.expire()
+    assert server.expired == []
+    assert len(expiry.heap) == 1
+    deadline, seq, client = expiry.heap[0]
+    assert client is a and deadline == a.expire_time
+
+
+def test_stale_entry_of_reconnected_client_is_skipped():
+    server = Server()
+    expiry = ManualExpiry(server)
+    old = server.connect(1, expiry, -1.0)
+    # same address connects again before old entry comes due
+    new = server.connect(1, expiry)
+    expiry.expire()
+    assert server.expired == []
+    assert server.clients[new.address] is new
+    assert [entry[2] for entry in expiry.heap] == [new]
+
+
+def test_disconnected_client_entry_is_dropped():
+    server = Server()
+    expiry = ManualExpiry(server)
+    a = server.connect(1, expiry, -1.0)
+    del server.clients[a.address]
+    expiry.expire()
+    assert server.expired == []
+    assert expiry.heap == []
+
+
+def test_monitor_expires_client():
+    server = Server()
+    expiry = ClientExpiry(server)
+    try:
+        a = server.connect(1, expiry, 0.05)
+        deadline = timer() + 5.0
+        while not server.expired and timer() < deadline:
+            time.sleep(0.01)
+        assert server.expired == [a]
+    finally:
+        expiry.stop()
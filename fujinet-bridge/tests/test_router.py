@@ -0,0 +1,142 @@
+from netsiohub.hub import *
+
+
+class Client:
+    def __init__(self, port):
+        self.address = ('127.0.0.1', port)
+
+
+def command(router, device_id, sn, command=SIO_WRITE, aux=1):
+    """Route command frame with sync request, return destinations"""
+    frame = bytes((device_id, command, aux & 0xFF, aux >> 8))
+    frame += bytes((sio_checksum(frame),))
+    return route(router, [
+        NetSIOMsg(NETSIO_COMMAND_ON),
+        NetSIOMsg(NETSIO_DATA_BLOCK, frame),
+        NetSIOMsg(NETSIO_COMMAND_OFF_SYNC, bytes((sn,))),
+    ])
+
+
+def route(router, msgs) -> list:
+    """Destination of every message"""
+    dest = []
+    for client, count in router.route(msgs):
+        dest += [client] * count
+    return dest
+
+
+def ack(sn, write_size=0, ack=SIO_ACK) -> NetSIOMsg:
+    return NetSIOMsg(NETSIO_SYNC_RESPONSE, struct.pack('<BBBH', sn, NETSIO_ACK_SYNC, ack, write_size))
+
+
+def empty(sn) -> NetSIOMsg:
+    return NetSIOMsg(NETSIO_SYNC_RESPONSE, bytes((sn, NETSIO_EMPTY_SYNC, 0, 0, 0)))
+
+
+def test_command_frame_is_broadcast():
+    router = SioRouter()
+    assert command(router, 0x31, 1) == [None, None, None]
+
+
+def test_owner_learned_from_ack():
+    router = SioRouter()
+    a, b = Client(1), Client(2)
+    command(router, 0x31, 1)
+    router.response(b, empty(1))
+    router.response(a, ack(1, 129))
+    assert router.owners == {0x31: a}
+    # data frame goes to owner only
+    assert route(router, [NetSIOMsg(NETSIO_DATA_BLOCK, bytes(128)),
+        NetSIOMsg(NETSIO_DATA_BYTE_SYNC, bytes((0, 2)))]) == [a, a]
+    # next command to the same device ID is unicast right away
+    command(router, 0x31, 3)
+    assert router.target is a
+
+
+def test_empty_response_forgets_owner():
+    router = SioRouter()
+    a = Client(1)
+    command(router, 0x31, 1)
+    router.response(a, ack(1, 129))
+    command(router, 0x31, 2)
+    router.response(a, empty(2))
+    assert router.owners == {}
+    assert route(router, [NetSIOMsg(NETSIO_DATA_BYTE, b'\x00')]) == [None]
+
+
+def test_response_to_other_sync_is_ignored():
+    router = SioRouter()
+    a = Client(1)
+    command(router, 0x31, 1)
+    router.response(a, ack(7, 129))
+    assert router.owners == {}
+
+
+def test_forget_client():
+    router = SioRouter()
+    a, b = Client(1), Client(2)
+    command(router, 0x31, 1)
+    router.response(a, ack(1, 129))
+    command(router, 0x70, 2)
+    router.response(b, ack(2))
+    router.forget(a)
+    assert router.owners == {0x70: b}
+    assert router.target is None
+    assert router.stats()['owners'] == {'70': '127.0.0.1:2'}
+
+
+def test_stream_after_read_is_broadcast():
+    router = SioRouter()
+    a = Client(1)
+    command(router, 0x50, 1, command=0x58)
+    # ACK without write size, no data frame follows
+    router.response(a, ack(1))
+    assert router.owners == {0x50: a}
+    assert route(router, [NetSIOMsg(NETSIO_DATA_BYTE, b'x')] * 3) == [None] * 3
+
+
+def test_stream_after_nak_is_broadcast():
+    router = SioRouter()
+    a = Client(1)
+    command(router, 0x31, 1)
+    router.response(a, ack(1, 129, SIO_NAK))
+    assert route(router, [NetSIOMsg(NETSIO_DATA_BYTE, b'x')]) == [None]
+
+
+def test_stream_after_data_frame_is_broadcast():
+    router = SioRouter()
+    a = Client(1)
+    command(router, 0x31, 1)
+    router.response(a, ack(1, 129))
+    assert route(router, [NetSIOMsg(NETSIO_DATA_BLOCK, bytes(128)),
+        NetSIOMsg(NETSIO_DATA_BYTE_SYNC, bytes((0, 2))),
+        NetSIOMsg(NETSIO_DATA_BYTE, b'x')]) == [a, a, None]
+
+
+def test_write_size_ends_data_phase():
+    router = SioRouter()
+    a = Client(1)
+    command(router, 0x31, 1)
+    router.response(a, ack(1, 4))
+    assert route(router, [NetSIOMsg(NETSIO_DATA_BYTE, b'x')] * 6) == [a] * 4 + [None] * 2
+
+
+def test_complete_from_owner_ends_data_phase():
+    router = SioRouter()
+    a, b = Client(1), Client(2)
+    command(router, 0x31, 1)
+    # short response, write size unknown
+    router.response(a, NetSIOMsg(NETSIO_SYNC_RESPONSE, bytes((1, NETSIO_ACK_SYNC, SIO_ACK))))
+    assert route(router, [NetSIOMsg(NETSIO_DATA_BYTE, b'x')]) == [a]
+    router.reply(b)
+    assert route(router, [NetSIOMsg(NETSIO_DATA_BYTE, b'x')]) == [a]
+    router.reply(a)
+    assert route(router, [NetSIOMsg(NETSIO_DATA_BYTE, b'x')]) == [None]
+
+
+def test_reset_ends_data_phase():
+    router = SioRouter()
+    a = Client(1)
+    command(router, 0x31, 1)
+    router.response(a, ack(1, 129))
+    assert route(router, [NetSIOMsg(NETSIO_WARM_RESET), NetSIOMsg(NETSIO_DATA_BYTE, b'x')]) == [None, None]